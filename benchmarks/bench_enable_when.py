@@ -0,0 +1,119 @@
+'''
+micro-benchmark of the compiled enableWhen engine against the previous string munging implementation
+#example: "python benchmarks/bench_enable_when.py"
+#example with the conditions of a reproschema library: "python benchmarks/bench_enable_when.py --library b2ai-reproschemaV3.5/activities"
+'''
+
+import argparse
+import json
+import re as r
+import timeit
+from pathlib import Path
+
+from reproschema_to_fhir.enable_when import compile_condition
+
+# conditions in the style of the B2AI redcap export, used when no library is given
+CORPUS = [
+    "diagnosis_vfp == 1",
+    "diagnosis_vfp_gsd == 1 || diagnosis_vfp_unilateral == 1",
+    "neurological_history___6 == 1",
+    "neurological_history___1 == 1 || neurological_history___2 == 1 || neurological_history___3 == 1",
+    "voice_prof == 1 && voice_prof_type ! == \"\"",
+    "smoking_status == 1 && smoking_years >= 5",
+    "current_neuro_dx(placeholder) == 6 && dx_age <= 18",
+    "gender_identity == 5 or sexual_orientation == 7",
+    "alcohol_amt > 2 && alcohol_freq >= 3",
+    "household_income == 8 and household_size > 1",
+]
+
+
+def legacy_add_enable_when(condition: str):
+    """
+    add_enable_when as it was before the compiled engine, kept for comparison
+    """
+    enable_when = []
+    behave = "None"
+    condition = condition.replace("\n", "")
+    if "||" in condition or " or" in condition:
+        behave = "any"
+    elif "&&" in condition or " and " in condition:
+        behave = "all"
+
+    condition = condition.replace(" or", " or ")
+    condition = condition.replace("\"", "")
+    condition = condition.replace("||", " or ")
+    condition = condition.replace("! == ", "!=")
+
+    condition = r.split(r'&&|and | or ', condition)
+
+    for i in condition:
+        (id, operator, ans) = r.split(r'(==|>=|<=|!=|>|<)', i)
+        if operator == "==":
+            operator = "="
+        id = r.sub(r'\([^()]*\)', '', id.strip())
+        if "___" in id:
+            id, ans = r.split(r'___+', id)
+        enable_when.append({
+            "question": id.strip(),
+            "operator": operator.strip(),
+            "answerString": ans.strip()
+        })
+
+    return (enable_when, behave)
+
+
+def compiled_add_enable_when(condition: str):
+    compiled = compile_condition(condition)
+    return (compiled.enable_when(), compiled.behavior)
+
+
+def library_conditions(library: Path) -> list:
+    """
+    Collect every isVis string from the *_schema files under a reproschema library
+    """
+    conditions = []
+    for schema_file in sorted(library.glob("**/*_schema")):
+        try:
+            schema = json.loads(schema_file.read_text())
+        except (ValueError, UnicodeDecodeError):
+            continue
+        for property in schema.get("ui", {}).get("addProperties", []):
+            if isinstance(property.get("isVis"), str):
+                conditions.append(property["isVis"])
+    return conditions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--library",
+                        type=str,
+                        help="reproschema activities folder to take the isVis conditions from")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=200,
+                        help="how many times the corpus is converted per measurement")
+    args = parser.parse_args()
+
+    corpus = library_conditions(Path(args.library)) if args.library else CORPUS
+    print(f"{len(corpus)} conditions, {len(set(corpus))} distinct")
+
+    def run(function):
+        for condition in corpus:
+            try:
+                function(condition)
+            except ValueError:
+                # the legacy function cannot parse some conditions at all
+                pass
+
+    results = {}
+    for name, function in (("legacy", legacy_add_enable_when),
+                           ("compiled", compiled_add_enable_when)):
+        compile_condition.cache_clear()
+        seconds = min(timeit.repeat(lambda: run(function), number=args.repeat, repeat=5))
+        results[name] = seconds / (args.repeat * len(corpus)) * 1e6
+        print(f"{name:>8}: {results[name]:.2f} us per condition")
+    print(f"speedup: {results['legacy'] / results['compiled']:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+'''
+benchmark harness timing the converter on synthetic activities of growing size
+#example: "python benchmarks/run.py --sizes 10 100 1000 --save baseline.json"
+#example: "python benchmarks/run.py --compare baseline.json"
+'''
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from reproschema_to_fhir.config import Config
+from reproschema_to_fhir.convert import convert_activity
+from reproschema_to_fhir.enable_when import compile_condition
+from reproschema_to_fhir.fhir import QuestionnaireGenerator, add_enable_when, generate_code_system
+
+from synthetic import make_activity, write_activity
+
+BENCHMARKS = ("convert_to_fhir", "add_enable_when", "generate_code_system", "convert_activity", "end_to_end")
+
+MAIN = Path(__file__).resolve().parent.parent / "main.py"
+
+
+def benchmark_config(mode: str) -> Config:
+    config = Config()
+    config.QUESTIONNAIRE_URI = "https://voicecollab.ai/fhir/Questionnaire/"
+    config.VALUESET_URI = "https://voicecollab.ai/fhir/ValueSet/"
+    config.CODESYSTEM_URI = "https://voicecollab.ai/fhir/CodeSystem/"
+    config.LANGUAGE = "en"
+    config.MODE = mode
+    return config
+
+
+def benchmark_environment(config: Config) -> dict:
+    """
+    The environment of a main.py process converting with the settings of config
+    """
+    return dict(os.environ,
+                QUESTIONNAIRE_URI=config.QUESTIONNAIRE_URI,
+                VALUESET_URI=config.VALUESET_URI,
+                CODESYSTEM_URI=config.CODESYSTEM_URI,
+                QUESTIONNAIRE_LANGUAGE=config.LANGUAGE,
+                FHIR_QUESTIONNAIRE_MODE=config.MODE)
+
+
+def best_of(function, repeat: int) -> float:
+    """
+    Shortest of repeat runs, which is the least disturbed by the rest of the machine
+    """
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def run_benchmarks(sizes: list, repeat: int, args) -> dict:
+    config = benchmark_config(args.mode)
+    results = OrderedDict((name, OrderedDict()) for name in BENCHMARKS)
+    for size in sizes:
+        content = make_activity(f"bench_{size}", size, args.choices, args.shared_options,
+                                visibility=args.visibility,
+                                visibility_terms=args.visibility_terms,
+                                version=args.version)
+        schema = content[f"bench_{size}_schema"]
+        conditions = [property["isVis"] for property in schema["ui"]["addProperties"]
+                      if isinstance(property["isVis"], str)]
+        options = [document for path, document in content.items()
+                   if isinstance(document, dict) and "choices" in document]
+        options += [document["responseOptions"] for document in content.values()
+                    if isinstance(document.get("responseOptions"), dict)
+                    and "choices" in document["responseOptions"]]
+
+        results["convert_to_fhir"][size] = best_of(
+            lambda: QuestionnaireGenerator(config).convert_to_fhir(content), repeat)
+
+        def enable_when():
+            # conditions repeat across activities, so the cache is only cleared once per run
+            compile_condition.cache_clear()
+            for condition in conditions:
+                add_enable_when(condition)
+        results["add_enable_when"][size] = best_of(enable_when, repeat)
+
+        value_set_config = benchmark_config("ValueSet")
+        results["generate_code_system"][size] = best_of(
+            lambda: [generate_code_system(document, "bench", value_set_config) for document in options],
+            repeat)
+
+        with tempfile.TemporaryDirectory() as folder:
+            activity = write_activity(Path(folder) / f"bench_{size}", content)
+            results["convert_activity"][size] = best_of(
+                lambda: convert_activity(activity, Path(folder) / "output", config,
+                                         validate=args.validate), repeat)
+            # what a user waits for: starting python, importing and converting through main.py
+            command = [sys.executable, str(MAIN), str(activity), "--output", str(Path(folder) / "output"),
+                       "--validate", args.validate]
+            environment = benchmark_environment(config)
+            results["end_to_end"][size] = best_of(
+                lambda: subprocess.run(command, env=environment, check=True, stdout=subprocess.DEVNULL),
+                repeat)
+
+        print(f"{size:>7} items: " + ", ".join(
+            f"{name} {results[name][size] * 1000:.1f}ms" for name in BENCHMARKS), flush=True)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> list:
+    """
+    Returns a message for every benchmark and size which got slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, timings in results.items():
+        for size, seconds in timings.items():
+            previous = baseline.get(name, {}).get(str(size))
+            if previous and seconds > previous * (1 + tolerance):
+                regressions.append(
+                    f"{name} at {size} items: {seconds * 1000:.1f}ms vs {previous * 1000:.1f}ms baseline "
+                    f"(+{(seconds / previous - 1) * 100:.0f}%)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000, 100000],
+                        help="number of items of each synthetic activity")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--mode", choices=("ValueSet", "AnswerOptions"), default="ValueSet")
+    parser.add_argument("--choices", type=int, default=4)
+    parser.add_argument("--shared-options", type=float, default=0.5)
+    parser.add_argument("--visibility", type=float, default=0.3)
+    parser.add_argument("--visibility-terms", type=int, default=2)
+    parser.add_argument("--version", choices=("0.0.1", "1.0.0"), default="1.0.0")
+    parser.add_argument("--validate", default="off",
+                        help="validation strategy of the convert_activity and end to end benchmarks")
+    parser.add_argument("--save", type=str, help="write the results to this file, eg. as a new baseline")
+    parser.add_argument("--compare", type=str, help="baseline results to flag regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="how much slower than the baseline is a regression, 0.25 is 25%%")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.sizes, args.repeat, args)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            f.write(json.dumps({
+                "python": platform.python_version(),
+                "machine": platform.machine(),
+                "parameters": {key: value for key, value in vars(args).items()
+                               if key not in ("save", "compare")},
+                "results": results,
+            }, indent=2))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.loads(f.read())["results"]
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("no regressions")
+
+
+if __name__ == '__main__':
+    main()
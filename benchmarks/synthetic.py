@@ -0,0 +1,150 @@
+'''
+generator of synthetic reproschema activities for benchmarks
+#example: "python benchmarks/synthetic.py synthetic_activities --items 1000 --activities 10"
+'''
+
+import argparse
+import json
+import random
+from collections import OrderedDict
+from pathlib import Path
+
+
+def make_condition(rng: random.Random, name: str, previous: int, terms: int) -> str:
+    """
+    isVis condition over the first previous items of activity name with the given number of comparisons.
+
+    One comparison is a plain condition, more are joined with && or ||, and from three
+    comparisons on they are mixed and grouped with parentheses like the redcap exports.
+    """
+    comparisons = [
+        f"{name}_item_{rng.randrange(previous)} {rng.choice(['==', '>=', '<=', '!=', '>', '<'])} {rng.randint(0, 5)}"
+        for _ in range(terms)
+    ]
+    if terms < 3:
+        return f" {rng.choice(['&&', '||'])} ".join(comparisons)
+    grouped = f"({comparisons[0]} || {comparisons[1]})"
+    return " && ".join([grouped] + comparisons[2:])
+
+
+def make_options(choices: int, offset: int = 0) -> dict:
+    return {
+        "valueType": "xsd:integer",
+        "choices": [{
+            "name": {"en": f"Choice {offset + number}"},
+            "value": number
+        } for number in range(choices)]
+    }
+
+
+def make_activity(name: str = "synthetic",
+                  items: int = 100,
+                  choices: int = 4,
+                  shared_options: float = 0.5,
+                  choice_items: float = 0.6,
+                  visibility: float = 0.3,
+                  visibility_terms: int = 2,
+                  version: str = "1.0.0",
+                  seed: int = 0) -> OrderedDict:
+    """
+    Builds a reproschema activity as a dict of path: document, like the content main loads.
+
+    - items: number of items
+    - choices: number of choices per choice item
+    - shared_options: share of the choice items using one of a few shared option lists,
+      the others each have their own list
+    - choice_items: share of the items which are choice (radio) items, the others are text or number
+    - visibility / visibility_terms: share of the items with an isVis condition and the
+      number of comparisons in it
+    - version: "0.0.1" puts the responseOptions inline, "1.0.0" references option files
+    """
+    rng = random.Random(seed)
+    content = OrderedDict()
+    order = []
+    properties = []
+    for number in range(items):
+        var_name = f"{name}_item_{number}"
+        item = {
+            "@type": "reproschema:Field",
+            "id": var_name,
+            "prefLabel": var_name,
+            "question": {"en": f"Question {number} of {name}?"},
+        }
+        if rng.random() < choice_items:
+            item["ui"] = {"inputType": "radio"}
+            if rng.random() < shared_options:
+                shared = rng.randint(0, 4)
+                options_name = f"shared_options_{shared}"
+                options = make_options(choices, offset=items + shared * choices)
+            else:
+                options_name = f"{var_name}_options"
+                options = make_options(choices, offset=number)
+            if version == "0.0.1":
+                item["responseOptions"] = options
+            else:
+                item["responseOptions"] = f"../valueConstraints/{options_name}"
+                content[f"valueConstraints/{options_name}"] = options
+        elif rng.random() < 0.5:
+            item["ui"] = {"inputType": "number"}
+            item["responseOptions"] = {"valueType": "xsd:integer"}
+        else:
+            item["ui"] = {"inputType": "text"}
+            item["responseOptions"] = {"valueType": "xsd:string"}
+        content[f"items/{var_name}"] = item
+        order.append(f"items/{var_name}")
+
+        is_vis = True
+        if number > 0 and rng.random() < visibility:
+            is_vis = make_condition(rng, name, number, visibility_terms)
+        properties.append({"variableName": var_name, "isAbout": f"items/{var_name}", "isVis": is_vis})
+
+    schema = {
+        "@type": "reproschema:Activity",
+        "id": f"{name}_schema",
+        "prefLabel": name,
+        "schemaVersion": version,
+        "ui": {"order": order, "addProperties": properties, "shuffle": False},
+    }
+    content[f"{name}_schema"] = schema
+    content.move_to_end(f"{name}_schema", last=False)
+    return content
+
+
+def write_activity(folder, content: dict):
+    """
+    Write a generated activity to a folder, one file per document
+    """
+    folder = Path(folder)
+    for path, document in content.items():
+        (folder / path).parent.mkdir(parents=True, exist_ok=True)
+        with open(folder / path, "w") as f:
+            f.write(json.dumps(document))
+    return folder
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("output", type=str, help="folder to write the activities to")
+    parser.add_argument("--activities", type=int, default=1)
+    parser.add_argument("--items", type=int, default=100)
+    parser.add_argument("--choices", type=int, default=4)
+    parser.add_argument("--shared-options", type=float, default=0.5)
+    parser.add_argument("--visibility", type=float, default=0.3)
+    parser.add_argument("--visibility-terms", type=int, default=2)
+    parser.add_argument("--version", choices=("0.0.1", "1.0.0"), default="1.0.0")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    for number in range(args.activities):
+        name = f"synthetic_{number}"
+        write_activity(
+            Path(args.output) / name,
+            make_activity(name, args.items, args.choices, args.shared_options,
+                          visibility=args.visibility,
+                          visibility_terms=args.visibility_terms,
+                          version=args.version,
+                          seed=args.seed + number))
+
+
+if __name__ == '__main__':
+    main()
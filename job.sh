@@ -1,11 +1,7 @@
 #!/bin/bash
-arr=(./b2ai-reproschemaV3.5/activities/*) # change based on where your reproschema folders are
-arr=("${arr[@]%/}")
-arr=("${arr[@]##*/}") 
-
-for folder in "${arr[@]}"; do
-    python main.py ./b2ai-reproschemaV3.5/activities/"${folder}"
-done
-
-
-
+# change based on where your reproschema folders are
+# all activities are converted in one process pool, pass --workers N to limit the number of processes
+# activities which did not change since the last run are skipped
+python main.py --batch ./b2ai-reproschemaV3.5/activities --incremental --deterministic "$@"
+# or convert the activities of a protocol, add --grouped for a single questionnaire:
+# python main.py --protocol ./b2ai-reproschemaV3.5/protocols/<protocol> --deterministic "$@"
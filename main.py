@@ -2,126 +2,465 @@
 script to convert repro scheme to json for fhir questionnaire
 Currently supports reproschema to fhir json in en.
 #example: "python reprotofhirjson.py <reproschema_folder directory>"
+#batch example: "python main.py --batch <activities folder> --workers 8"
+#watch example: "python main.py --batch <activities folder> --watch"
+#upload example: "python main.py upload output --url http://localhost:8080/fhir"
+#service example: "python main.py serve --port 8000"
+#responses example: "python main.py responses <reproschema folder> responses.ndjson --output QuestionnaireResponse.ndjson"
+#validate example: "python main.py validate output QuestionnaireResponse.ndjson"
 '''
 
 import argparse
-from collections import OrderedDict
-import json
-import os
-import shutil
+import sys
+import time
 from pathlib import Path
 
-from fhir.resources.questionnaire import Questionnaire
-from fhir.resources.valueset import ValueSet
-from fhir.resources.codesystem import CodeSystem
-from fhir.resources import construct_fhir_element
+from reproschema_to_fhir.archive import activity_name, is_archive
+from reproschema_to_fhir.batch import ActivityResult, BatchOptions, print_summary, run_batch, target_registry_path
+from reproschema_to_fhir.bulk import OUTPUT_FORMATS, NdjsonWriter
+from reproschema_to_fhir.config import Config
+from reproschema_to_fhir.convert import claiming, convert_activity, convert_resources, convert_targets
+from reproschema_to_fhir.item_cache import ItemCache
+from reproschema_to_fhir.manifest import Manifest, conversion_fingerprint, hash_activity
+from reproschema_to_fhir.profiling import StageTimer, write_report
+from reproschema_to_fhir.protocol import Protocol, convert_grouped_protocol
+from reproschema_to_fhir.registry import TerminologyRegistry
+from reproschema_to_fhir.resolver import DEFAULT_TTL, Resolver
+from reproschema_to_fhir.targets import load_targets
+from reproschema_to_fhir.validation import VALIDATION_STRATEGIES
 
-from reproschema.jsonldutils import load_file
 
-from reproschema_to_fhir.config import Config
-from reproschema_to_fhir.fhir import QuestionnaireGenerator
+def upload_main(argv):
+    # the subcommands import what only they need, eg. asyncio and http.server, when they run
+    from reproschema_to_fhir.upload import BUNDLE_TYPES, upload
+
+    parser = argparse.ArgumentParser(prog="main.py upload")
+    parser.add_argument("output",
+                        type=str,
+                        help="output folder of a conversion, in the files or the ndjson format")
+    parser.add_argument("--url",
+                        type=str,
+                        required=True,
+                        help="base url of the FHIR server the bundles are posted to")
+    parser.add_argument("--bundle-size",
+                        type=int,
+                        default=100,
+                        help="number of resources per bundle")
+    parser.add_argument("--bundle-type",
+                        choices=BUNDLE_TYPES,
+                        default="batch")
+    parser.add_argument("--concurrency",
+                        type=int,
+                        default=4,
+                        help="number of bundles sent at once")
+    parser.add_argument("--retries",
+                        type=int,
+                        default=3,
+                        help="how often a bundle is sent again after a connection error or a 429/5xx response")
+    parser.add_argument("--header",
+                        type=str,
+                        action="append",
+                        default=[],
+                        metavar="NAME: VALUE",
+                        help="extra http header, eg. for authorization")
+    args = parser.parse_args(argv)
+
+    headers = dict()
+    for header in args.header:
+        (name, _, value) = header.partition(":")
+        headers[name.strip()] = value.strip()
+
+    results = upload(args.output, args.url, args.bundle_size, args.bundle_type,
+                     args.concurrency, args.retries, headers=headers)
+    for result in results:
+        if not result.ok:
+            print(f"FAILED  bundle {result.bundle} ({result.entries} resources, "
+                  f"{result.attempts} attempts): {result.error}")
+    failures = [result for result in results if not result.ok]
+    print(f"{len(results) - len(failures)} of {len(results)} bundles uploaded, "
+          f"{sum(result.entries for result in results if result.ok)} resources")
+    if failures:
+        sys.exit(1)
+
+
+def serve_main(argv):
+    from reproschema_to_fhir.service import serve
+
+    parser = argparse.ArgumentParser(prog="main.py serve")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="number of worker processes converting requests (default: number of CPUs)")
+    parser.add_argument("--validate",
+                        choices=VALIDATION_STRATEGIES,
+                        default="full",
+                        help="default validation strategy, requests can pick another one with ?validate=")
+    parser.add_argument("--document-cache",
+                        type=str,
+                        default=None,
+                        metavar="PATH",
+                        help="folder of cached documents activities may reference by URL, eg. filled by a "
+                        "conversion with --document-cache; the service never fetches a URL itself")
+    args = parser.parse_args(argv)
+    serve(args.host, args.port, args.workers, args.validate, args.document_cache)
+
+
+def responses_main(argv):
+    from reproschema_to_fhir.responses import convert_responses
+
+    parser = argparse.ArgumentParser(prog="main.py responses")
+    parser.add_argument("reproschema_questionnaire",
+                        type=str,
+                        help="path to the folder of the reproschema activity the responses are for")
+    parser.add_argument("responses",
+                        type=str,
+                        help="ndjson file of reproschema response activities, one per line (.gz for gzipped)")
+    parser.add_argument("--output",
+                        type=str,
+                        default="output/QuestionnaireResponse.ndjson",
+                        help="ndjson file to write the QuestionnaireResponses to (.gz for gzipped)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=10000,
+                        help="number of responses handed to a worker at a time")
+    parser.add_argument("--terminology",
+                        type=str,
+                        default=None,
+                        metavar="REGISTRY",
+                        help="terminology.sqlite of the --shared-terminology conversion of the activity, so the "
+                        "answers code the shared code systems its questionnaire uses")
+    parser.add_argument("--document-cache",
+                        type=str,
+                        metavar="PATH",
+                        help="the --document-cache of the conversion of the activity, the items and option "
+                        "lists it references by URL are read from it until --cache-ttl expires")
+    parser.add_argument("--cache-ttl",
+                        type=float,
+                        default=DEFAULT_TTL,
+                        help="seconds a document in the --document-cache is used before it is revalidated")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="never fetch referenced documents, only use the ones in the --document-cache")
+    args = parser.parse_args(argv)
+    if args.offline and args.document_cache is None:
+        parser.error("--offline needs a --document-cache")
+
+    start = time.perf_counter()
+    (converted, failed, errors) = convert_responses(args.reproschema_questionnaire, args.responses,
+                                                    args.output, workers=args.workers,
+                                                    chunk_size=args.chunk_size,
+                                                    registry_path=args.terminology,
+                                                    resolver=Resolver(args.document_cache, args.cache_ttl,
+                                                                      args.offline))
+    for error in errors:
+        print(f"FAILED  line {error['line']}: {error['error']}")
+    seconds = time.perf_counter() - start
+    print(f"{converted} responses converted, {failed} failed in {seconds:.2f}s "
+          f"({converted / max(seconds, 1e-9):.0f} per second)")
+    if failed:
+        sys.exit(1)
+
+
+def validate_main(argv):
+    from reproschema_to_fhir.response_validation import validate_responses
+    from reproschema_to_fhir.upload import read_output
+
+    parser = argparse.ArgumentParser(prog="main.py validate")
+    parser.add_argument("output",
+                        type=str,
+                        help="output folder of a conversion with the Questionnaires, ValueSets and CodeSystems")
+    parser.add_argument("responses",
+                        type=str,
+                        help="ndjson file of QuestionnaireResponses, one per line (.gz for gzipped)")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="number of worker processes (default: number of CPUs)")
+    parser.add_argument("--chunk-size",
+                        type=int,
+                        default=10000,
+                        help="number of responses handed to a worker at a time")
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    (total, invalid, errors) = validate_responses(read_output(args.output), args.responses,
+                                                  workers=args.workers, chunk_size=args.chunk_size)
+    for error in errors:
+        for response_error in error["errors"]:
+            link_id = response_error["linkId"] or "-"
+            print(f"INVALID  line {error['line']} ({error['id']}) {link_id}: {response_error['error']}")
+    seconds = time.perf_counter() - start
+    print(f"{total} responses validated, {invalid} invalid in {seconds:.2f}s "
+          f"({total / max(seconds, 1e-9):.0f} per second)")
+    if invalid:
+        sys.exit(1)
+
 
 def main():
+    if sys.argv[1:2] == ["responses"]:
+        return responses_main(sys.argv[2:])
+    if sys.argv[1:2] == ["validate"]:
+        return validate_main(sys.argv[2:])
+    if sys.argv[1:2] == ["upload"]:
+        return upload_main(sys.argv[2:])
+    if sys.argv[1:2] == ["serve"]:
+        return serve_main(sys.argv[2:])
+
     parser = argparse.ArgumentParser()
     # string param of path to folder containing reproschema files
     parser.add_argument("reproschema_questionnaire",
                         type=str,
-                        help="path to folder containing reproschema files")
+                        nargs="?",
+                        help="path to folder containing reproschema files, a zip or tar archive of one activity, "
+                        "or <archive>!/<folder> for an activity inside an archive")
     parser.add_argument("--output",
                         type=str,
                         default="output",
                         help="path to folder to output fhir json")
+    parser.add_argument("--batch",
+                        type=str,
+                        metavar="ACTIVITIES_ROOT",
+                        help="convert every activity folder under this folder, or in this zip or tar archive, "
+                        "in a single process pool")
+    parser.add_argument("--protocol",
+                        type=str,
+                        metavar="PROTOCOL",
+                        help="convert every activity of a reproschema protocol (a folder, a folder in an archive or "
+                        "the URL of its schema) in a single process pool, with shared terminology")
+    parser.add_argument("--grouped",
+                        action="store_true",
+                        help="convert the --protocol into a single questionnaire with a group item per activity")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="number of worker processes used with --batch or --validate parallel (default: number of CPUs)")
+    parser.add_argument("--shared-terminology",
+                        action="store_true",
+                        help="reuse one CodeSystem/ValueSet per distinct set of codes and displays across activities and runs, "
+                        "registered in <output>/terminology.sqlite and written to <output>/codesystems and <output>/valuesets")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="skip activities whose input files and config did not change since the last run, "
+                        "tracked in <output>/manifest.json")
+    parser.add_argument("--deterministic",
+                        action="store_true",
+                        help="pin resource dates to the last change of the input files so unchanged content gives identical files")
+    parser.add_argument("--validate",
+                        choices=VALIDATION_STRATEGIES,
+                        default="full",
+                        help="validate every resource (full), none (off), a random share of them (sample) "
+                        "or every resource across a pool of --workers processes (parallel)")
+    parser.add_argument("--validate-sample-rate",
+                        type=float,
+                        default=0.1,
+                        help="share of the resources validated with --validate sample")
+    parser.add_argument("--report",
+                        type=str,
+                        metavar="PATH",
+                        help="time the load, index, convert, validate and write stages of each activity "
+                        "and write a JSON report with per-stage totals and p50/p95 figures")
+    parser.add_argument("--trace-memory",
+                        action="store_true",
+                        help="add the peak traced memory of each stage to the --report (slower)")
+    parser.add_argument("--progress",
+                        action="store_true",
+                        help="show a progress bar in --batch runs")
+    parser.add_argument("--format",
+                        choices=OUTPUT_FORMATS,
+                        default="files",
+                        help="write a folder of json files per activity (files) or every resource to "
+                        "Questionnaire.ndjson, ValueSet.ndjson and CodeSystem.ndjson for a FHIR $import (ndjson)")
+    parser.add_argument("--gzip",
+                        action="store_true",
+                        help="gzip the --format ndjson files")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="write each questionnaire item by item as it is converted and validated, "
+                        "so memory stays bounded by one item for very large activities")
+    parser.add_argument("--watch",
+                        action="store_true",
+                        help="after the --batch run keep running and convert again every activity whose files change")
+    parser.add_argument("--watch-interval",
+                        type=float,
+                        default=0.5,
+                        help="seconds between two checks for changed files with --watch")
+    parser.add_argument("--item-cache",
+                        type=str,
+                        metavar="PATH",
+                        help="keep converted items in an SQLite database at PATH, reused by later runs "
+                        "(batch runs always reuse them between the activities a worker converts)")
+    parser.add_argument("--profile",
+                        type=str,
+                        metavar="PATH",
+                        help="a JSON profile of targets, each with its own .env settings (eg. URIs and mode) "
+                        "and output folder; every activity is loaded once and written for every target")
+    parser.add_argument("--document-cache",
+                        type=str,
+                        metavar="PATH",
+                        help="keep the items and option lists referenced by URL in a folder at PATH, "
+                        "reused by later runs until --cache-ttl expires and then revalidated")
+    parser.add_argument("--cache-ttl",
+                        type=float,
+                        default=DEFAULT_TTL,
+                        help="seconds a document in the --document-cache is used before it is revalidated")
+    parser.add_argument("--offline",
+                        action="store_true",
+                        help="never fetch referenced documents, only use the ones in the --document-cache")
     args = parser.parse_args()
 
-    output_path = Path(args.output)
-    reproschema_folder = Path(args.reproschema_questionnaire)
-    if not os.path.isdir(reproschema_folder):
-        raise FileNotFoundError(
-            f"{reproschema_folder} does not exist. Please check if folder exists and is located at the correct directory"
-        )
-
-    # load each file recursively within the folder into its own key in the reproschema_content dict
-    reproschema_content = OrderedDict()
-    for file in reproschema_folder.glob("**/*"):
-        if file.is_file():
-            # get the full path to the file *after* the base reproschema_folder path
-            # since files can be referenced by relative paths, we need to keep track of relative location
-            filename = str(file.relative_to(reproschema_folder))
-            with open(f"{reproschema_folder}/{filename}") as f:
-                reproschema_content[filename] = json.loads(f.read())
-
-    schema_name = [
-        name for name in (reproschema_content.keys())
-        if name.endswith("_schema")
-    ][0]
-    reproschema_schema = reproschema_content[schema_name]
-
-    if (f"schema:version" in reproschema_schema and
-            reproschema_schema["schema:version"] not in ("0.0.1", "1.0.0-rc1", "1.0.0")
-        ) or f"schemaVersion" in reproschema_schema and reproschema_schema[
-            "schemaVersion"] not in ("0.0.1", "1.0.0-rc1", "1.0.0-rc4", "1.0.0"):
-        raise ValueError(
-            'Unable to work with reproschema versions other than 0.0.1, 1.0.0-rc1, and 1.0.0-rc4'
-        )
-    # before we print to file we wish to validate the jsons using fhir resources
-
-    # convert to fhir
+    registry_path = None
+    if args.shared_terminology:
+        registry_path = Path(args.output) / "terminology.sqlite"
+
+    if args.batch is None and args.protocol is None and args.reproschema_questionnaire is None:
+        parser.error("either a reproschema folder, --batch or --protocol is required")
+    if args.protocol is not None and args.batch is not None:
+        parser.error("--protocol and --batch cannot be used together")
+    if args.grouped and args.protocol is None:
+        parser.error("--grouped needs --protocol")
+    if args.grouped and (args.format == "ndjson" or args.stream or args.incremental):
+        parser.error("--grouped cannot be used with --format ndjson, --stream or --incremental")
+    if args.format == "ndjson" and args.incremental:
+        parser.error("--incremental cannot be used with --format ndjson, the ndjson files are rewritten by every run")
+    if args.watch and args.batch is None:
+        parser.error("--watch needs --batch")
+    if args.watch and is_archive(args.batch):
+        parser.error("--watch needs a folder of activities, not an archive")
+    if args.watch and args.format == "ndjson":
+        parser.error("--watch cannot be used with --format ndjson")
+    if args.format == "ndjson" and args.stream:
+        parser.error("--stream cannot be used with --format ndjson")
+    if args.profile is not None and (args.format == "ndjson" or args.stream or args.incremental
+                                     or args.watch or args.grouped):
+        parser.error("--profile cannot be used with --format ndjson, --stream, --incremental, --watch or --grouped")
+    if args.offline and args.document_cache is None:
+        parser.error("--offline needs a --document-cache")
+
     config = Config()
+    targets = None
+    if args.profile is not None:
+        targets = load_targets(args.profile, args.output, config)
+
+    start = time.perf_counter()
+    if args.protocol is not None and args.grouped:
+        name = convert_grouped_protocol(args.protocol, args.output, args.workers, args.deterministic,
+                                        args.validate, args.validate_sample_rate,
+                                        item_cache_path=args.item_cache,
+                                        document_cache_path=args.document_cache,
+                                        offline=args.offline, cache_ttl=args.cache_ttl)
+        print(f"{name} converted in {time.perf_counter() - start:.2f}s")
+        return
+    if args.protocol is not None:
+        # the activities of a protocol share their code systems and value sets
+        registry_path = Path(args.output) / "terminology.sqlite"
+        args.batch = Protocol(args.protocol,
+                              Resolver(args.document_cache, args.cache_ttl, args.offline)).locations
+    if args.batch is not None:
+        watcher = None
+        if args.watch:
+            from reproschema_to_fhir.watch import ActivityWatcher
+            watcher = ActivityWatcher(
+                args.batch, args.output,
+                BatchOptions(None if registry_path is None else str(registry_path),
+                             True, args.deterministic, args.validate,
+                             args.validate_sample_rate, stream=args.stream,
+                             item_cache_path=args.item_cache,
+                             document_cache_path=args.document_cache,
+                             offline=args.offline, cache_ttl=args.cache_ttl))
+            # changes made during the first run are picked up by the first poll
+            watcher.prime()
+        results = run_batch(args.batch, args.output, args.workers,
+                            registry_path, args.incremental or args.watch, args.deterministic,
+                            args.validate, args.validate_sample_rate,
+                            profile=args.report is not None,
+                            trace_memory=args.trace_memory,
+                            progress=args.progress,
+                            output_format=args.format,
+                            compress=args.gzip,
+                            stream=args.stream,
+                            item_cache_path=args.item_cache,
+                            document_cache_path=args.document_cache,
+                            offline=args.offline,
+                            cache_ttl=args.cache_ttl,
+                            targets=targets)
+        print_summary(results)
+        if args.report is not None:
+            write_report(args.report, results, time.perf_counter() - start)
+        if watcher is not None:
+            print(f"watching {args.batch} for changes, press Ctrl+C to stop")
+            try:
+                watcher.watch(args.watch_interval, on_results=print_summary)
+            except KeyboardInterrupt:
+                pass
+            return
+        if not all(result.ok for result in results):
+            sys.exit(1)
+        return
+
+    registry = None
+    if registry_path is not None:
+        registry_path.parent.mkdir(parents=True, exist_ok=True)
+        registry = TerminologyRegistry(registry_path)
+        if args.format == "ndjson":
+            registry.clear()
+
+    item_cache = None
+    if args.item_cache is not None:
+        Path(args.item_cache).parent.mkdir(parents=True, exist_ok=True)
+        item_cache = ItemCache(args.item_cache)
+    resolver = Resolver(args.document_cache, args.cache_ttl, args.offline)
+
+    name = activity_name(args.reproschema_questionnaire)
+    if args.incremental:
+        manifest = Manifest(Path(args.output) / "manifest.json")
+        digest = hash_activity(
+            args.reproschema_questionnaire,
+            conversion_fingerprint(config, registry is not None, args.deterministic, args.validate))
+        if manifest.is_current(name, digest, args.output):
+            print(f"{name} is unchanged, skipping")
+            return
+
+    timer = StageTimer(args.report is not None, args.trace_memory)
+    if targets is not None:
+        registries = None
+        if registry_path is not None:
+            registries = dict()
+            for target in targets:
+                target_registry_path(target).parent.mkdir(parents=True, exist_ok=True)
+                registries[target.name] = TerminologyRegistry(target_registry_path(target))
+        convert_targets(args.reproschema_questionnaire, targets, registries, args.deterministic,
+                        args.validate, args.validate_sample_rate, args.workers, timer, item_cache,
+                        resolver)
+    elif args.format == "ndjson":
+        with claiming(registry):
+            (_, questionnaire, valuesets, codesystems, _) = convert_resources(
+                args.reproschema_questionnaire, config, registry, args.deterministic,
+                args.validate, args.validate_sample_rate, args.workers, timer, item_cache,
+                resolver)
+            with timer.stage("write"), NdjsonWriter(args.output, args.gzip) as writer:
+                writer.write_activity(name, questionnaire, valuesets, codesystems)
+    else:
+        convert_activity(args.reproschema_questionnaire, args.output, config,
+                         registry, args.deterministic, args.validate,
+                         args.validate_sample_rate, args.workers, timer,
+                         args.stream, item_cache, resolver)
+    if args.report is not None:
+        seconds = time.perf_counter() - start
+        write_report(args.report, [
+            ActivityResult(name, args.reproschema_questionnaire, True, seconds,
+                           stages=timer.stages)
+        ], seconds)
+
+    if args.incremental:
+        manifest.update(name, digest)
+        manifest.save()
 
-    questionnaire_generator = QuestionnaireGenerator(config)
-    fhir_questionnaire = questionnaire_generator.convert_to_fhir(
-        reproschema_content)
-    
-    questionnaire_json = construct_fhir_element('Questionnaire',
-                                                json.dumps(fhir_questionnaire))
-
-    valueset_dict = questionnaire_generator.get_value_set()
-
-    for valueset in valueset_dict:
-        valueset_json = construct_fhir_element('ValueSet',
-                                               valueset_dict[valueset])
-
-    codesystem_dict = questionnaire_generator.get_code_system()
-
-    for codesystem in codesystem_dict:
-        codesystem_json = construct_fhir_element('CodeSystem',
-                                                 codesystem_dict[codesystem])
-
-    # get filename from the reproschema_folder name provided
-
-    file_name = reproschema_folder.parts[-1]
-
-    dirpath = Path(output_path / f"{file_name}")
-    if dirpath.exists() and dirpath.is_dir():
-        shutil.rmtree(dirpath)
-
-    paths = [
-        output_path / file_name,
-        output_path / f"{file_name}/valuesets/",
-        output_path / f"{file_name}/codesystems/"
-    ]
-    
-    for folder in paths:
-        folder.mkdir(parents=True, exist_ok=True)
-
-    with open(output_path / f"{file_name}/{file_name}.json", "w+") as f:
-        f.write(json.dumps(fhir_questionnaire))
-
-    # write out valuesets and codesystems which have been updated in the generator object
- 
-    valueset_count = 1
-    valuesets = [value for (key,value) in questionnaire_generator.get_value_set().items()]
-    for valueset in valuesets:
-        with open(output_path / f"{file_name}/valuesets/{file_name}-valueset-{valueset_count}.json", "w+") as f:
-            f.write(json.dumps(valueset))
-        valueset_count += 1
-
-    codesystem_count = 1
-    codesystems = [value for (key,value) in questionnaire_generator.get_code_system().items()]
-    for codesystem in codesystems:
-        with open(output_path / f"{file_name}/codesystems/{file_name}-codesystem-{codesystem_count}.json", "w+") as f:
-            f.write(json.dumps(codesystem))
-        codesystem_count += 1
 
 if __name__ == '__main__':
     main()
@@ -1,4 +1,42 @@
+import gzip
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+import urllib.error
+import urllib.request
+import zipfile
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
 import pytest
+from reproschema_to_fhir.archive import Archive, FolderSource, activity_name, open_source
+from reproschema_to_fhir.batch import BatchOptions, find_activities, run_batch
+from reproschema_to_fhir.bulk import NdjsonWriter
+from reproschema_to_fhir import fhir, jsonio
+from reproschema_to_fhir.convert import convert_activity, convert_resources
+from reproschema_to_fhir.enable_when import ENABLE_WHEN_EXPRESSION_URL, AllOf, AnyOf, Condition, compile_condition, parse_condition
+from reproschema_to_fhir.index import ReproschemaIndex
+from reproschema_to_fhir.item_cache import ItemCache
+from reproschema_to_fhir.loader import ReproschemaLoader
+from reproschema_to_fhir.manifest import Manifest, last_change
+from reproschema_to_fhir.profiling import STAGES, percentile, summarize_stages, write_report
+from reproschema_to_fhir.protocol import Protocol, convert_grouped_protocol
+from reproschema_to_fhir.registry import TerminologyRegistry, concept_fingerprint
+from reproschema_to_fhir.resolver import Resolver
+from reproschema_to_fhir.response_validation import ResponseValidator, validate_responses
+from reproschema_to_fhir.responses import ResponseConverter, convert_responses
+from reproschema_to_fhir.service import ConversionServer
+from reproschema_to_fhir.stream import replace_strings, replace_strings_in_file, write_questionnaire_stream
+from reproschema_to_fhir.targets import load_targets
+from reproschema_to_fhir.upload import make_bundles, read_output, upload
+from reproschema_to_fhir.visibility import VisibilityError, VisibilityGraph, parse_enable_when_expression
+from reproschema_to_fhir.watch import ActivityWatcher
+from reproschema_to_fhir.validation import serialize, validate_resources
 from reproschema_to_fhir.fhir import add_options, add_enable_when, Config, generate_code_system, generate_value_set, QuestionnaireGenerator
 from collections import OrderedDict
 
@@ -287,4 +325,1270 @@ def test_add_enable_when_edgecase_with_parentheses():
          "answerString": "2"
          }], "all")
 
-    assert expected == actual
\ No newline at end of file
+    assert expected == actual
+
+def write_activity(folder, name, items=None, extra_files=None):
+    """
+    Write a small reproschema activity to disk for the tests that work on folders
+    """
+    if items is None:
+        items = {
+            "consent": {"ui": {"inputType": "radio"}, "question": {"en": "Do you consent?"},
+                        "responseOptions": {"valueType": "xsd:integer", "choices": [
+                            {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}},
+            "age": {"ui": {"inputType": "number"}, "question": {"en": "Age"},
+                    "responseOptions": {"valueType": "xsd:integer"}},
+        }
+    activity = folder / name
+    (activity / "items").mkdir(parents=True)
+    schema = {"@type": "reproschema:Activity", "id": f"{name}_schema", "schemaVersion": "1.0.0",
+              "ui": {"order": [f"items/{item}" for item in items],
+                     "addProperties": [{"variableName": item, "isAbout": f"items/{item}", "isVis": True}
+                                       for item in items]}}
+    (activity / f"{name}_schema").write_text(json.dumps(schema))
+    for item, item_json in items.items():
+        (activity / "items" / item).write_text(json.dumps(dict(item_json, id=item)))
+    for path, content in (extra_files or {}).items():
+        (activity / path).parent.mkdir(parents=True, exist_ok=True)
+        (activity / path).write_text(content if isinstance(content, str) else json.dumps(content))
+    return activity
+
+
+@pytest.fixture
+def fhir_env(monkeypatch):
+    monkeypatch.setenv("CODESYSTEM_URI", "https://voicecollab.ai/fhir/CodeSystem/")
+    monkeypatch.setenv("VALUESET_URI", "https://voicecollab.ai/fhir/ValueSet/")
+    monkeypatch.setenv("QUESTIONNAIRE_URI", "https://voicecollab.ai/fhir/Questionnaire/")
+    monkeypatch.setenv("QUESTIONNAIRE_LANGUAGE", "en")
+    monkeypatch.setenv("FHIR_QUESTIONNAIRE_MODE", "ValueSet")
+
+
+def test_find_activities_only_returns_folders_with_a_schema(tmp_path):
+    write_activity(tmp_path, "b_activity")
+    write_activity(tmp_path, "a_activity")
+    (tmp_path / "not_an_activity").mkdir()
+    assert [folder.name for folder in find_activities(tmp_path)] == ["a_activity", "b_activity"]
+
+
+def test_run_batch_converts_every_activity_and_reports_failures(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    write_activity(activities, "second")
+    broken = write_activity(activities, "broken")
+    (broken / "broken_schema").write_text(json.dumps({"id": "broken_schema", "schemaVersion": "9.9.9"}))
+
+    results = run_batch(activities, tmp_path / "output", workers=2)
+
+    assert [(result.name, result.ok) for result in results] == [
+        ("broken", False), ("first", True), ("second", True)]
+    assert "ValueError" in results[0].error
+    questionnaire = json.loads((tmp_path / "output" / "first" / "first.json").read_text())
+    assert [item["linkId"] for item in questionnaire["item"]] == ["consent", "age"]
+    assert (tmp_path / "output" / "second" / "codesystems" / "second-codesystem-1.json").exists()
+
+
+def test_loader_only_reads_documents_reachable_from_the_schema(tmp_path):
+    activity = write_activity(tmp_path, "activity", extra_files={
+        "notes.txt": "not json", "items/unused": "{broken"})
+    loader = ReproschemaLoader(activity)
+
+    assert loader.schema_name == "activity_schema"
+    assert list(loader) == ["activity_schema", "items/consent", "items/age"]
+    assert set(loader._documents) == {"activity_schema"}
+    assert loader["items/age"]["question"] == {"en": "Age"}
+    assert set(loader._documents) == {"activity_schema", "items/age"}
+    with pytest.raises(KeyError):
+        loader["items/missing"]
+
+
+def test_loader_checks_schema_version_before_reading_items(tmp_path):
+    activity = write_activity(tmp_path, "activity")
+    (activity / "activity_schema").write_text(json.dumps(
+        {"id": "activity_schema", "schemaVersion": "2.0.0", "ui": {"order": ["items/age"]}}))
+    (activity / "items" / "age").write_text("{broken")
+    with pytest.raises(ValueError):
+        ReproschemaLoader(activity)
+
+
+def test_convert_to_fhir_accepts_a_loader(tmp_path, fhir_env):
+    activity = write_activity(tmp_path, "activity")
+    from_loader = QuestionnaireGenerator(Config()).convert_to_fhir(ReproschemaLoader(activity))
+    content = OrderedDict((str(path.relative_to(activity)), json.loads(path.read_text()))
+                          for path in activity.glob("**/*") if path.is_file())
+    from_dict = QuestionnaireGenerator(Config()).convert_to_fhir(content)
+    from_loader["date"] = from_dict["date"]
+    assert from_loader == from_dict
+
+
+def test_index_resolves_options_by_relative_path_not_basename(tmp_path, fhir_env, monkeypatch):
+    items = {
+        "pain": {"ui": {"inputType": "radio"}, "question": {"en": "Pain?"},
+                 "responseOptions": "../options/adult/scale"},
+        "pain_child": {"ui": {"inputType": "radio"}, "question": {"en": "Pain (child)?"},
+                       "responseOptions": "../options/child/scale"},
+    }
+    activity = write_activity(tmp_path, "activity", items=items, extra_files={
+        "options/adult/scale": {"choices": [{"name": {"en": "None"}, "value": 0},
+                                            {"name": {"en": "Severe"}, "value": 3}]},
+        "options/child/scale": {"choices": [{"name": {"en": "Happy face"}, "value": 0},
+                                            {"name": {"en": "Sad face"}, "value": 1}]},
+    })
+    index = ReproschemaIndex.build(ReproschemaLoader(activity))
+    assert list(index.items) == ["items/pain", "items/pain_child"]
+    assert set(index.options) == {"options/adult/scale", "options/child/scale"}
+    assert index.visibility == {"pain": True, "pain_child": True}
+
+    # resolving must not depend on the process working directory
+    monkeypatch.chdir(tmp_path)
+    config = Config()
+    config.MODE = "AnswerOptions"
+    questionnaire = QuestionnaireGenerator(config).convert_to_fhir(index)
+    assert [item["answerOption"] for item in questionnaire["item"]] == [
+        [{"valueString": "None"}, {"valueString": "Severe"}],
+        [{"valueString": "Happy face"}, {"valueString": "Sad face"}]]
+
+
+def test_parse_condition_respects_precedence_and_parentheses():
+    assert parse_condition("a == 1 || b == 2 && c == 3") == AnyOf((
+        Condition("a", "=", "1"), AllOf((Condition("b", "=", "2"), Condition("c", "=", "3")))))
+    assert parse_condition("(a == 1 || b == 2) && c ! == \"x\"") == AllOf((
+        AnyOf((Condition("a", "=", "1"), Condition("b", "=", "2"))), Condition("c", "!=", "x")))
+    assert parse_condition("a == 1 or (b == 2 or c >= 3)") == AnyOf((
+        Condition("a", "=", "1"), Condition("b", "=", "2"), Condition("c", ">=", "3")))
+    with pytest.raises(ValueError):
+        parse_condition("a == 1 &&")
+
+
+def test_compile_condition_is_cached_and_uses_expression_for_mixed_operators():
+    flat = compile_condition("brand_new == 1 and android < 2")
+    assert flat is compile_condition("brand_new == 1 and android < 2")
+    assert flat.behavior == "all" and flat.expression is None
+    assert [condition.question for condition in flat.conditions] == ["brand_new", "android"]
+
+    item = {"linkId": "q"}
+    compile_condition("(a == 1 || b == 2) && c > 3").apply(item)
+    assert "enableWhen" not in item
+    assert item["extension"][0]["url"] == ENABLE_WHEN_EXPRESSION_URL
+    assert item["extension"][0]["valueExpression"]["expression"] == (
+        "((%resource.repeat(item).where(linkId='a').answer.value.select(code | $this.toString()).exists($this = '1')"
+        " or %resource.repeat(item).where(linkId='b').answer.value.select(code | $this.toString()).exists($this = '2'))"
+        " and %resource.repeat(item).where(linkId='c').answer.value.select(code | $this.toString()).exists($this.toDecimal() > 3))")
+
+
+def test_concept_fingerprint_includes_codes():
+    yes_no = [{"code": "0", "display": "No"}, {"code": "1", "display": "Yes"}]
+    assert concept_fingerprint(yes_no) == concept_fingerprint([dict(concept) for concept in yes_no])
+    assert concept_fingerprint(yes_no) != concept_fingerprint(
+        [{"code": "1", "display": "No"}, {"code": "2", "display": "Yes"}])
+
+
+def test_registry_shares_code_systems_across_activities_and_runs(tmp_path, fhir_env):
+    yes_no = {"valueType": "xsd:integer", "choices": [{"name": {"en": "No"}, "value": 0},
+                                                      {"name": {"en": "Yes"}, "value": 1}]}
+    shifted = {"valueType": "xsd:integer", "choices": [{"name": {"en": "No"}, "value": 1},
+                                                       {"name": {"en": "Yes"}, "value": 2}]}
+    activities = tmp_path / "activities"
+    write_activity(activities, "first", items={
+        "smoker": {"ui": {"inputType": "radio"}, "question": {"en": "Smoker?"}, "responseOptions": yes_no}})
+    write_activity(activities, "second", items={
+        "drinker": {"ui": {"inputType": "radio"}, "question": {"en": "Drinker?"}, "responseOptions": yes_no},
+        "smoker": {"ui": {"inputType": "radio"}, "question": {"en": "Smoker?"}, "responseOptions": shifted}})
+    output = tmp_path / "output"
+
+    for run in range(2):
+        results = run_batch(activities, output, workers=2, registry_path=output / "terminology.sqlite")
+        assert all(result.ok for result in results)
+
+    first = json.loads((output / "first" / "first.json").read_text())
+    second = json.loads((output / "second" / "second.json").read_text())
+    assert first["item"][0]["answerValueSet"] == "https://voicecollab.ai/fhir/ValueSet/smoker"
+    assert second["item"][0]["answerValueSet"] == "https://voicecollab.ai/fhir/ValueSet/smoker"
+    # same displays with different codes is a different code system
+    assert second["item"][1]["answerValueSet"] == "https://voicecollab.ai/fhir/ValueSet/smoker-2"
+    assert sorted(path.name for path in (output / "codesystems").iterdir()) == ["smoker-2.json", "smoker.json"]
+    assert sorted(path.name for path in (output / "valuesets").iterdir()) == ["smoker-2.json", "smoker.json"]
+    assert not (output / "first" / "codesystems").exists()
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_registry_claims_of_failed_activities_are_rolled_back(tmp_path, fhir_env, workers):
+    activities = tmp_path / "activities"
+    first = write_activity(activities, "first")
+    write_activity(activities, "second", items={
+        "height": {"ui": {"inputType": "number"}, "question": {"en": "Height"},
+                   "responseOptions": {"valueType": "xsd:integer"}}})
+    schema = json.loads((first / "first_schema").read_text())
+    schema["ui"]["addProperties"][0]["isVis"] = "age == 1"
+    schema["ui"]["addProperties"][1]["isVis"] = "consent == 1"
+    (first / "first_schema").write_text(json.dumps(schema))
+    output = tmp_path / "output"
+
+    results = run_batch(activities, output, workers=workers, registry_path=output / "terminology.sqlite",
+                        incremental=True, validate="off")
+    assert [result.ok for result in results] == [False, True]
+    assert not list(output.glob("codesystems/*.json"))
+
+    schema["ui"]["addProperties"][0]["isVis"] = True
+    (first / "first_schema").write_text(json.dumps(schema))
+    results = run_batch(activities, output, workers=workers, registry_path=output / "terminology.sqlite",
+                        incremental=True, validate="off")
+    assert [(result.ok, result.skipped) for result in results] == [(True, False), (True, True)]
+    questionnaire = json.loads((output / "first" / "first.json").read_text())
+    assert questionnaire["item"][0]["answerValueSet"] == "https://voicecollab.ai/fhir/ValueSet/consent"
+    assert (output / "valuesets" / "consent.json").exists()
+    assert (output / "codesystems" / "consent.json").exists()
+
+
+def test_incremental_batch_skips_unchanged_activities_and_output_is_deterministic(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    second = write_activity(activities, "second")
+    output = tmp_path / "output"
+
+    results = run_batch(activities, output, workers=1, incremental=True, deterministic=True)
+    assert [result.skipped for result in results] == [False, False]
+    before = (output / "second" / "second.json").read_bytes()
+    assert datetime.fromisoformat(json.loads(before)["date"].replace("Z", "+00:00")) == last_change(second)
+
+    results = run_batch(activities, output, workers=1, incremental=True, deterministic=True)
+    assert [result.skipped for result in results] == [True, True]
+
+    # without the manifest everything is converted again, to the same bytes
+    run_batch(activities, output, workers=1, deterministic=True)
+    assert (output / "second" / "second.json").read_bytes() == before
+
+    (second / "items" / "age").write_text(json.dumps({"id": "age", "ui": {"inputType": "number"},
+                                                      "question": {"en": "Age in years"}}))
+    results = run_batch(activities, output, workers=1, incremental=True, deterministic=True)
+    assert [result.skipped for result in results] == [True, False]
+    assert json.loads((output / "second" / "second.json").read_text())["item"][1]["text"] == "Age in years"
+    manifest = Manifest(output / "manifest.json")
+    assert manifest.get("second") == results[1].digest
+
+
+def test_incremental_batch_hashes_the_items_of_other_activities(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    activity = write_activity(activities, "activity")
+    shared = write_activity(activities, "shared", items={
+        "sleep": {"ui": {"inputType": "radio"}, "question": {"en": "Trouble sleeping?"},
+                  "responseOptions": "../valueConstraints/frequency"}},
+        extra_files={"valueConstraints/frequency": {"valueType": "xsd:integer", "choices": [
+            {"name": {"en": "Never"}, "value": 0}, {"name": {"en": "Often"}, "value": 1}]}})
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["order"].append("../shared/items/sleep")
+    (activity / "activity_schema").write_text(json.dumps(schema))
+    output = tmp_path / "output"
+
+    run_batch(activities, output, workers=1, incremental=True, validate="off")
+    (shared / "valueConstraints" / "frequency").write_text(json.dumps({"valueType": "xsd:integer", "choices": [
+        {"name": {"en": "Never"}, "value": 0}, {"name": {"en": "Always"}, "value": 1}]}))
+    results = run_batch(activities, output, workers=1, incremental=True, validate="off")
+    assert [(result.name, result.skipped) for result in results] == [("activity", False), ("shared", False)]
+
+
+def test_single_activity_skips_what_a_parallel_batch_converted(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    output = tmp_path / "output"
+    results = run_batch(activities, output, workers=1, incremental=True, validate="parallel")
+    assert all(result.ok for result in results)
+    # parallel validation is full validation in a batch worker, both hash the activity the same
+    process = subprocess.run([sys.executable, "main.py", str(activities / "first"), "--output", str(output),
+                              "--incremental", "--validate", "parallel"],
+                             capture_output=True, text=True, check=True, cwd=Path(__file__).parent)
+    assert "first is unchanged, skipping" in process.stdout
+
+
+def test_validate_resources_strategies():
+    resources = [{"resourceType": "ValueSet", "id": f"vs-{number}", "status": "active"} for number in range(6)]
+    assert validate_resources(resources, "off") == [None] * 6
+
+    full = validate_resources(resources, "full")
+    assert [json.loads(resource)["id"] for resource in full] == [f"vs-{number}" for number in range(6)]
+    assert validate_resources(resources, "parallel", workers=2) == full
+
+    sampled = validate_resources(resources, "sample", sample_rate=0.5, seed=1)
+    assert len([resource for resource in sampled if resource is not None]) == 3
+    # validated or not, every resource is written as the same compact json
+    assert [serialize(resource, validated) for resource, validated in zip(resources, sampled)] == [
+        jsonio.dumps(resource) for resource in resources]
+
+    with pytest.raises(Exception):
+        validate_resources([{"resourceType": "ValueSet", "id": "vs", "status": "active", "date": "yesterday"}], "full")
+    with pytest.raises(ValueError):
+        validate_resources(resources, "sometimes")
+
+
+def test_percentile_and_stage_summary():
+    assert percentile([4.0, 1.0, 3.0, 2.0], 0.5) == 2.5
+    assert percentile([1.0], 0.95) == 1.0
+    summary = summarize_stages([{"load": {"seconds": 1.0}, "write": {"seconds": 2.0}},
+                                {"load": {"seconds": 3.0}}])
+    assert list(summary) == ["load", "write"]
+    assert summary["load"] == {"count": 2, "total_seconds": 4.0, "p50_seconds": 2.0, "p95_seconds": 2.9}
+
+
+def test_profiled_batch_writes_a_report(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    write_activity(activities, "second")
+    results = run_batch(activities, tmp_path / "output", workers=2, profile=True, trace_memory=True)
+    assert all(set(result.stages) == set(STAGES) for result in results)
+    assert all(result.stages["index"]["peak_bytes"] > 0 for result in results)
+
+    report = write_report(tmp_path / "report.json", results, 1.0)
+    assert json.loads((tmp_path / "report.json").read_text()) == report
+    assert report["stages"]["convert"]["count"] == 2
+
+
+# generous enough for a slow CI machine, importing fhir.resources alone takes longer
+IMPORT_BUDGET_SECONDS = 0.5
+
+
+def import_times(*args) -> dict:
+    """
+    Run python -X importtime and return the cumulative import time in seconds of every module
+    """
+    process = subprocess.run([sys.executable, "-X", "importtime", *args],
+                             capture_output=True, text=True, check=True,
+                             cwd=Path(__file__).parent)
+    times = dict()
+    for line in process.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            (_, cumulative, module) = line.split("|")
+            if cumulative.strip().isdigit():
+                times[module.strip()] = int(cumulative) / 1e6
+    return times
+
+
+def test_benchmarks_save_and_compare_a_baseline(tmp_path):
+    benchmark = [sys.executable, str(Path(__file__).parent / "benchmarks" / "run.py"),
+                 "--sizes", "10", "--repeat", "1"]
+    subprocess.run(benchmark + ["--save", str(tmp_path / "baseline.json")],
+                   capture_output=True, check=True)
+    baseline = json.loads((tmp_path / "baseline.json").read_text())
+    assert set(baseline["results"]) == {"convert_to_fhir", "add_enable_when", "generate_code_system",
+                                        "convert_activity", "end_to_end"}
+    assert all(list(timings) == ["10"] for timings in baseline["results"].values())
+    # timings of a run this small are noise, only the comparison itself is checked
+    process = subprocess.run(benchmark + ["--compare", str(tmp_path / "baseline.json"), "--tolerance", "1000"],
+                             capture_output=True, text=True, check=True)
+    assert "no regressions" in process.stdout
+
+
+def test_startup_does_not_import_fhir_resources():
+    times = import_times("-c", "import reproschema_to_fhir.batch, reproschema_to_fhir.convert")
+    assert not [module for module in times if module.startswith(("fhir.resources", "pydantic", "reproschema."))]
+    assert times["reproschema_to_fhir.batch"] < IMPORT_BUDGET_SECONDS
+
+
+def test_conversion_without_validation_does_not_import_fhir_resources(tmp_path, fhir_env):
+    activity = write_activity(tmp_path, "activity")
+    times = import_times("main.py", str(activity), "--output", str(tmp_path / "output"), "--validate", "off")
+    assert (tmp_path / "output" / "activity" / "activity.json").exists()
+    assert not [module for module in times if module.startswith(("fhir.resources", "pydantic"))]
+    # the modules of the upload, serve, responses and --watch commands are only imported by them
+    assert not {"asyncio", "http.server", "urllib.request"} & set(times)
+
+
+def test_batch_writes_ndjson_bulk_files(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    for name in ("first", "second", "third"):
+        write_activity(activities, name)
+    output = tmp_path / "output"
+
+    contents = []
+    for run in range(2):
+        results = run_batch(activities, output, workers=2, registry_path=output / "terminology.sqlite",
+                            deterministic=True, output_format="ndjson", compress=True)
+        assert all(result.ok and result.resources is None for result in results)
+        contents.append({path.name: gzip.decompress(path.read_bytes())
+                         for path in output.glob("*.ndjson.gz")})
+
+    assert contents[0] == contents[1]
+    assert sorted(contents[0]) == ["CodeSystem.ndjson.gz", "Questionnaire.ndjson.gz", "ValueSet.ndjson.gz"]
+    questionnaires = [json.loads(line) for line in contents[0]["Questionnaire.ndjson.gz"].splitlines()]
+    assert [questionnaire["id"] for questionnaire in questionnaires] == ["firstschema", "secondschema", "thirdschema"]
+    # the consent options are the same in every activity, so the shared terminology has them once
+    assert len(contents[0]["ValueSet.ndjson.gz"].splitlines()) == 1
+    assert len(contents[0]["CodeSystem.ndjson.gz"].splitlines()) == 1
+    assert not (output / "first").exists()
+
+    with pytest.raises(ValueError):
+        run_batch(activities, output, incremental=True, output_format="ndjson")
+
+
+def test_ndjson_writer_skips_duplicates_and_rejects_conflicting_ids(tmp_path):
+    with NdjsonWriter(tmp_path) as writer:
+        assert writer.write("CodeSystem", "consent", b'{"id":"consent","count":2}')
+        assert not writer.write("CodeSystem", "consent", b'{"id":"consent","count":2}')
+        with pytest.raises(ValueError):
+            writer.write("CodeSystem", "consent", b'{"id":"consent","count":3}')
+    assert (tmp_path / "CodeSystem.ndjson").read_text() == '{"id":"consent","count":2}\n'
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_batch_ndjson_shares_code_systems_without_a_registry(tmp_path, fhir_env, workers):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    write_activity(activities, "second", {
+        "consent": {"ui": {"inputType": "radio"}, "question": {"en": "Do you consent?"},
+                    "responseOptions": {"valueType": "xsd:integer", "choices": [
+                        {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Maybe"}, "value": 1},
+                        {"name": {"en": "Yes"}, "value": 2}]}}})
+    write_activity(activities, "third")
+    results = run_batch(activities, tmp_path / "output", workers=workers, deterministic=True,
+                        output_format="ndjson")
+    assert all(result.ok for result in results)
+    codesystems = [json.loads(line) for line in (tmp_path / "output" / "CodeSystem.ndjson").read_text().splitlines()]
+    # both consent code systems are written, under their own ids
+    assert [codesystem["id"] for codesystem in codesystems] == ["consent", "consent-2"]
+
+
+@pytest.mark.parametrize("output_format", ["files", "stream", "ndjson"])
+def test_batch_with_several_workers_converts_each_activity_once(tmp_path, fhir_env, monkeypatch, output_format):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    write_activity(activities, "second", items={
+        "drinker": {"ui": {"inputType": "radio"}, "question": {"en": "Drinker?"},
+                    "responseOptions": {"valueType": "xsd:integer", "choices": [
+                        {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}}})
+    write_activity(activities, "third")
+    # the workers are forked, so they count their conversions in a file
+    conversions = tmp_path / "conversions"
+    iter_reproschema_items = QuestionnaireGenerator.iter_reproschema_items
+
+    def counted(self, reproschema_items, reproschema_content):
+        with open(conversions, "a") as f:
+            f.write(f"{reproschema_content.schema['id']}\n")
+        return iter_reproschema_items(self, reproschema_items, reproschema_content)
+
+    monkeypatch.setattr(QuestionnaireGenerator, "iter_reproschema_items", counted)
+    output = tmp_path / "output"
+    results = run_batch(activities, output, workers=2, validate="off",
+                        registry_path=None if output_format == "ndjson" else output / "terminology.sqlite",
+                        output_format="ndjson" if output_format == "ndjson" else "files",
+                        stream=output_format == "stream")
+    assert all(result.ok for result in results)
+    assert sorted(conversions.read_text().split()) == ["first_schema", "second_schema", "third_schema"]
+    # the consent code system of the first activity is shared by the drinker item of the second
+    if output_format == "ndjson":
+        questionnaires = [json.loads(line) for line in (output / "Questionnaire.ndjson").read_text().splitlines()]
+        codesystems = [json.loads(line)["id"] for line in (output / "CodeSystem.ndjson").read_text().splitlines()]
+    else:
+        questionnaires = [json.loads((output / name / f"{name}.json").read_text())
+                          for name in ("first", "second", "third")]
+        codesystems = [path.stem for path in (output / "codesystems").iterdir()]
+    assert questionnaires[1]["item"][0]["answerValueSet"] == "https://voicecollab.ai/fhir/ValueSet/consent"
+    assert codesystems == ["consent"]
+
+
+def test_write_questionnaire_stream_splices_the_items_into_the_header(tmp_path):
+    with open(tmp_path / "questionnaire.json", "wb") as f:
+        count = write_questionnaire_stream(f, b'{"resourceType":"Questionnaire"}',
+                                           (jsonio.dumps({"linkId": str(number)}) for number in range(3)))
+    assert count == 3
+    assert json.loads((tmp_path / "questionnaire.json").read_text()) == {
+        "resourceType": "Questionnaire", "item": [{"linkId": "0"}, {"linkId": "1"}, {"linkId": "2"}]}
+
+    with open(tmp_path / "empty.json", "wb") as f:
+        write_questionnaire_stream(f, b'{"resourceType":"Questionnaire"}', iter([]))
+    assert json.loads((tmp_path / "empty.json").read_text()) == {"resourceType": "Questionnaire"}
+
+
+def test_replace_strings_only_replaces_whole_strings_across_chunks(tmp_path):
+    data = json.dumps({"a": "https://x/ValueSet/smoker", "b": ["https://x/ValueSet/smoker-2", "smoker"],
+                       "c": 'say "https://x/ValueSet/smoker"'}).encode("utf-8")
+    replacements = {b"https://x/ValueSet/smoker": b"https://x/ValueSet/consent"}
+    expected = json.dumps({"a": "https://x/ValueSet/consent", "b": ["https://x/ValueSet/smoker-2", "smoker"],
+                           "c": 'say "https://x/ValueSet/smoker"'}).encode("utf-8")
+    assert replace_strings(data, replacements) == expected
+    for chunk_size in (1, 7, len(data)):
+        (tmp_path / "questionnaire.json").write_bytes(data)
+        replace_strings_in_file(tmp_path / "questionnaire.json", replacements, chunk_size)
+        assert (tmp_path / "questionnaire.json").read_bytes() == expected
+
+
+@pytest.mark.parametrize("validate", ["off", "full"])
+def test_streamed_questionnaire_is_identical_to_the_built_one(tmp_path, fhir_env, validate):
+    activity = write_activity(tmp_path, "activity", items={
+        "consent": {"ui": {"inputType": "radio"}, "question": {"en": "Do you consent?"},
+                    "responseOptions": {"valueType": "xsd:integer", "choices": [
+                        {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}},
+        "age": {"ui": {"inputType": "number"}, "question": {"en": "Age"},
+                "responseOptions": {"valueType": "xsd:integer"}},
+    })
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["addProperties"][1]["isVis"] = "consent == 1"
+    (activity / "activity_schema").write_text(json.dumps(schema))
+
+    outputs = []
+    for stream in (False, True):
+        output = tmp_path / f"stream-{stream}"
+        convert_activity(activity, output, deterministic=True, validate=validate, stream=stream)
+        outputs.append(sorted((path.relative_to(output), path.read_bytes())
+                              for path in output.glob("**/*.json")))
+    assert outputs[0] == outputs[1]
+    assert not list((tmp_path / "stream-True").glob("**/*.partial"))
+
+
+def test_streamed_questionnaire_reads_each_item_as_it_is_converted(tmp_path, fhir_env, monkeypatch):
+    activity = write_activity(tmp_path, "activity")
+    log = []
+    source_read = FolderSource.read
+    monkeypatch.setattr(FolderSource, "read", lambda self, key: log.append(("read", key)) or source_read(self, key))
+    convert_item = QuestionnaireGenerator.convert_item
+    monkeypatch.setattr(QuestionnaireGenerator, "convert_item",
+                        lambda self, var_name, *args: log.append(("convert", var_name)) or
+                        convert_item(self, var_name, *args))
+    convert_activity(activity, tmp_path / "output", validate="off", stream=True)
+    assert log == [("read", "activity_schema"), ("read", "items/consent"), ("convert", "consent"),
+                   ("read", "items/age"), ("convert", "age")]
+
+
+def test_json_backends_write_the_same_bytes(monkeypatch):
+    document = {"resourceType": "ValueSet", "id": "yes-no", "compose": {"include": [{"concept": [
+        {"code": "1", "display": "Oui, très"}, {"code": "2", "display": None}]}]}, "count": 2.5}
+    outputs = set()
+    for backend in {jsonio.BACKEND, "json"}:
+        monkeypatch.setattr(jsonio, "BACKEND", backend)
+        outputs.add((jsonio.dumps(document), jsonio.dumps(document, sort_keys=True),
+                     jsonio.dumps(document, sort_keys=True, pretty=True)))
+        assert jsonio.loads(jsonio.dumps(document)) == document
+    assert len(outputs) == 1
+    (compact, sorted_keys, pretty) = outputs.pop()
+    assert compact == json.dumps(document, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    assert pretty == json.dumps(document, ensure_ascii=False, sort_keys=True, indent=2).encode("utf-8")
+
+
+class FhirStandIn(BaseHTTPRequestHandler):
+    """
+    Accepts bundles like a FHIR server, after failing the first request with a 503
+    """
+    bundles = []
+    requests = 0
+
+    def do_POST(self):
+        FhirStandIn.requests += 1
+        bundle = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        if FhirStandIn.requests == 1:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        FhirStandIn.bundles.append(bundle)
+        body = json.dumps({"resourceType": "Bundle", "type": f"{bundle['type']}-response",
+                           "entry": [{"response": {"status": "201 Created"}} for _ in bundle["entry"]]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/fhir+json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_upload_sends_the_output_in_bundles_and_retries(tmp_path, fhir_env):
+    pytest.importorskip("aiohttp")
+    activities = tmp_path / "activities"
+    for name in ("first", "second"):
+        write_activity(activities, name)
+    output = tmp_path / "output"
+    run_batch(activities, output, workers=1)
+    resources = read_output(output)
+    assert sorted(resource["resourceType"] for resource in resources) == [
+        "CodeSystem", "CodeSystem", "Questionnaire", "Questionnaire", "ValueSet", "ValueSet"]
+
+    bundles = make_bundles(resources, bundle_size=4, bundle_type="transaction")
+    # a bundle holds one resource type, so the types can be sent one after the other
+    assert [[entry["request"]["url"].split("/")[0] for entry in bundle["entry"]] for bundle in bundles] == [
+        ["CodeSystem", "CodeSystem"], ["ValueSet", "ValueSet"], ["Questionnaire", "Questionnaire"]]
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FhirStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        results = upload(output, f"http://127.0.0.1:{server.server_address[1]}/fhir",
+                         bundle_size=1, concurrency=2, backoff=0.01)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert all(result.ok for result in results)
+    assert sorted(result.attempts for result in results) == [1, 1, 1, 1, 1, 2]
+    # with two bundles in flight, none of a type is sent before every one of the type before it
+    assert [bundle["entry"][0]["request"]["url"].split("/")[0] for bundle in FhirStandIn.bundles] == [
+        "CodeSystem", "CodeSystem", "ValueSet", "ValueSet", "Questionnaire", "Questionnaire"]
+    assert all(entry["request"]["method"] == "PUT" for bundle in FhirStandIn.bundles for entry in bundle["entry"])
+
+
+def test_watcher_converts_only_changed_activities(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    second = write_activity(activities, "second")
+    output = tmp_path / "output"
+    watcher = ActivityWatcher(activities, output, BatchOptions(registry_path=str(output / "terminology.sqlite"),
+                                                               validate="off"))
+
+    watcher.prime()
+    run_batch(activities, output, workers=1, registry_path=output / "terminology.sqlite",
+              incremental=True, validate="off")
+    assert watcher.poll() == []
+
+    consent = json.loads((second / "items" / "consent").read_text())
+    consent["responseOptions"]["choices"].append({"name": {"en": "Maybe"}, "value": 2})
+    (second / "items" / "consent").write_text(json.dumps(consent))
+    results = watcher.poll()
+    assert [(result.name, result.ok, result.skipped) for result in results] == [("second", True, False)]
+    # the edited options are a new shared code system, the first activity keeps the old one
+    assert len(list((output / "codesystems").iterdir())) == 2
+    assert Manifest(output / "manifest.json").get("second") == results[0].digest
+
+    # touched but not changed
+    mtime = (second / "items" / "consent").stat().st_mtime_ns
+    os.utime(second / "items" / "consent", ns=(mtime, mtime + 10**9))
+    assert [result.skipped for result in watcher.poll()] == [True]
+
+    # the code system of the options edited before is used by no questionnaire any more
+    consent["responseOptions"]["choices"].append({"name": {"en": "Often"}, "value": 3})
+    (second / "items" / "consent").write_text(json.dumps(consent))
+    assert [(result.name, result.ok) for result in watcher.poll()] == [("second", True)]
+    assert sorted(path.name for path in (output / "codesystems").iterdir()) == ["consent-3.json", "consent.json"]
+    assert sorted(path.name for path in (output / "valuesets").iterdir()) == ["consent-3.json", "consent.json"]
+
+    # an activity is converted again when an item of another activity it references changes
+    third = write_activity(activities, "third", items={
+        "sleep": {"ui": {"inputType": "number"}, "question": {"en": "Hours of sleep"},
+                  "responseOptions": {"valueType": "xsd:integer"}}})
+    schema = json.loads((third / "third_schema").read_text())
+    schema["ui"]["order"].append("../first/items/age")
+    (third / "third_schema").write_text(json.dumps(schema))
+    assert [result.name for result in watcher.poll()] == ["third"]
+    age = json.loads((activities / "first" / "items" / "age").read_text())
+    age["question"]["en"] = "Age in years"
+    (activities / "first" / "items" / "age").write_text(json.dumps(age))
+    assert sorted((result.name, result.skipped) for result in watcher.poll()) == [("first", False), ("third", False)]
+    questionnaire = json.loads((output / "third" / "third.json").read_text())
+    assert questionnaire["item"][1]["text"] == "Age in years"
+
+
+def test_service_converts_json_maps_and_zips(tmp_path, fhir_env):
+    activity = write_activity(tmp_path, "activity")
+    documents = {path.relative_to(activity).as_posix(): json.loads(path.read_text())
+                 for path in activity.glob("**/*") if path.is_file()}
+    archive = tmp_path / "activity.zip"
+    with zipfile.ZipFile(archive, "w") as f:
+        for path in activity.glob("**/*"):
+            f.write(path, path.relative_to(tmp_path).as_posix())
+
+    server = ConversionServer(("127.0.0.1", 0), workers=1, quiet=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+
+    caches = []
+
+    def post(body, content_type, query=""):
+        request = urllib.request.Request(f"{url}/convert{query}", data=body, headers={"Content-Type": content_type})
+        with urllib.request.urlopen(request) as response:
+            caches.append(response.headers["X-Cache"])
+            return json.loads(response.read())
+
+    try:
+        bundles = [post(json.dumps(documents).encode(), "application/json"),
+                   post(archive.read_bytes(), "application/zip", "?validate=off"),
+                   post(json.dumps(documents).encode(), "application/json")]
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post(b'{"items/consent": {}}', "application/json")
+        assert error.value.code == 400
+        with urllib.request.urlopen(f"{url}/metrics") as response:
+            metrics = json.loads(response.read())
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    for bundle in bundles:
+        assert bundle["type"] == "collection"
+        assert [entry["resource"]["resourceType"] for entry in bundle["entry"]] == [
+            "Questionnaire", "ValueSet", "CodeSystem"]
+    assert bundles[0]["entry"][0]["resource"]["item"] == bundles[1]["entry"][0]["resource"]["item"]
+    # the repeated request is answered from the cache of the worker
+    assert caches == ["MISS", "MISS", "HIT"]
+    assert bundles[2] == bundles[0]
+    assert (metrics["requests"], metrics["errors"], metrics["cache_hits"], metrics["latency_seconds"]["count"]) == (
+        4, 1, 1, 4)
+
+
+def response_activity(number, consent, age):
+    return {"id": f"https://example.org/responses/{number}", "wasAttributedTo": {"@id": f"participant-{number}"},
+            "startedAtTime": "2024-01-01T10:00:00Z", "endedAtTime": "2024-01-01T10:05:00Z",
+            "generated": [{"isAbout": "items/consent", "value": consent}, {"isAbout": "items/age", "value": age}]}
+
+
+def test_response_converter_codes_the_answers(tmp_path, fhir_env):
+    activity = write_activity(tmp_path, "activity")
+    converter = ResponseConverter.from_activity(activity)
+    assert converter.table["age"] == ("integer", {})
+
+    response = converter.convert(response_activity(1, 1, "42"))
+    assert response == {
+        "resourceType": "QuestionnaireResponse", "id": "1",
+        "questionnaire": "https://voicecollab.ai/fhir/Questionnaire/Questionnaire-activityschema",
+        "status": "completed", "subject": {"identifier": {"value": "participant-1"}},
+        "authored": "2024-01-01T10:05:00Z",
+        "item": [{"linkId": "consent", "answer": [{"valueCoding": {
+                     "system": "https://voicecollab.ai/fhir/CodeSystem/consent", "code": "1", "display": "Yes"}}]},
+                 {"linkId": "age", "answer": [{"valueInteger": 42}]}]}
+
+    with pytest.raises(ValueError):
+        converter.convert(response_activity(2, 7, 42))
+
+
+def test_answer_option_mode_answers_with_the_option_strings(tmp_path, fhir_env, monkeypatch):
+    monkeypatch.setenv("FHIR_QUESTIONNAIRE_MODE", "AnswerOptions")
+    converter = ResponseConverter.from_activity(write_activity(tmp_path, "activity"))
+    assert converter.answer("consent", 0) == [{"valueString": "No"}]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_convert_responses_in_chunks_keeps_the_order(tmp_path, fhir_env, workers):
+    activity = write_activity(tmp_path, "activity")
+    lines = [json.dumps(response_activity(number, number % 2, number)) for number in range(25)]
+    lines[7] = json.dumps(response_activity(7, 5, 7))
+    lines.insert(3, "")
+    with gzip.open(tmp_path / "responses.ndjson.gz", "wt") as f:
+        f.write("\n".join(lines) + "\n")
+
+    (converted, failed, errors) = convert_responses(activity, tmp_path / "responses.ndjson.gz",
+                                                    tmp_path / "out" / "QuestionnaireResponse.ndjson",
+                                                    workers=workers, chunk_size=4)
+    assert (converted, failed) == (24, 1)
+    assert errors == [{"line": 9, "error": "ValueError: 5 is not an answer of consent"}]
+    responses = [json.loads(line) for line in
+                 (tmp_path / "out" / "QuestionnaireResponse.ndjson").read_text().splitlines()]
+    assert [response["id"] for response in responses] == [str(number) for number in range(25) if number != 7]
+
+
+def test_responses_code_the_shared_code_systems_of_the_conversion(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "first")
+    second = write_activity(activities, "second", {
+        "drinker": {"ui": {"inputType": "radio"}, "question": {"en": "Do you drink?"},
+                    "responseOptions": {"valueType": "xsd:integer", "choices": [
+                        {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}}})
+    output = tmp_path / "output"
+    assert all(result.ok for result in run_batch(activities, output, workers=2,
+                                                 registry_path=output / "terminology.sqlite"))
+
+    converter = ResponseConverter.from_activity(second, registry_path=output / "terminology.sqlite")
+    # the yes/no options of drinker are the code system written for consent of the first activity
+    assert converter.answer("drinker", 1) == [{"valueCoding": {
+        "system": "https://voicecollab.ai/fhir/CodeSystem/consent", "code": "1", "display": "Yes"}}]
+    assert ResponseConverter.from_activity(second).answer("drinker", 1)[0]["valueCoding"]["system"] == \
+        "https://voicecollab.ai/fhir/CodeSystem/drinker"
+    # a registry which does not exist is not created empty
+    with pytest.raises(FileNotFoundError):
+        ResponseConverter.from_activity(second, registry_path=tmp_path / "missing.sqlite")
+    assert not (tmp_path / "missing.sqlite").exists()
+    TerminologyRegistry(tmp_path / "empty.sqlite").close()
+    with pytest.raises(ValueError):
+        ResponseConverter.from_activity(second, registry_path=tmp_path / "empty.sqlite")
+
+
+def conditional_resources(tmp_path):
+    items = {
+        "consent": {"ui": {"inputType": "radio"}, "question": {"en": "Do you consent?"},
+                    "responseOptions": {"valueType": "xsd:integer", "choices": [
+                        {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}},
+        "age": {"ui": {"inputType": "number"}, "question": {"en": "Age"},
+                "responseOptions": {"valueType": "xsd:integer"}},
+        "visit": {"ui": {"inputType": "date"}, "question": {"en": "Visit"},
+                  "responseOptions": {"valueType": "xsd:date"}},
+    }
+    activity = write_activity(tmp_path, "activity", items)
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["addProperties"][1]["isVis"] = "consent == 1"
+    schema["ui"]["addProperties"][2]["isVis"] = "(consent == 1 || age > 17) && age < 100"
+    (activity / "activity_schema").write_text(json.dumps(schema))
+    convert_activity(activity, tmp_path / "output")
+    return read_output(tmp_path / "output")
+
+
+def test_parse_enable_when_expression_round_trips_the_compiled_condition():
+    for condition in ("(a == 1 || b > 2) && c != 3", "a == 'x' || (b >= 2.5 && c < d)"):
+        assert parse_enable_when_expression(compile_condition(condition).expression) == parse_condition(condition)
+    with pytest.raises(ValueError):
+        parse_enable_when_expression("%resource.item.count() > 1")
+
+
+def test_response_validator_checks_types_codes_and_visibility(tmp_path, fhir_env):
+    resources = conditional_resources(tmp_path)
+    questionnaire = next(resource for resource in resources if resource["resourceType"] == "Questionnaire")
+    validator = ResponseValidator(questionnaire,
+                                  [resource for resource in resources if resource["resourceType"] == "ValueSet"],
+                                  [resource for resource in resources if resource["resourceType"] == "CodeSystem"])
+    system = "https://voicecollab.ai/fhir/CodeSystem/consent"
+
+    def response(*items):
+        return {"resourceType": "QuestionnaireResponse", "questionnaire": questionnaire["url"],
+                "item": [{"linkId": link_id, "answer": [answer]} for (link_id, answer) in items]}
+
+    assert validator.validate(response(("consent", {"valueCoding": {"system": system, "code": "1"}}),
+                                       ("age", {"valueInteger": 42}),
+                                       ("visit", {"valueDate": "2024-01-01"}))) == []
+    # consent == 0 hides age, and visit is only shown to adults under 100
+    assert validator.validate(response(("consent", {"valueCoding": {"system": system, "code": "0"}}),
+                                       ("visit", {"valueDate": "2024-01-01"}))) == [
+        {"linkId": "visit", "error": "answered but not enabled"}]
+    assert validator.validate_batch([
+        response(("consent", {"valueCoding": {"system": system, "code": "2"}})),
+        response(("consent", {"valueCoding": {"system": system, "code": "1"}}), ("age", {"valueString": "42"}),
+                 ("visit", {"valueDate": "01/01/2024"}), ("height", {"valueInteger": 1})),
+    ]) == [
+        [{"linkId": "consent", "error": "'2' is not an allowed answer"}],
+        [{"linkId": "age", "error": "expected valueInteger for a integer item, got valueString"},
+         {"linkId": "visit", "error": "'01/01/2024' is not a valid valueDate"},
+         {"linkId": "height", "error": "not an item of the questionnaire"}],
+    ]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_validate_responses_reports_errors_per_line(tmp_path, fhir_env, workers):
+    resources = conditional_resources(tmp_path)
+    activity = tmp_path / "activity"
+    lines = [json.dumps(response_activity(number, number % 2, number)) for number in range(10)]
+    (tmp_path / "responses.ndjson").write_text("\n".join(lines) + "\n")
+    convert_responses(activity, tmp_path / "responses.ndjson", tmp_path / "QuestionnaireResponse.ndjson", workers=1)
+
+    (total, invalid, errors) = validate_responses(resources, tmp_path / "QuestionnaireResponse.ndjson",
+                                                  workers=workers, chunk_size=3)
+    # age is only enabled with consent
+    assert (total, invalid) == (10, 5)
+    assert [error["line"] for error in errors] == [1, 3, 5, 7, 9]
+    assert errors[0] == {"line": 1, "id": "0", "errors": [{"linkId": "age", "error": "answered but not enabled"}]}
+
+
+def test_visibility_graph_orders_the_items_and_hides_dependents_of_hidden_items():
+    graph = VisibilityGraph([
+        ("late", compile_condition("middle == 'yes'").node, None),
+        ("first", None, None),
+        ("middle", compile_condition("first > 17 || first == 'x'").node, None),
+    ])
+    assert graph.order == ["first", "middle", "late"]
+    assert graph.dependencies == {"late": ["middle"], "first": [], "middle": ["first"]}
+    assert graph.visible_batch([
+        {"first": 20, "middle": "yes"},
+        # the answer to middle is ignored when it is hidden
+        {"first": 3, "middle": "yes"},
+        {"first": [{"valueString": "x"}], "middle": [{"valueCoding": {"code": "yes"}}]},
+    ]) == [{"first", "middle", "late"}, {"first"}, {"first", "middle", "late"}]
+
+    assert VisibilityGraph.from_json(json.loads(json.dumps(graph.to_json()))).visible(
+        {"first": 20, "middle": "no"}) == {"first", "middle"}
+
+
+def test_visibility_graph_rejects_cycles_and_warns_of_missing_items():
+    with pytest.raises(VisibilityError, match="cycle: a, b"):
+        VisibilityGraph([("a", compile_condition("b == 1").node, None),
+                         ("b", compile_condition("a == 1").node, None),
+                         ("c", None, None)])
+    graph = VisibilityGraph([("a", compile_condition("missing == 1").node, None), ("b", None, None)])
+    assert graph.warnings == ["a depends on missing, which is not in the questionnaire"]
+    # the missing item is never answered
+    assert graph.visible({"b": 1}) == {"b"}
+    assert graph.to_json()["warnings"] == graph.warnings
+    assert VisibilityGraph.from_json(graph.to_json()).warnings == graph.warnings
+
+
+def test_convert_activity_writes_the_visibility_sidecar(tmp_path, fhir_env):
+    items = {"consent": {"ui": {"inputType": "radio"}, "question": {"en": "Do you consent?"},
+                         "responseOptions": {"valueType": "xsd:integer", "choices": [
+                             {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}},
+             "age": {"ui": {"inputType": "number"}, "question": {"en": "Age"},
+                     "responseOptions": {"valueType": "xsd:integer"}}}
+    activity = write_activity(tmp_path, "activity", items)
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["addProperties"][1]["isVis"] = "consent == 1"
+    (activity / "activity_schema").write_text(json.dumps(schema))
+
+    for stream in (False, True):
+        convert_activity(activity, tmp_path / "output", validate="off", stream=stream)
+        sidecar = json.loads((tmp_path / "output" / "activity" / "activity.visibility.json").read_text())
+        assert sidecar == {
+            "questionnaire": "https://voicecollab.ai/fhir/Questionnaire/Questionnaire-activityschema",
+            "order": ["consent", "age"],
+            "items": {"age": {"dependsOn": ["consent"],
+                              "condition": {"question": "consent", "operator": "=", "answer": "1"}}}}
+
+    # a condition on an item of another activity is a warning, a cycle an error
+    schema["ui"]["addProperties"][1]["isVis"] = "height == 1"
+    (activity / "activity_schema").write_text(json.dumps(schema))
+    convert_activity(activity, tmp_path / "output", validate="off")
+    sidecar = json.loads((tmp_path / "output" / "activity" / "activity.visibility.json").read_text())
+    assert sidecar["warnings"] == ["age depends on height, which is not in the questionnaire"]
+    schema["ui"]["addProperties"][0]["isVis"] = "age > 1"
+    schema["ui"]["addProperties"][1]["isVis"] = "consent == 1"
+    (activity / "activity_schema").write_text(json.dumps(schema))
+    with pytest.raises(VisibilityError):
+        convert_activity(activity, tmp_path / "output", validate="off")
+
+
+@pytest.mark.parametrize("mode", ["ValueSet", "AnswerOptions"])
+def test_item_cache_converts_shared_items_once(tmp_path, fhir_env, monkeypatch, mode):
+    monkeypatch.setenv("FHIR_QUESTIONNAIRE_MODE", mode)
+    first = write_activity(tmp_path / "a", "activity")
+    second = write_activity(tmp_path / "b", "activity")
+    uncached = convert_resources(first, deterministic=True, validate="off")
+
+    calls = []
+    add_options_calls = fhir.add_options
+    monkeypatch.setattr(fhir, "add_options", lambda *args: calls.append(args) or add_options_calls(*args))
+    cache = ItemCache()
+    assert convert_resources(first, deterministic=True, validate="off", item_cache=cache) == uncached
+    # the displays of the consent options are only worked out once, not again for its code system
+    assert [len(options_json["choices"]) for (options_json, _) in calls].count(2) == 1
+    converted = len(calls)
+    assert convert_resources(second, deterministic=True, validate="off", item_cache=cache) == uncached
+    assert len(calls) == converted
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_item_cache_on_disk_is_reused_by_later_runs(tmp_path, fhir_env):
+    activity = write_activity(tmp_path, "activity")
+    cache = ItemCache(tmp_path / "items.sqlite")
+    convert_resources(activity, validate="off", item_cache=cache)
+    cache.close()
+
+    cache = ItemCache(tmp_path / "items.sqlite")
+    convert_resources(activity, validate="off", item_cache=cache)
+    assert (cache.hits, cache.misses) == (2, 0)
+
+
+def archive_library(tmp_path):
+    library = tmp_path / "library"
+    write_activity(library / "activities", "a_activity")
+    write_activity(library / "activities", "b_activity", extra_files={"README.md": "not json"})
+    with zipfile.ZipFile(tmp_path / "library.zip", "w", zipfile.ZIP_DEFLATED) as f:
+        for file in sorted(library.glob("**/*")):
+            f.write(file, file.relative_to(tmp_path).as_posix())
+    with tarfile.open(tmp_path / "library.tar.gz", "w:gz") as f:
+        f.add(library, "library")
+    return library
+
+
+@pytest.mark.parametrize("archive_name", ["library.zip", "library.tar.gz"])
+def test_batch_converts_activities_straight_from_an_archive(tmp_path, fhir_env, archive_name):
+    library = archive_library(tmp_path)
+    run_batch(library / "activities", tmp_path / "from_folders", workers=1, validate="off")
+    results = run_batch(tmp_path / archive_name, tmp_path / "from_archive", workers=1, validate="off")
+    assert [(result.name, result.ok) for result in results] == [("a_activity", True), ("b_activity", True)]
+    for name in ("a_activity", "b_activity"):
+        from_archive = json.loads((tmp_path / "from_archive" / name / f"{name}.json").read_text())
+        from_folder = json.loads((tmp_path / "from_folders" / name / f"{name}.json").read_text())
+        assert from_archive["item"] == from_folder["item"]
+
+
+def test_archive_sources_only_read_the_referenced_members(tmp_path, fhir_env, monkeypatch):
+    archive_library(tmp_path)
+    read = []
+    archive_read = Archive.read
+    monkeypatch.setattr(Archive, "read", lambda self, name: read.append(name) or archive_read(self, name))
+
+    location = f"{tmp_path / 'library.zip'}!/library/activities/b_activity"
+    assert open_source(location).name == "b_activity"
+    convert_activity(location, tmp_path / "output", validate="off")
+    assert sorted(read) == ["library/activities/b_activity/b_activity_schema",
+                            "library/activities/b_activity/items/age",
+                            "library/activities/b_activity/items/consent"]
+    assert (tmp_path / "output" / "b_activity" / "b_activity.json").exists()
+
+
+def test_activity_name_of_a_single_activity_archive_is_its_folder(tmp_path, fhir_env):
+    activity = write_activity(tmp_path / "activities", "phq9_v2")
+    with zipfile.ZipFile(tmp_path / "phq9.zip", "w") as f:
+        for file in sorted(activity.glob("**/*")):
+            f.write(file, file.relative_to(tmp_path).as_posix())
+    assert activity_name(tmp_path / "phq9.zip") == open_source(tmp_path / "phq9.zip").name == "phq9_v2"
+    assert activity_name(tmp_path / "library.zip") == "library"
+
+
+class LibraryStandIn(BaseHTTPRequestHandler):
+    """
+    Serves reproschema documents like the reproschema-library on github, with ETags
+    """
+    documents = {}
+    statuses = []
+
+    def do_GET(self):
+        body = json.dumps(LibraryStandIn.documents[self.path]).encode()
+        etag = '"%s"' % hashlib.sha256(body).hexdigest()
+        status = 304 if self.headers.get("If-None-Match") == etag else 200
+        LibraryStandIn.statuses.append((self.path, status))
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", "0" if status == 304 else str(len(body)))
+        self.end_headers()
+        if status == 200:
+            self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def test_remote_and_cross_activity_references_resolve_through_the_cache(tmp_path, fhir_env):
+    options = {"valueType": "xsd:integer", "choices": [
+        {"name": {"en": "Never"}, "value": 0}, {"name": {"en": "Often"}, "value": 1}]}
+    LibraryStandIn.documents = {
+        "/activities/PHQ-9/items/phq9_1": {"id": "phq9_1", "ui": {"inputType": "radio"},
+                                           "question": {"en": "Little interest?"},
+                                           "responseOptions": "../valueConstraints/frequency"},
+        "/activities/PHQ-9/items/phq9_2": {"id": "phq9_2", "ui": {"inputType": "radio"},
+                                           "question": {"en": "Feeling down?"},
+                                           "responseOptions": "../valueConstraints/frequency"},
+        "/activities/PHQ-9/valueConstraints/frequency": options,
+    }
+    LibraryStandIn.statuses = []
+    activities = tmp_path / "activities"
+    write_activity(activities, "shared", items={
+        "sleep": {"ui": {"inputType": "radio"}, "question": {"en": "Trouble sleeping?"},
+                  "responseOptions": "../valueConstraints/frequency"}},
+        extra_files={"valueConstraints/frequency": options})
+    activity = write_activity(activities, "activity")
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LibraryStandIn)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    library = f"http://127.0.0.1:{server.server_address[1]}/activities/PHQ-9"
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["order"] += [f"{library}/items/phq9_1", f"{library}/items/phq9_2", "../shared/items/sleep"]
+    (activity / "activity_schema").write_text(json.dumps(schema))
+
+    try:
+        resolver = Resolver(tmp_path / "documents")
+        (_, questionnaire, _, _, _) = convert_resources(activity, deterministic=True, validate="off", resolver=resolver)
+        assert [item["linkId"] for item in json.loads(questionnaire)["item"]] == [
+            "consent", "age", "phq9_1", "phq9_2", "sleep"]
+        # the options shared by both remote items are fetched once
+        assert sorted(LibraryStandIn.statuses) == [
+            ("/activities/PHQ-9/items/phq9_1", 200), ("/activities/PHQ-9/items/phq9_2", 200),
+            ("/activities/PHQ-9/valueConstraints/frequency", 200)]
+
+        # a later run within the ttl does not ask again, an expired cache only revalidates
+        convert_resources(activity, deterministic=True, validate="off", resolver=Resolver(tmp_path / "documents"))
+        assert len(LibraryStandIn.statuses) == 3
+        resolver = Resolver(tmp_path / "documents", ttl=0)
+        assert convert_resources(activity, deterministic=True, validate="off", resolver=resolver)[1] == questionnaire
+        assert (resolver.fetches, resolver.revalidations) == (0, 3)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    offline = Resolver(tmp_path / "documents", ttl=0, offline=True)
+    assert convert_resources(activity, deterministic=True, validate="off", resolver=offline)[1] == questionnaire
+    with pytest.raises(FileNotFoundError):
+        convert_resources(activity, deterministic=True, validate="off", resolver=Resolver(tmp_path / "empty", offline=True))
+    # responses are coded through the documents the conversion read
+    converter = ResponseConverter.from_activity(activity, resolver=offline)
+    assert converter.answer("phq9_1", 1) == [{"valueCoding": {
+        "system": "https://voicecollab.ai/fhir/CodeSystem/phq9-1", "code": "1", "display": "Often"}}]
+
+
+def test_items_of_other_activities_with_the_same_name_are_rejected(tmp_path, fhir_env):
+    activities = tmp_path / "activities"
+    write_activity(activities, "shared")
+    activity = write_activity(activities, "activity")
+    schema = json.loads((activity / "activity_schema").read_text())
+    schema["ui"]["order"].append("../shared/items/consent")
+    (activity / "activity_schema").write_text(json.dumps(schema))
+    with pytest.raises(ValueError, match="items/consent"):
+        convert_resources(activity, validate="off")
+
+
+def test_service_only_reads_referenced_urls_from_its_document_cache(tmp_path, fhir_env):
+    LibraryStandIn.documents = {"/items/mood": {"id": "mood", "ui": {"inputType": "text"},
+                                                "question": {"en": "Mood?"}}}
+    LibraryStandIn.statuses = []
+    library = ThreadingHTTPServer(("127.0.0.1", 0), LibraryStandIn)
+    threading.Thread(target=library.serve_forever, daemon=True).start()
+    mood = f"http://127.0.0.1:{library.server_address[1]}/items/mood"
+    activity = write_activity(tmp_path, "activity")
+    documents = {path.relative_to(activity).as_posix(): json.loads(path.read_text())
+                 for path in activity.glob("**/*") if path.is_file()}
+    documents["activity_schema"]["ui"]["order"].append(mood)
+
+    server = ConversionServer(("127.0.0.1", 0), workers=1, validate="off", quiet=True,
+                              document_cache_path=tmp_path / "documents")
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def post():
+        request = urllib.request.Request(f"http://127.0.0.1:{server.server_address[1]}/convert",
+                                         data=json.dumps(documents).encode(),
+                                         headers={"Content-Type": "application/json"})
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())
+
+    try:
+        with pytest.raises(urllib.error.HTTPError) as error:
+            post()
+        assert error.value.code == 400
+        assert LibraryStandIn.statuses == []
+        # documents fetched into the cache by a conversion can be referenced
+        Resolver(tmp_path / "documents").load(mood)
+        bundle = post()
+    finally:
+        server.shutdown()
+        server.server_close()
+        library.shutdown()
+        library.server_close()
+    assert [item["linkId"] for item in bundle["entry"][0]["resource"]["item"]] == ["consent", "age", "mood"]
+
+
+def write_protocol(library, order, properties):
+    protocol = library / "protocols" / "study"
+    protocol.mkdir(parents=True)
+    schema = {"@type": "reproschema:Protocol", "id": "study_schema", "schemaVersion": "1.0.0",
+              "ui": {"order": order, "addProperties": properties}}
+    (protocol / "study_schema").write_text(json.dumps(schema))
+    return protocol
+
+
+def protocol_library(tmp_path):
+    library = tmp_path / "library"
+    write_activity(library / "activities", "first")
+    write_activity(library / "activities", "second", items={
+        "mood": {"ui": {"inputType": "radio"}, "question": {"en": "Feeling well?"},
+                 "responseOptions": {"valueType": "xsd:integer", "choices": [
+                     {"name": {"en": "No"}, "value": 0}, {"name": {"en": "Yes"}, "value": 1}]}}})
+    order = ["../../activities/first/first_schema", "../../activities/second/second_schema"]
+    return write_protocol(library, order, [
+        {"variableName": "first", "isAbout": order[0], "isVis": True},
+        {"variableName": "second", "isAbout": order[1], "isVis": "consent == 1"}])
+
+
+def test_protocol_activities_convert_in_one_batch(tmp_path, fhir_env):
+    protocol = Protocol(protocol_library(tmp_path))
+    assert [(activity.link_id, Path(activity.location).name, activity.is_vis) for activity in protocol.activities] == [
+        ("first", "first", True), ("second", "second", "consent == 1")]
+    results = run_batch(protocol.locations, tmp_path / "output", workers=1, validate="off",
+                        registry_path=tmp_path / "output" / "terminology.sqlite")
+    assert [(result.name, result.ok) for result in results] == [("first", True), ("second", True)]
+    # the consent and mood options are the same code system
+    assert len(list((tmp_path / "output" / "codesystems").iterdir())) == 1
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_grouped_protocol_is_one_questionnaire(tmp_path, fhir_env, workers):
+    protocol = protocol_library(tmp_path)
+    output = tmp_path / "output"
+    assert convert_grouped_protocol(protocol, output, workers=workers, deterministic=True) == "study"
+    questionnaire = json.loads((output / "study" / "study.json").read_text())
+    assert [(group["linkId"], group["type"], [item["linkId"] for item in group["item"]])
+            for group in questionnaire["item"]] == [("first", "group", ["consent", "age"]),
+                                                   ("second", "group", ["mood"])]
+    assert "enableWhen" not in questionnaire["item"][0]
+    assert [condition["question"] for condition in questionnaire["item"][1]["enableWhen"]] == ["consent"]
+    assert len(list((output / "codesystems").iterdir())) == 1
+
+    graph = VisibilityGraph.from_json(json.loads((output / "study" / "study.visibility.json").read_text()))
+    assert graph.visible({"consent": [0]}) == {"first", "consent", "age"}
+    assert graph.visible({"consent": [1]}) == {"first", "consent", "age", "second", "mood"}
+
+    generator = QuestionnaireGenerator(Config())
+    assert generator.convert_protocol(Protocol(protocol))["item"] == questionnaire["item"]
+
+
+def test_grouped_protocol_rejects_shared_link_ids(tmp_path, fhir_env):
+    library = tmp_path / "library"
+    write_activity(library / "activities", "first")
+    write_activity(library / "activities", "again")
+    protocol = write_protocol(library, ["../../activities/first/first_schema", "../../activities/again/again_schema"], [])
+    with pytest.raises(ValueError, match="linkId consent is used by both first and again"):
+        convert_grouped_protocol(protocol, tmp_path / "output", workers=1, validate="off")
+
+
+def translated_activity(tmp_path):
+    return write_activity(tmp_path, "activity", items={
+        "consent": {"ui": {"inputType": "radio"},
+                    "question": {"en": "Do you consent?", "fr": "Consentez-vous ?"},
+                    "responseOptions": "../valueConstraints/yes_no"}},
+        extra_files={"valueConstraints/yes_no": {"valueType": "xsd:integer", "choices": [
+            {"name": {"en": "No", "fr": "Non"}, "value": 0}, {"name": {"en": "Yes", "fr": "Oui"}, "value": 1}]}})
+
+
+def translations(element: dict) -> dict:
+    return {
+        extension["extension"][0]["valueCode"]: extension["extension"][1]["valueString"]
+        for extension in element["extension"]
+    }
+
+
+def test_translations_are_added_in_the_same_pass(tmp_path, fhir_env, monkeypatch):
+    monkeypatch.setenv("QUESTIONNAIRE_TRANSLATIONS", "fr,es")
+    (_, questionnaire, _, codesystems, _) = convert_resources(translated_activity(tmp_path))
+    item = json.loads(questionnaire)["item"][0]
+    assert item["text"] == "Do you consent?"
+    # there is no spanish text, which falls back to english and is left out
+    assert translations(item["_text"]) == {"fr": "Consentez-vous ?"}
+    [(_, codesystem)] = codesystems
+    assert [(concept["display"], concept["designation"]) for concept in json.loads(codesystem)["concept"]] == [
+        ("No", [{"language": "fr", "value": "Non"}]), ("Yes", [{"language": "fr", "value": "Oui"}])]
+
+    monkeypatch.setenv("FHIR_QUESTIONNAIRE_MODE", "AnswerOptions")
+    (_, questionnaire, _, _, _) = convert_resources(translated_activity(tmp_path / "answers"))
+    options = json.loads(questionnaire)["item"][0]["answerOption"]
+    assert [(option["valueString"], translations(option["_valueString"])) for option in options] == [
+        ("No", {"fr": "Non"}), ("Yes", {"fr": "Oui"})]
+
+
+def test_regional_languages_fall_back_to_their_base_language(tmp_path, fhir_env, monkeypatch):
+    monkeypatch.setenv("QUESTIONNAIRE_LANGUAGE", "fr-CA")
+    config = Config()
+    assert config.get_language_chain() == ["fr-CA", "fr"]
+    assert config.for_language("es").get_language_chain() == ["es", "fr-CA", "fr"]
+    (_, questionnaire, _, _, _) = convert_resources(translated_activity(tmp_path), validate="off")
+    assert json.loads(questionnaire)["item"][0]["text"] == "Consentez-vous ?"
+
+
+def write_profile(tmp_path):
+    profile = tmp_path / "profile.json"
+    profile.write_text(json.dumps({"targets": [
+        {"name": "staging", "QUESTIONNAIRE_URI": "https://staging.example.org/fhir/Questionnaire/",
+         "VALUESET_URI": "https://staging.example.org/fhir/ValueSet/",
+         "CODESYSTEM_URI": "https://staging.example.org/fhir/CodeSystem/"},
+        {"name": "production", "output": str(tmp_path / "published"), "FHIR_QUESTIONNAIRE_MODE": "AnswerOptions"},
+    ]}))
+    return profile
+
+
+def test_profile_targets_render_one_parse_into_separate_trees(tmp_path, fhir_env, monkeypatch):
+    targets = load_targets(write_profile(tmp_path), tmp_path / "output")
+    assert [(target.name, target.output_path, target.config.get_mode()) for target in targets] == [
+        ("staging", str(tmp_path / "output" / "staging"), "ValueSet"),
+        ("production", str(tmp_path / "published"), "AnswerOptions")]
+
+    activities = tmp_path / "activities"
+    for name in ("first", "second"):
+        write_activity(activities, name)
+    read = []
+    source_read = FolderSource.read
+    monkeypatch.setattr(FolderSource, "read", lambda self, key: read.append(key) or source_read(self, key))
+    results = run_batch(activities, tmp_path / "output", workers=1, deterministic=True, targets=targets)
+    assert all(result.ok for result in results)
+    # every document is read once for both targets
+    assert sorted(read) == sorted(["first_schema", "second_schema"] + ["items/consent", "items/age"] * 2)
+
+    staging = json.loads((tmp_path / "output" / "staging" / "first" / "first.json").read_text())
+    assert staging["url"].startswith("https://staging.example.org/fhir/Questionnaire/")
+    assert staging["item"][0]["answerValueSet"].startswith("https://staging.example.org/fhir/ValueSet/")
+    production = json.loads((tmp_path / "published" / "first" / "first.json").read_text())
+    assert production["url"].startswith("https://voicecollab.ai/fhir/Questionnaire/")
+    assert [option["valueString"] for option in production["item"][0]["answerOption"]] == ["No", "Yes"]
+
+    # the same as converting each target on its own
+    monkeypatch.setenv("FHIR_QUESTIONNAIRE_MODE", "AnswerOptions")
+    convert_activity(activities / "first", tmp_path / "alone", deterministic=True)
+    assert (tmp_path / "alone" / "first" / "first.json").read_bytes() == (
+        tmp_path / "published" / "first" / "first.json").read_bytes()
+
+
+def test_profile_rejects_unknown_settings(tmp_path, fhir_env):
+    profile = tmp_path / "profile.json"
+    profile.write_text(json.dumps({"targets": [{"name": "staging", "QUESTIONAIRE_URI": "https://typo/"}]}))
+    with pytest.raises(ValueError, match="Unknown setting QUESTIONAIRE_URI"):
+        load_targets(profile, tmp_path / "output")
@@ -0,0 +1,258 @@
+import io
+import mmap
+import os
+import posixpath
+import tarfile
+import threading
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+from .resolver import Resolver, RemoteSource, is_url
+
+ARCHIVE_SUFFIXES = (".zip", ".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tar.xz")
+# separates the archive from the folder of an activity inside it, eg. library.zip!/activities/phq9
+MEMBER_SEPARATOR = "!/"
+
+
+class _MappedFile(mmap.mmap):
+    # zipfile asks file objects whether they are seekable, mmap only answers from python 3.13
+    def seekable(self) -> bool:
+        return True
+
+
+def is_archive(path) -> bool:
+    return str(path).lower().endswith(ARCHIVE_SUFFIXES) and Path(path).is_file()
+
+
+def _archive_stem(path: str) -> str:
+    name = posixpath.basename(str(path))
+    for suffix in sorted(ARCHIVE_SUFFIXES, key=len, reverse=True):
+        if name.lower().endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+class Archive:
+    """
+    Index of the members of a zip or tar archive, read without extracting anything.
+
+    Zip archives are memory-mapped where possible and their members are found through the
+    central directory, so only the members which are read are ever decompressed. Tar
+    archives have no central directory: their headers are read once when the archive is
+    opened, which for compressed tars means decompressing it once.
+    """
+
+    def __init__(self, path=None, data: bytes = None):
+        self.path = None if path is None else str(path)
+        self._file = None
+        self._mmap = None
+        # tarfile seeks the one file object for every member, threads take turns
+        self._lock = threading.Lock()
+        self.members: Dict[str, Union[zipfile.ZipInfo, tarfile.TarInfo]] = dict()
+        if data is not None:
+            fileobj = io.BytesIO(data)
+        else:
+            self._file = open(self.path, "rb")
+            fileobj = self._file
+            if os.fstat(self._file.fileno()).st_size > 0:
+                self._mmap = _MappedFile(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                fileobj = self._mmap
+        if zipfile.is_zipfile(fileobj):
+            fileobj.seek(0)
+            self._zip = zipfile.ZipFile(fileobj)
+            self._tar = None
+            self.members = {info.filename: info for info in self._zip.infolist() if not info.is_dir()}
+        else:
+            fileobj.seek(0)
+            self._zip = None
+            try:
+                self._tar = tarfile.open(fileobj=fileobj, mode="r:*")
+            except tarfile.TarError:
+                self.close()
+                raise ValueError(f"{self.path or 'The data'} is neither a zip nor a tar archive")
+            self.members = {posixpath.normpath(info.name): info
+                            for info in self._tar.getmembers() if info.isfile()}
+        # the file names in each folder, to find the schemas without going over every member
+        self.folders: Dict[str, List[str]] = dict()
+        for name in self.members:
+            self.folders.setdefault(posixpath.dirname(name), []).append(posixpath.basename(name))
+
+    def read(self, name: str) -> bytes:
+        info = self.members[name]
+        with self._lock:
+            if self._zip is not None:
+                return self._zip.read(info)
+            return self._tar.extractfile(info).read()
+
+    def mtime(self, name: str) -> float:
+        info = self.members[name]
+        if self._zip is not None:
+            return datetime(*info.date_time).timestamp()
+        return float(info.mtime)
+
+    def activities(self) -> List[str]:
+        """
+        The folder of every *_schema member, i.e. of every activity in the archive, "" for the root
+        """
+        return sorted(folder for (folder, names) in self.folders.items()
+                      if any(name.endswith("_schema") and not name.startswith(".") for name in names))
+
+    def close(self):
+        for resource in (getattr(self, "_zip", None), getattr(self, "_tar", None), self._mmap, self._file):
+            if resource is not None:
+                resource.close()
+
+
+# archives stay open for the life of a process, a batch worker reads many activities from one
+_open_archives: Dict[tuple, Archive] = dict()
+
+
+def open_archive(path) -> Archive:
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _open_archives:
+        _open_archives[key] = Archive(path)
+    return _open_archives[key]
+
+
+class FolderSource:
+    """
+    The files of an activity folder on disk
+    """
+
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        if not os.path.isdir(self.folder):
+            raise FileNotFoundError(
+                f"{self.folder} does not exist. Please check if folder exists and is located at the correct directory"
+            )
+        self.name = self.folder.parts[-1]
+
+    def schema_names(self) -> List[str]:
+        return sorted(file.name for file in self.folder.glob("*_schema") if file.is_file())
+
+    def is_file(self, key: str) -> bool:
+        return (self.folder / key).is_file()
+
+    def read(self, key: str) -> bytes:
+        path = self.folder / key
+        if not path.is_file():
+            raise KeyError(key)
+        with open(path, "rb") as f:
+            return f.read()
+
+    def files(self) -> List[str]:
+        return sorted(file.relative_to(self.folder).as_posix()
+                      for file in self.folder.glob("**/*") if file.is_file())
+
+    def mtime(self, key: str) -> float:
+        return (self.folder / key).stat().st_mtime
+
+    def locate(self, reference: str) -> str:
+        """
+        The location of a file or folder relative to this one, eg. another activity
+        """
+        return os.path.normpath(self.folder / reference)
+
+    def __str__(self):
+        return str(self.folder)
+
+
+class ArchiveSource:
+    """
+    The members of an activity folder inside a zip or tar archive
+    """
+
+    def __init__(self, archive: Archive, prefix: str = "", name: str = None):
+        self.archive = archive
+        self.prefix = prefix.strip("/")
+        self.name = name or (posixpath.basename(self.prefix) if self.prefix else _archive_stem(archive.path or ""))
+
+    def _member(self, key: str) -> str:
+        return posixpath.normpath(posixpath.join(self.prefix, key)) if self.prefix else posixpath.normpath(key)
+
+    def schema_names(self) -> List[str]:
+        return sorted(name for name in self.archive.folders.get(self.prefix, []) if name.endswith("_schema"))
+
+    def is_file(self, key: str) -> bool:
+        return self._member(key) in self.archive.members
+
+    def read(self, key: str) -> bytes:
+        member = self._member(key)
+        if member not in self.archive.members:
+            raise KeyError(key)
+        return self.archive.read(member)
+
+    def files(self) -> List[str]:
+        start = f"{self.prefix}/" if self.prefix else ""
+        return sorted(name[len(start):] for name in self.archive.members if name.startswith(start))
+
+    def mtime(self, key: str) -> float:
+        return self.archive.mtime(self._member(key))
+
+    def locate(self, reference: str) -> str:
+        if self.archive.path is None:
+            raise ValueError(f"Cannot locate {reference} next to an archive which is not a file")
+        return f"{self.archive.path}{MEMBER_SEPARATOR}{self._member(reference)}"
+
+    def __str__(self):
+        return f"{self.archive.path}{MEMBER_SEPARATOR}{self.prefix}"
+
+
+ActivitySource = Union[FolderSource, ArchiveSource, RemoteSource]
+
+
+def open_source(location, resolver: Optional[Resolver] = None) -> ActivitySource:
+    """
+    The source of an activity: a folder, an archive holding a single activity, a
+    folder in an archive given as <archive>!/<folder>, or the URL of its schema
+    """
+    if isinstance(location, (FolderSource, ArchiveSource, RemoteSource)):
+        return location
+    location = str(location)
+    if is_url(location):
+        return RemoteSource(location, resolver)
+    if MEMBER_SEPARATOR in location or location.endswith("!"):
+        # the activity at the root of an archive is <archive>!
+        (path, prefix) = (location + "/").split(MEMBER_SEPARATOR, 1)
+        if is_archive(path):
+            return ArchiveSource(open_archive(path), prefix)
+    if is_archive(location):
+        archive = open_archive(location)
+        activities = archive.activities()
+        if len(activities) != 1:
+            raise ValueError(f"{location} holds {len(activities)} activities, convert it with --batch")
+        return ArchiveSource(archive, activities[0])
+    return FolderSource(location)
+
+
+def activity_name(location) -> str:
+    """
+    The name of the activity at a location, which names its output folder, without loading it.
+
+    The name is the one open_source gives the activity: an archive holding a single
+    activity is named after the folder of that activity, so its member list is read.
+    """
+    location = str(location)
+    if is_url(location):
+        return RemoteSource(location).name
+    if MEMBER_SEPARATOR in location or location.endswith("!"):
+        (path, prefix) = (location + "/").split(MEMBER_SEPARATOR, 1)
+        prefix = prefix.strip("/")
+        return posixpath.basename(prefix) if prefix else _archive_stem(path)
+    if is_archive(location):
+        activities = open_archive(location).activities()
+        if len(activities) == 1:
+            return ArchiveSource(open_archive(location), activities[0]).name
+    if location.lower().endswith(ARCHIVE_SUFFIXES):
+        return _archive_stem(location)
+    return Path(location).name
+
+
+def find_archive_activities(path) -> List[Path]:
+    """
+    The <archive>!/<folder> location of every activity in an archive
+    """
+    return [Path(f"{path}{MEMBER_SEPARATOR}{prefix}") for prefix in open_archive(path).activities()]
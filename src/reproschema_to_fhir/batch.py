@@ -0,0 +1,539 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from datetime import datetime
+import os
+import time
+import traceback
+from pathlib import Path
+from typing import List, Optional
+
+from .archive import activity_name, find_archive_activities, is_archive
+from .bulk import NdjsonWriter
+from .config import Config
+from .convert import (claiming, convert_activity, convert_resources, convert_targets, render_terminology,
+                      write_shared_terminology)
+from .item_cache import ItemCache
+from .manifest import Manifest, conversion_fingerprint, hash_activity, last_change
+from .profiling import StageTimer
+from .registry import ProvisionalRegistry, TerminologyRegistry
+from .resolver import DEFAULT_TTL, Resolver
+from .stream import replace_strings, replace_strings_in_file
+from .targets import Target
+
+# each worker process loads the .env once and reuses the config for every activity it converts
+_worker_config: Optional[Config] = None
+_worker_registry: Optional[TerminologyRegistry] = None
+# items converted by a worker are reused for every later activity it converts
+_worker_item_cache: Optional[ItemCache] = None
+# documents referenced by URL are fetched once per worker, or once per cache ttl with a document cache
+_worker_resolver: Optional[Resolver] = None
+# with targets and shared terminology, the registry of each target by name
+_worker_target_registries: Optional[dict] = None
+_worker_options: Optional["BatchOptions"] = None
+_worker_config_hash: str = ""
+
+
+@dataclass
+class BatchOptions:
+    """
+    Options of a batch run which every worker needs, see run_batch.
+    """
+    registry_path: Optional[str] = None
+    incremental: bool = False
+    deterministic: bool = False
+    validate: str = "full"
+    sample_rate: float = 0.1
+    profile: bool = False
+    trace_memory: bool = False
+    output_format: str = "files"
+    stream: bool = False
+    item_cache_path: Optional[str] = None
+    document_cache_path: Optional[str] = None
+    offline: bool = False
+    cache_ttl: float = DEFAULT_TTL
+    targets: Optional[List[Target]] = None
+    # the parent claims the code systems, the workers never open the registries
+    planned: bool = False
+
+
+@dataclass
+class ActivityResult:
+    """
+    Outcome of converting a single reproschema activity in a batch run.
+    """
+    name: str
+    folder: str
+    ok: bool
+    seconds: float
+    error: str = ""
+    # set when the input hash matched the manifest and the activity was not converted again
+    skipped: bool = False
+    digest: str = ""
+    # seconds (and peak_bytes when tracing memory) per stage, when profiling
+    stages: dict = field(default_factory=dict)
+    # with the ndjson format the serialized resources are sent back to be written by the parent:
+    # (questionnaire json, [(valueset id, json)], [(codesystem id, json)]). With several
+    # workers the parent gives the questionnaire the canonical ids of its code systems and
+    # generates the code systems and value sets itself, see TerminologyPlan
+    resources: Optional[tuple] = None
+    # with shared terminology and several workers, the code systems the activity used by
+    # registry, {target name or None: ProvisionalRegistry.claims}, and the date of its
+    # resources, for the parent to claim them in order, see TerminologyPlan
+    claims: Optional[dict] = None
+    date: Optional[datetime] = None
+
+
+class TerminologyPlan:
+    """
+    Claims the code systems of the activities of a run in the order of the activities.
+
+    With several workers the activities finish in any order, so the workers convert them
+    with provisional ids and send back the code systems each of them used, see
+    ProvisionalRegistry. The parent claims them in the registry activity by activity, so a
+    run from scratch always gives a code system the id of the first activity using it, and
+    replaces the provisional ids of the questionnaire which differ from the canonical ones.
+    The code systems new to the registry are then generated by the parent, dated like the
+    first activity using them which converted, and committed once they are written.
+    """
+
+    def __init__(self, registry: TerminologyRegistry, config: Config):
+        self.registry = registry
+        self.config = config
+        # fingerprint: (id, concepts, positions of the activities using it) of the new code systems
+        self.new = dict()
+
+    def claim(self, position: int, claims: dict) -> dict:
+        """
+        Claims the code systems of the activity at position, returns the canonical url of
+        the value sets its questionnaire refers to by a different provisional url
+        """
+        urls = dict()
+        for (fingerprint, (provisional, id_str, concepts)) in claims.items():
+            (codesystem_id, is_new) = self.registry.claim(fingerprint, id_str)
+            if is_new:
+                self.new[fingerprint] = (codesystem_id, concepts, [])
+            if fingerprint in self.new:
+                self.new[fingerprint][2].append(position)
+            if codesystem_id != provisional:
+                urls[f"{self.config.get_valueset()}{provisional}"] = f"{self.config.get_valueset()}{codesystem_id}"
+        return urls
+
+    def terminology(self, dates: dict) -> dict:
+        """
+        {fingerprint: (id, concepts, date)} of the new code systems used by an activity which
+        converted, dates holding the date of the resources of each of them by position
+        """
+        terminology = dict()
+        for (fingerprint, (id_str, concepts, positions)) in self.new.items():
+            converted = [position for position in positions if position in dates]
+            if converted:
+                terminology[fingerprint] = (id_str, concepts, dates[converted[0]])
+        return terminology
+
+
+def find_activities(activities_root) -> List[Path]:
+    """
+    Return every folder directly under activities_root which contains a reproschema *_schema file
+
+    activities_root may also be a zip or tar archive, then every folder in it which contains
+    a *_schema member is returned as <archive>!/<folder>.
+    """
+    if is_archive(activities_root):
+        return find_archive_activities(activities_root)
+    activities_root = Path(activities_root)
+    if not activities_root.is_dir():
+        raise FileNotFoundError(
+            f"{activities_root} does not exist. Please check if folder exists and is located at the correct directory"
+        )
+    activities = []
+    for folder in sorted(activities_root.iterdir()):
+        if folder.is_dir() and any(folder.glob("*_schema")):
+            activities.append(folder)
+    return activities
+
+
+def _init_worker(options: BatchOptions):
+    global _worker_config, _worker_registry, _worker_item_cache, _worker_resolver, _worker_target_registries
+    global _worker_options, _worker_config_hash
+    _worker_config = Config()
+    # every worker opens its own connection to the shared registry and item cache
+    _worker_registry = None
+    if options.registry_path is not None and options.targets is None and not options.planned:
+        _worker_registry = TerminologyRegistry(options.registry_path)
+    elif options.output_format == "ndjson" and not options.planned:
+        # the bulk files hold one code system per id, so the activities share them anyway
+        _worker_registry = TerminologyRegistry()
+    _worker_item_cache = ItemCache(options.item_cache_path)
+    _worker_resolver = Resolver(options.document_cache_path, options.cache_ttl, options.offline)
+    _worker_target_registries = None
+    if options.targets is not None and options.registry_path is not None and not options.planned:
+        _worker_target_registries = {
+            target.name: TerminologyRegistry(target_registry_path(target))
+            for target in options.targets
+        }
+    _worker_options = options
+    _worker_config_hash = conversion_fingerprint(
+        _worker_config, options.registry_path is not None, options.deterministic, options.validate)
+
+
+def target_registry_path(target: Target) -> Path:
+    return Path(target.output_path) / "terminology.sqlite"
+
+
+def _worker_validate() -> str:
+    # the activities are already spread over the pool, each worker validates its own resources
+    return "full" if _worker_options.validate == "parallel" else _worker_options.validate
+
+
+def _convert_one(folder: str,
+                 output_path: str,
+                 previous_digest: Optional[str] = None) -> ActivityResult:
+    """
+    Converts an activity, with provisional ids for its code systems when the run is planned
+    """
+    options = _worker_options
+    start = time.perf_counter()
+    name = activity_name(folder)
+    digest = ""
+    (resources, claims, date) = (None, None, None)
+    timer = StageTimer(options.profile, options.trace_memory)
+    registry = _worker_registry
+    registries = _worker_target_registries
+    if options.planned and options.targets is not None:
+        registries = {target.name: ProvisionalRegistry(target_registry_path(target))
+                      for target in options.targets}
+    elif options.planned:
+        registry = ProvisionalRegistry(options.registry_path)
+    try:
+        if options.incremental:
+            digest = hash_activity(folder, _worker_config_hash)
+            if (digest == previous_digest and
+                    (Path(output_path) / name / f"{name}.json").exists()):
+                return ActivityResult(name, folder, True,
+                                      time.perf_counter() - start,
+                                      skipped=True, digest=digest)
+        if options.targets is not None:
+            convert_targets(folder, options.targets, registries,
+                            options.deterministic, _worker_validate(), options.sample_rate,
+                            workers=1, timer=timer, item_cache=_worker_item_cache,
+                            resolver=_worker_resolver)
+        elif options.output_format == "ndjson":
+            # the parent writes the resources right away, in the order of the activities
+            with claiming(registry):
+                (_, questionnaire, valuesets, codesystems, _) = convert_resources(
+                    folder, _worker_config, registry, options.deterministic,
+                    _worker_validate(), options.sample_rate, workers=1, timer=timer,
+                    item_cache=_worker_item_cache, resolver=_worker_resolver)
+            resources = (questionnaire, valuesets, codesystems)
+        else:
+            convert_activity(folder, output_path, _worker_config,
+                             registry, options.deterministic,
+                             _worker_validate(), options.sample_rate, workers=1,
+                             timer=timer, stream=options.stream,
+                             item_cache=_worker_item_cache, resolver=_worker_resolver)
+        if options.planned:
+            # the parent claims them in the order of the activities, see _claim_in_order
+            claims = {None: registry.claims} if registries is None else {
+                key: target_registry.claims for (key, target_registry) in registries.items()}
+            date = last_change(folder) if options.deterministic else None
+    except Exception as e:
+        return ActivityResult(name, folder, False,
+                              time.perf_counter() - start,
+                              "".join(traceback.format_exception_only(type(e), e)).strip(),
+                              stages=timer.stages)
+    return ActivityResult(name, folder, True, time.perf_counter() - start,
+                          digest=digest, stages=timer.stages, resources=resources,
+                          claims=claims, date=date)
+
+
+def _claim_in_order(activities: List[str], plans: dict, output_paths: dict, finished):
+    """
+    Wraps finished to claim the code systems of each activity once those of every activity
+    before it are claimed, see TerminologyPlan
+    """
+    converted = dict()
+    position = 0
+
+    def claim(folder, result):
+        nonlocal position
+        converted[folder] = result
+        while position < len(activities) and activities[position] in converted:
+            result = converted.pop(activities[position])
+            if result.claims is not None:
+                # skipped and failed activities claimed nothing
+                _claim_one(result, position, plans, output_paths)
+            finished(activities[position], result)
+            position += 1
+
+    return claim
+
+
+def _claim_one(result: ActivityResult, position: int, plans: dict, output_paths: dict):
+    """
+    Claims the code systems of a converted activity and gives its questionnaire their ids
+    """
+    try:
+        for (key, claims) in result.claims.items():
+            replacements = {
+                provisional.encode("utf-8"): canonical.encode("utf-8")
+                for (provisional, canonical) in plans[key].claim(position, claims).items()
+            }
+            if result.resources is not None:
+                (questionnaire, valuesets, codesystems) = result.resources
+                result.resources = (replace_strings(questionnaire, replacements), valuesets, codesystems)
+            else:
+                replace_strings_in_file(output_paths[key] / result.name / f"{result.name}.json",
+                                        replacements)
+    except Exception as e:
+        (result.ok, result.error) = (False, "".join(traceback.format_exception_only(type(e), e)).strip())
+        result.resources = None
+    result.claims = None
+
+
+def _write_planned_terminology(plans: dict, activities: List[str], results: dict, output_paths: dict,
+                               writer: Optional[NdjsonWriter], validate: str, sample_rate: float,
+                               workers: int):
+    """
+    Writes the new code systems and value sets of a planned run and commits their claims.
+
+    An invalid code system fails the activities using it, like the activity claiming it
+    fails in a run which is not planned.
+    """
+    dates = {position: results[folder].date for (position, folder) in enumerate(activities)
+             if results[folder].ok}
+    for (key, plan) in plans.items():
+        terminology = plan.terminology(dates)
+        try:
+            (valuesets, codesystems) = render_terminology(
+                list(terminology.values()), plan.config, validate, sample_rate, workers)
+            written = list(terminology)
+        except Exception:
+            # find which code systems are invalid
+            (valuesets, codesystems, written) = ([], [], [])
+            for (fingerprint, entry) in terminology.items():
+                try:
+                    (valueset, codesystem) = render_terminology([entry], plan.config, "full")
+                except Exception as e:
+                    error = "".join(traceback.format_exception_only(type(e), e)).strip()
+                    for position in plan.new[fingerprint][2]:
+                        result = results[activities[position]]
+                        if result.ok:
+                            (result.ok, result.error) = (False, f"CodeSystem {entry[0]}: {error}")
+                    continue
+                valuesets += valueset
+                codesystems += codesystem
+                written.append(fingerprint)
+        if writer is not None:
+            for (valueset_id, valueset) in valuesets:
+                writer.write("ValueSet", valueset_id, valueset)
+            for (codesystem_id, codesystem) in codesystems:
+                writer.write("CodeSystem", codesystem_id, codesystem)
+        else:
+            write_shared_terminology(valuesets, codesystems, output_paths[key])
+        plan.registry.commit(written)
+
+
+def run_batch(activities_root,
+              output_path,
+              workers: Optional[int] = None,
+              registry_path=None,
+              incremental: bool = False,
+              deterministic: bool = False,
+              validate: str = "full",
+              sample_rate: float = 0.1,
+              profile: bool = False,
+              trace_memory: bool = False,
+              progress: bool = False,
+              output_format: str = "files",
+              compress: bool = False,
+              stream: bool = False,
+              item_cache_path=None,
+              document_cache_path=None,
+              offline: bool = False,
+              cache_ttl: float = DEFAULT_TTL,
+              targets: Optional[List[Target]] = None) -> List[ActivityResult]:
+    """
+    Convert every activity under activities_root in a single pool of warm worker processes.
+
+    activities_root may also be a list of activity locations, eg. the activities of a Protocol.
+
+    With a registry_path, code systems and value sets with the same codes and displays
+    are shared by all activities (see TerminologyRegistry). A code system is named after
+    the first activity using it, in the order of the activities whichever worker finishes
+    first. With several workers the parent claims the code systems of every activity once
+    it converted, in the order of the activities, see TerminologyPlan.
+
+    In incremental mode the hash of every activity's input files and the config is kept in
+    <output_path>/manifest.json, and activities whose hash did not change are skipped.
+    In deterministic mode resource dates are pinned to the last change of the inputs.
+
+    validate is passed on to convert_activity, except that parallel validates each
+    activity's resources in the worker converting it.
+
+    profile records the time of each stage of each activity in ActivityResult.stages,
+    trace_memory adds the peak traced memory, and progress shows a tqdm progress bar.
+
+    With the ndjson output_format all resources go to Questionnaire.ndjson, ValueSet.ndjson
+    and CodeSystem.ndjson in output_path (gzipped with compress), see NdjsonWriter. The
+    files are rewritten by every run, so it cannot be combined with incremental, and a
+    registry at registry_path starts empty. As the files hold one resource per id, the
+    activities share their code systems and value sets even without a registry_path, in a
+    registry kept in memory for the run.
+
+    stream writes each questionnaire item by item, see stream_activity.
+
+    Every worker keeps the items it converted in an ItemCache, so items and option lists
+    shared by many activities are converted once per worker. With an item_cache_path the
+    cache is an SQLite database shared by the workers and by later runs.
+
+    Documents referenced by URL are fetched through a Resolver per worker, kept on disk in
+    document_cache_path when given and revalidated after cache_ttl seconds. offline runs
+    only use the documents already in the cache. The incremental manifest only hashes the
+    local files, including the items of other activities referenced by a "../" path, a
+    remote document changing does not convert its activities again.
+
+    With targets every activity is loaded once and written for each Target, see
+    convert_targets, to the target's output folder instead of output_path. With a
+    registry_path each target gets its own registry in its output folder.
+
+    Results are returned in the same (sorted) order as the activities were found, or given.
+    """
+    if output_format == "ndjson" and incremental:
+        raise ValueError("incremental runs cannot write ndjson, the bulk files are rewritten by every run")
+    if output_format == "ndjson" and stream:
+        raise ValueError("questionnaires can only be streamed to files, not to ndjson")
+    if targets is not None and (incremental or stream or output_format == "ndjson"):
+        raise ValueError("targets are written as files, and cannot be combined with incremental or stream")
+    if isinstance(activities_root, (list, tuple)):
+        activities = [str(folder) for folder in activities_root]
+    else:
+        activities = [str(folder) for folder in find_activities(activities_root)]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(activities) or 1))
+    planned = (registry_path is not None or output_format == "ndjson") and workers > 1
+    options = BatchOptions(
+        None if registry_path is None else str(registry_path), incremental,
+        deterministic, validate, sample_rate, profile, trace_memory, output_format,
+        stream, None if item_cache_path is None else str(item_cache_path),
+        None if document_cache_path is None else str(document_cache_path), offline, cache_ttl,
+        targets, planned)
+    # the registries the parent claims the code systems in when the run is planned, by target
+    plans = dict()
+    if registry_path is not None and targets is not None:
+        for target in targets:
+            target_registry_path(target).parent.mkdir(parents=True, exist_ok=True)
+            registry = TerminologyRegistry(target_registry_path(target))
+            if planned:
+                plans[target.name] = TerminologyPlan(registry, target.config)
+            else:
+                registry.close()
+    elif registry_path is not None:
+        # create the database before the workers race to do it
+        Path(registry_path).parent.mkdir(parents=True, exist_ok=True)
+        registry = TerminologyRegistry(registry_path)
+        if output_format == "ndjson":
+            # code systems claimed by earlier runs would be missing from the new files
+            registry.clear()
+        if planned:
+            plans[None] = TerminologyPlan(registry, Config())
+        else:
+            registry.close()
+    elif planned:
+        plans[None] = TerminologyPlan(TerminologyRegistry(), Config())
+    if item_cache_path is not None:
+        Path(item_cache_path).parent.mkdir(parents=True, exist_ok=True)
+        ItemCache(item_cache_path).close()
+
+    manifest = Manifest(Path(output_path) / "manifest.json") if incremental else None
+
+    def task(folder):
+        previous_digest = None if manifest is None else manifest.get(activity_name(folder))
+        return (folder, str(output_path), previous_digest)
+
+    progress_bar = None
+    if progress:
+        from tqdm import tqdm
+        progress_bar = tqdm(total=len(activities), unit="activity")
+
+    writer = None
+    if output_format == "ndjson":
+        writer = NdjsonWriter(output_path, compress)
+    # resources are written in the order of the activities, whatever order they finish in,
+    # so the bulk files of deterministic runs are identical
+    position = 0
+
+    results = {}
+
+    def finished(folder, result):
+        nonlocal position
+        results[folder] = result
+        while writer is not None and position < len(activities) and activities[position] in results:
+            written = results[activities[position]]
+            if written.resources is not None:
+                writer.write_activity(written.name, *written.resources)
+                written.resources = None
+            position += 1
+        if progress_bar is not None:
+            progress_bar.update()
+
+    output_paths = {None: Path(output_path)}
+    for target in targets or []:
+        output_paths[target.name] = Path(target.output_path)
+    try:
+        if workers == 1:
+            # no point paying for a pool when there is only one worker
+            _init_worker(options)
+            for folder in activities:
+                finished(folder, _convert_one(*task(folder)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(options, )) as executor:
+                futures = {
+                    executor.submit(_convert_one, *task(folder)): folder
+                    for folder in activities
+                }
+                done = finished
+                if planned:
+                    done = _claim_in_order(activities, plans, output_paths, finished)
+                for future in as_completed(futures):
+                    done(futures[future], future.result())
+        if planned:
+            _write_planned_terminology(plans, activities, results, output_paths, writer,
+                                       validate, sample_rate, workers)
+    finally:
+        for plan in plans.values():
+            plan.registry.rollback()
+            plan.registry.close()
+        if writer is not None:
+            writer.close()
+        if progress_bar is not None:
+            progress_bar.close()
+    results = [results[folder] for folder in activities]
+
+    if manifest is not None:
+        for result in results:
+            if result.ok:
+                manifest.update(result.name, result.digest)
+            else:
+                manifest.remove(result.name)
+        manifest.save()
+    return results
+
+
+def print_summary(results: List[ActivityResult]):
+    """
+    Print one line per activity followed by the overall success/failure counts
+    """
+    for result in results:
+        status = "ok" if result.ok else "FAILED"
+        if result.skipped:
+            status = "skipped"
+        line = f"{status:>6}  {result.name} ({result.seconds:.2f}s)"
+        if not result.ok:
+            line += f": {result.error}"
+        print(line)
+    failures = [result for result in results if not result.ok]
+    skipped = [result for result in results if result.skipped]
+    print(f"{len(results) - len(failures)} succeeded ({len(skipped)} unchanged), {len(failures)} failed")
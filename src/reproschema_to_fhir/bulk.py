@@ -0,0 +1,81 @@
+import gzip
+import hashlib
+import io
+from pathlib import Path
+
+OUTPUT_FORMATS = ("files", "ndjson")
+RESOURCE_TYPES = ("Questionnaire", "ValueSet", "CodeSystem")
+
+
+class NdjsonWriter:
+    """
+    Writes resources to one <resourceType>.ndjson file per resource type, the FHIR bulk
+    data layout which a server can load with $import.
+
+    The three files are created (and truncated) once and then only appended to through a
+    large buffer, optionally gzip compressed. A resource whose id was already written with
+    the same content is skipped, so a value set shared by many activities appears once, and
+    one written with a different content is an error, as the files hold one resource per id.
+    """
+
+    def __init__(self, output_path, compress: bool = False, buffer_size: int = 1 << 20):
+        self.output_path = Path(output_path)
+        self.output_path.mkdir(parents=True, exist_ok=True)
+        self.compress = compress
+        # id: digest of the json of every resource written, by resource type
+        self.written = {resource_type: dict() for resource_type in RESOURCE_TYPES}
+        self._files = dict()
+        for resource_type in RESOURCE_TYPES:
+            path = self.output_path / self.file_name(resource_type)
+            file = open(path, "wb", buffering=buffer_size)
+            stream = file
+            if compress:
+                # buffer in front of the compressor too, so it gets large chunks rather than lines
+                stream = io.BufferedWriter(
+                    gzip.GzipFile(fileobj=file, mode="wb", compresslevel=6), buffer_size)
+            self._files[resource_type] = (stream, file)
+
+    def file_name(self, resource_type: str) -> str:
+        return f"{resource_type}.ndjson.gz" if self.compress else f"{resource_type}.ndjson"
+
+    def write(self, resource_type: str, resource_id: str, data: bytes) -> bool:
+        """
+        Append the json of one resource as a line, returns False if it was already written.
+
+        Raises ValueError if a different resource was written with the same id.
+        """
+        # json never contains a raw newline, but a pretty-printed resource would break the format
+        if b"\n" in data:
+            data = b" ".join(line.strip() for line in data.splitlines())
+        digest = hashlib.sha256(data).digest()
+        written = self.written[resource_type].get(resource_id)
+        if written is not None:
+            if written != digest:
+                raise ValueError(f"{resource_type}/{resource_id} was already written with a different content")
+            return False
+        self.written[resource_type][resource_id] = digest
+        self._files[resource_type][0].write(data + b"\n")
+        return True
+
+    def write_activity(self, name: str, questionnaire: bytes, valuesets: list,
+                       codesystems: list):
+        """
+        Append the questionnaire of an activity and the (id, json) pairs of its value sets and code systems
+        """
+        self.write("Questionnaire", name, questionnaire)
+        for (valueset_id, valueset) in valuesets:
+            self.write("ValueSet", valueset_id, valueset)
+        for (codesystem_id, codesystem) in codesystems:
+            self.write("CodeSystem", codesystem_id, codesystem)
+
+    def close(self):
+        for (stream, file) in self._files.values():
+            stream.close()
+            # closing the GzipFile does not close the file object it was given
+            file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
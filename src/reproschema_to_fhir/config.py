@@ -1,17 +1,64 @@
+import copy
 import os
 from dotenv import load_dotenv
 
 
+# the .env / profile setting of each Config attribute
+SETTINGS = {
+    "CODESYSTEM_URI": "CODESYSTEM_URI",
+    "VALUESET_URI": "VALUESET_URI",
+    "QUESTIONNAIRE_URI": "QUESTIONNAIRE_URI",
+    "QUESTIONNAIRE_LANGUAGE": "LANGUAGE",
+    "FHIR_QUESTIONNAIRE_MODE": "MODE",
+    "QUESTIONNAIRE_TRANSLATIONS": "TRANSLATIONS",
+    "QUESTIONNAIRE_LANGUAGE_FALLBACK": "LANGUAGE_FALLBACK",
+}
+
+
 class Config:
+    # the .env file is read by the first config of a process, the environment by every one
+    _dotenv_loaded = False
 
     def __init__(self):
-        load_dotenv()
+        if not Config._dotenv_loaded:
+            load_dotenv()
+            Config._dotenv_loaded = True
         self.CODESYSTEM_URI = os.getenv('CODESYSTEM_URI')
         self.VALUESET_URI = os.getenv('VALUESET_URI')
         self.QUESTIONNAIRE_URI = os.getenv('QUESTIONNAIRE_URI')
         self.LANGUAGE = str(os.getenv('QUESTIONNAIRE_LANGUAGE'))
         self.MODE = os.getenv('FHIR_QUESTIONNAIRE_MODE')
+        # comma separated, eg. "fr,es", added to the texts as translation extensions
+        self.TRANSLATIONS = self._languages(os.getenv('QUESTIONNAIRE_TRANSLATIONS'))
+        # comma separated languages to use when a text is missing in the language itself
+        self.LANGUAGE_FALLBACK = self._languages(os.getenv('QUESTIONNAIRE_LANGUAGE_FALLBACK'))
+
+    @staticmethod
+    def _languages(value) -> list:
+        return [language.strip() for language in (value or "").split(",") if language.strip()]
+
+    def for_language(self, language: str) -> "Config":
+        """
+        The same config in another language, falling back to this one's language, without translations
+        """
+        config = copy.copy(self)
+        config.LANGUAGE = language
+        config.TRANSLATIONS = []
+        config.LANGUAGE_FALLBACK = [self.LANGUAGE] + self.LANGUAGE_FALLBACK
+        return config
 
+    def with_settings(self, settings: dict) -> "Config":
+        """
+        The same config with some of the .env settings replaced, eg. {"FHIR_QUESTIONNAIRE_MODE": "AnswerOptions"}
+        """
+        config = copy.copy(self)
+        for (name, value) in settings.items():
+            if name not in SETTINGS:
+                raise ValueError(f"Unknown setting {name}, expected one of {', '.join(SETTINGS)}")
+            if SETTINGS[name] in ("TRANSLATIONS", "LANGUAGE_FALLBACK") and isinstance(value, str):
+                value = self._languages(value)
+            setattr(config, SETTINGS[name], value)
+        return config
 
     def get_questionnaire(self):
         return self.QUESTIONNAIRE_URI
@@ -24,6 +71,21 @@ class Config:
 
     def get_language(self):
         return self.LANGUAGE
-    
+
+    def get_language_chain(self) -> list:
+        """
+        The languages to look a text up in, in order: the language, then the LANGUAGE_FALLBACK,
+        each followed by its base language (fr for fr-CA)
+        """
+        chain = []
+        for language in [self.LANGUAGE] + self.LANGUAGE_FALLBACK:
+            for candidate in (language, language.split("-")[0]):
+                if candidate not in chain:
+                    chain.append(candidate)
+        return chain
+
+    def get_translations(self) -> list:
+        return self.TRANSLATIONS
+
     def get_mode(self):
         return self.MODE
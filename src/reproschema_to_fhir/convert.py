@@ -0,0 +1,446 @@
+from contextlib import nullcontext
+import os
+import random
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import jsonio
+from .config import Config
+from .fhir import QuestionnaireGenerator, code_system_resource, generate_value_set
+from .index import ReproschemaIndex
+from .item_cache import ItemCache
+from .loader import ReproschemaLoader
+from .manifest import last_change
+from .profiling import StageTimer
+from .registry import TerminologyRegistry
+from .resolver import Resolver
+from .stream import write_questionnaire_stream
+from .targets import Target
+from .validation import serialize, validate_item, validate_resource, validate_resources
+
+
+def convert_activity(reproschema_folder,
+                     output_path,
+                     config: Optional[Config] = None,
+                     registry: Optional[TerminologyRegistry] = None,
+                     deterministic: bool = False,
+                     validate: str = "full",
+                     sample_rate: float = 0.1,
+                     workers: Optional[int] = None,
+                     timer: Optional[StageTimer] = None,
+                     stream: bool = False,
+                     item_cache: Optional[ItemCache] = None,
+                     resolver: Optional[Resolver] = None):
+    """
+    Convert a single reproschema activity folder and write the FHIR resources to output_path
+
+    The folder may also be an archive holding one activity or a folder inside an archive,
+    eg. library.zip!/activities/phq9, see open_source.
+
+    validate is one of the VALIDATION_STRATEGIES: off, full, sample (a sample_rate share
+    of the resources) or parallel (across a pool of worker processes).
+
+    In deterministic mode the dates of the resources are the last change to the input
+    files rather than now, so converting unchanged content gives byte-identical files.
+
+    When an on-disk registry is given, code systems and value sets are shared by every
+    activity using it. They are written once, named by their canonical id, to
+    output_path/codesystems and output_path/valuesets instead of the activity's folder.
+    The activity's claims are committed once its output is written, and rolled back when
+    it fails.
+
+    A StageTimer records how long loading the schema, indexing the items and options,
+    converting, validating and writing took.
+
+    With stream the questionnaire is written item by item as it is converted, see
+    stream_activity, instead of being built in memory first.
+
+    An ItemCache shared by many conversions converts items and option lists which they
+    have in common only once.
+
+    Items and option lists referenced by URL are loaded through the resolver, see Resolver
+    for its on-disk cache and offline mode.
+
+    The dependency graph of the items' enable conditions is written next to the
+    questionnaire as <activity>.visibility.json, see VisibilityGraph.
+
+    Returns the name of the output folder, i.e. the name of the activity.
+    """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+
+    if stream:
+        return stream_activity(reproschema_folder, output_path, config, registry,
+                               deterministic, validate, sample_rate, timer, item_cache,
+                               resolver)
+
+    with claiming(registry):
+        (file_name, questionnaire_json, valuesets, codesystems, visibility) = convert_resources(
+            reproschema_folder, config, registry, deterministic, validate,
+            sample_rate, workers, timer, item_cache, resolver)
+
+        with timer.stage("write"):
+            write_activity_output(
+                Path(output_path), file_name, questionnaire_json, valuesets, codesystems,
+                shared=registry is not None and registry.path is not None,
+                visibility=visibility)
+
+    return file_name
+
+
+def claiming(registry):
+    """
+    The transaction of a registry, which commits its claims once the block wrote the output
+    """
+    return nullcontext() if registry is None else registry.transaction()
+
+
+def convert_resources(reproschema_folder,
+                      config: Optional[Config] = None,
+                      registry: Optional[TerminologyRegistry] = None,
+                      deterministic: bool = False,
+                      validate: str = "full",
+                      sample_rate: float = 0.1,
+                      workers: Optional[int] = None,
+                      timer: Optional[StageTimer] = None,
+                      item_cache: Optional[ItemCache] = None,
+                      resolver: Optional[Resolver] = None):
+    """
+    Convert a single reproschema activity folder to serialized FHIR resources without writing them.
+
+    Takes the same options as convert_activity. Returns the name of the activity, the
+    questionnaire json, the (id, json) pairs of its value sets and code systems and the
+    json of its visibility graph. The claims made in the registry are the caller's to
+    commit once it wrote them, see TerminologyRegistry.transaction.
+    """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+
+    # reads the schema and checks its version, then only the items and options it references
+    with timer.stage("load"):
+        reproschema_loader = ReproschemaLoader(reproschema_folder, resolver)
+    with timer.stage("index"):
+        reproschema_content = ReproschemaIndex.build(reproschema_loader, resolver)
+
+    if config is None:
+        config = Config()
+    date = last_change(reproschema_loader.source) if deterministic else None
+    return (reproschema_loader.name,) + render_resources(
+        reproschema_content, config, registry, date, validate, sample_rate, workers, timer,
+        item_cache)
+
+
+def render_resources(index: ReproschemaIndex,
+                     config: Config,
+                     registry: Optional[TerminologyRegistry] = None,
+                     date=None,
+                     validate: str = "full",
+                     sample_rate: float = 0.1,
+                     workers: Optional[int] = None,
+                     timer: Optional[StageTimer] = None,
+                     item_cache: Optional[ItemCache] = None):
+    """
+    Convert an indexed activity with a config to serialized FHIR resources.
+
+    Returns the questionnaire json, the (id, json) pairs of its value sets and code systems
+    and the json of its visibility graph, see convert_resources.
+    """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+
+    with timer.stage("convert"):
+        questionnaire_generator = QuestionnaireGenerator(config, registry, date, item_cache)
+        fhir_questionnaire = questionnaire_generator.convert_to_fhir(index)
+        # conditions in a cycle fail the conversion here
+        visibility = questionnaire_generator.visibility_graph(fhir_questionnaire["url"])
+
+    # before we print to file we wish to validate the jsons using fhir resources.
+    # the validated models are what gets written, so each resource is only serialized once
+    valuesets = list(questionnaire_generator.get_value_set().values())
+    codesystems = list(questionnaire_generator.get_code_system().values())
+    resources = [fhir_questionnaire] + valuesets + codesystems
+    with timer.stage("validate"):
+        validated = validate_resources(resources, validate, sample_rate, workers)
+
+    with timer.stage("write"):
+        serialized = [
+            serialize(resource, validated_json)
+            for (resource, validated_json) in zip(resources, validated)
+        ]
+        visibility_json = jsonio.dumps(visibility.to_json())
+
+    return (serialized[0],
+            list(zip(questionnaire_generator.get_value_set(),
+                     serialized[1:1 + len(valuesets)])),
+            list(zip(questionnaire_generator.get_code_system(),
+                     serialized[1 + len(valuesets):])),
+            visibility_json)
+
+
+def terminology_resources(terminology: list, config: Config) -> tuple:
+    """
+    The value sets and code systems, by id, of the (id, concepts, date) of shared code systems
+    """
+    valuesets = dict()
+    codesystems = dict()
+    for (id_str, concepts, date) in terminology:
+        valuesets[id_str] = generate_value_set(id_str, config, date)
+        codesystems[id_str] = code_system_resource(id_str, concepts, config, date)
+    return (valuesets, codesystems)
+
+
+def render_terminology(terminology: list,
+                       config: Config,
+                       validate: str = "full",
+                       sample_rate: float = 0.1,
+                       workers: Optional[int] = None) -> tuple:
+    """
+    Validate and serialize the (id, concepts, date) of shared code systems.
+
+    Returns the (id, json) pairs of their value sets and code systems, see write_shared_terminology.
+    """
+    (valuesets, codesystems) = terminology_resources(terminology, config)
+    resources = list(valuesets.values()) + list(codesystems.values())
+    validated = validate_resources(resources, validate, sample_rate, workers)
+    serialized = [serialize(resource, validated_json)
+                  for (resource, validated_json) in zip(resources, validated)]
+    return (list(zip(valuesets, serialized[:len(valuesets)])),
+            list(zip(codesystems, serialized[len(valuesets):])))
+
+
+def convert_targets(reproschema_folder,
+                    targets: List[Target],
+                    registries: Optional[Dict[str, TerminologyRegistry]] = None,
+                    deterministic: bool = False,
+                    validate: str = "full",
+                    sample_rate: float = 0.1,
+                    workers: Optional[int] = None,
+                    timer: Optional[StageTimer] = None,
+                    item_cache: Optional[ItemCache] = None,
+                    resolver: Optional[Resolver] = None):
+    """
+    Convert a single reproschema activity folder once and write it for every Target.
+
+    The activity is loaded and indexed once and each target renders it with its own config
+    into its own output folder. Items are converted once per language and mode through the
+    item cache, an in-memory one unless one is given, since the URIs of a target are only
+    added to them afterwards. registries holds the registry of each target by name, for
+    targets sharing code systems and value sets across activities.
+
+    Returns the name of the output folders, i.e. the name of the activity.
+    """
+    if timer is None:
+        timer = StageTimer(enabled=False)
+    if item_cache is None:
+        item_cache = ItemCache()
+
+    with timer.stage("load"):
+        reproschema_loader = ReproschemaLoader(reproschema_folder, resolver)
+    with timer.stage("index"):
+        index = ReproschemaIndex.build(reproschema_loader, resolver)
+    date = last_change(reproschema_loader.source) if deterministic else None
+
+    for target in targets:
+        registry = None if registries is None else registries.get(target.name)
+        with claiming(registry):
+            (questionnaire_json, valuesets, codesystems, visibility) = render_resources(
+                index, target.config, registry, date, validate, sample_rate, workers, timer, item_cache)
+            with timer.stage("write"):
+                write_activity_output(
+                    Path(target.output_path), reproschema_loader.name, questionnaire_json,
+                    valuesets, codesystems,
+                    shared=registry is not None and registry.path is not None,
+                    visibility=visibility)
+    return reproschema_loader.name
+
+
+def stream_activity(reproschema_folder,
+                    output_path,
+                    config: Optional[Config] = None,
+                    registry: Optional[TerminologyRegistry] = None,
+                    deterministic: bool = False,
+                    validate: str = "full",
+                    sample_rate: float = 0.1,
+                    timer: Optional[StageTimer] = None,
+                    item_cache: Optional[ItemCache] = None,
+                    resolver: Optional[Resolver] = None):
+    """
+    Convert a single reproschema activity folder, writing the questionnaire one item at a time.
+
+    Each item is loaded, converted, validated on its own as a QuestionnaireItem and written
+    before the next one is read, so neither the item documents, the item list, its json nor
+    a pydantic model of the whole questionnaire are ever held in memory. The header is validated as a Questionnaire
+    without items. parallel validation validates every item in this process, sample a
+    sample_rate share of the items. The value sets and code systems are validated and
+    written afterwards like in convert_activity, as is the visibility graph, and the claims
+    committed.
+
+    Returns the name of the output folder, i.e. the name of the activity.
+    """
+    output_path = Path(output_path)
+    shared = registry is not None and registry.path is not None
+
+    if timer is None:
+        timer = StageTimer(enabled=False)
+
+    with timer.stage("load"):
+        reproschema_loader = ReproschemaLoader(reproschema_folder, resolver, keep_items=False)
+    file_name = reproschema_loader.name
+    with timer.stage("index"):
+        # the items are loaded as they are converted, timed with the convert stage
+        index = ReproschemaIndex.build(reproschema_loader, resolver, lazy=True)
+
+    if config is None:
+        config = Config()
+
+    # the claims of the items are committed once the code systems were written
+    with claiming(registry):
+        with timer.stage("convert"):
+            date = last_change(reproschema_loader.source) if deterministic else None
+            questionnaire_generator = QuestionnaireGenerator(config, registry, date, item_cache)
+            header = questionnaire_generator.questionnaire_header(index.schema)
+            items = questionnaire_generator.iter_reproschema_items(index.iter_items(), index)
+        with timer.stage("validate"):
+            header_json = serialize(header, None if validate == "off" else validate_resource(header))
+
+        rng = random.Random()
+
+        def item_json():
+            while True:
+                with timer.stage("convert"):
+                    item = next(items, None)
+                if item is None:
+                    return
+                validated = None
+                if validate in ("full", "parallel") or (validate == "sample" and rng.random() < sample_rate):
+                    with timer.stage("validate"):
+                        validated = validate_item(item)
+                with timer.stage("write"):
+                    yield serialize(item, validated)
+
+        with timer.stage("write"):
+            prepare_activity_folder(output_path, file_name, shared)
+        # the write stage is timed per item above, the items are converted while the file is open.
+        # an item which fails to convert or validate leaves no half written questionnaire behind
+        questionnaire_path = output_path / f"{file_name}/{file_name}.json"
+        partial_path = questionnaire_path.with_name(questionnaire_path.name + ".partial")
+        try:
+            with open(partial_path, "wb") as f:
+                write_questionnaire_stream(f, header_json, item_json())
+            with timer.stage("convert"):
+                visibility = questionnaire_generator.visibility_graph(header["url"])
+        except BaseException:
+            partial_path.unlink()
+            raise
+        os.replace(partial_path, questionnaire_path)
+
+        # the terminology of every item is known once the last item was converted
+        valuesets = list(questionnaire_generator.get_value_set().values())
+        codesystems = list(questionnaire_generator.get_code_system().values())
+        resources = valuesets + codesystems
+        with timer.stage("validate"):
+            validated = validate_resources(resources, validate, sample_rate)
+        with timer.stage("write"):
+            serialized = [serialize(resource, validated_json)
+                          for (resource, validated_json) in zip(resources, validated)]
+            write_terminology(output_path, file_name,
+                              list(zip(questionnaire_generator.get_value_set(),
+                                       serialized[:len(valuesets)])),
+                              list(zip(questionnaire_generator.get_code_system(),
+                                       serialized[len(valuesets):])),
+                              shared)
+            write_visibility(output_path, file_name, jsonio.dumps(visibility.to_json()))
+
+    return file_name
+
+
+def prepare_activity_folder(output_path: Path, file_name: str, shared: bool = False):
+    """
+    Replace the activity's output folder with empty folders for its resources
+    """
+    dirpath = Path(output_path / f"{file_name}")
+    if dirpath.exists() and dirpath.is_dir():
+        shutil.rmtree(dirpath)
+
+    paths = [
+        output_path / file_name,
+        output_path / f"{file_name}/valuesets/",
+        output_path / f"{file_name}/codesystems/"
+    ]
+    if shared:
+        paths = [output_path / file_name]
+
+    for folder in paths:
+        folder.mkdir(parents=True, exist_ok=True)
+
+
+def write_activity_output(output_path: Path,
+                          file_name: str,
+                          questionnaire_json: bytes,
+                          valuesets: list,
+                          codesystems: list,
+                          shared: bool = False,
+                          visibility: Optional[bytes] = None):
+    """
+    Write the questionnaire, the (id, json) pairs of its value sets and code systems and
+    the json of its visibility graph.
+
+    The activity's folder is replaced. Shared value sets and code systems are written to
+    the shared folders instead, see write_shared_terminology.
+    """
+    prepare_activity_folder(output_path, file_name, shared)
+
+    with open(output_path / f"{file_name}/{file_name}.json", "wb") as f:
+        f.write(questionnaire_json)
+
+    write_terminology(output_path, file_name, valuesets, codesystems, shared)
+    if visibility is not None:
+        write_visibility(output_path, file_name, visibility)
+
+
+def write_visibility(output_path: Path, file_name: str, visibility: bytes):
+    """
+    Write the json of an activity's visibility graph next to its questionnaire
+    """
+    with open(output_path / f"{file_name}/{file_name}.visibility.json", "wb") as f:
+        f.write(visibility)
+
+
+def write_terminology(output_path: Path,
+                      file_name: str,
+                      valuesets: list,
+                      codesystems: list,
+                      shared: bool = False):
+    """
+    Write the (id, json) pairs of an activity's value sets and code systems to its folder,
+    or to the shared folders
+    """
+    # write out valuesets and codesystems which have been updated in the generator object
+    if shared:
+        write_shared_terminology(valuesets, codesystems, output_path)
+        return
+
+    valueset_count = 1
+    for (valueset_id, valueset) in valuesets:
+        with open(output_path / f"{file_name}/valuesets/{file_name}-valueset-{valueset_count}.json", "wb") as f:
+            f.write(valueset)
+        valueset_count += 1
+
+    codesystem_count = 1
+    for (codesystem_id, codesystem) in codesystems:
+        with open(output_path / f"{file_name}/codesystems/{file_name}-codesystem-{codesystem_count}.json", "wb") as f:
+            f.write(codesystem)
+        codesystem_count += 1
+
+
+def write_shared_terminology(valuesets, codesystems, output_path: Path):
+    """
+    Write (id, json) pairs of value sets and code systems to the shared folders
+    """
+    for folder, resources in (("valuesets", valuesets),
+                              ("codesystems", codesystems)):
+        (output_path / folder).mkdir(parents=True, exist_ok=True)
+        for resource_id, resource in resources:
+            with open(output_path / folder / f"{resource_id}.json", "wb") as f:
+                f.write(resource)
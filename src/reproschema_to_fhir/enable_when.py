@@ -0,0 +1,225 @@
+from functools import lru_cache
+import re as r
+from typing import NamedTuple, Optional, Tuple, Union
+
+ENABLE_WHEN_EXPRESSION_URL = "http://hl7.org/fhir/uv/sdc/StructureDefinition/sdc-questionnaire-enableWhenExpression"
+
+# the exact order of the alternatives matters as otherwise '<' will be parsed instead of of '<='
+_TOKEN = r.compile(
+    r"""\s*(?:
+        (?P<and>&&|\band\b)
+        |(?P<or>\|\||\bor\b)
+        |(?P<op>!\s*==|!=|==|>=|<=|=|>|<)
+        |(?P<lparen>\()
+        |(?P<rparen>\))
+        |(?P<string>"[^"]*"|'[^']*')
+        |(?P<word>[^\s()=!<>&|"']+)(?P<suffix>(?:\([^()]*\))*)
+    )""", r.VERBOSE)
+
+
+class Condition(NamedTuple):
+    """
+    A single comparison, eg. item_1 > 1
+    """
+    question: str
+    operator: str
+    answer: str
+
+
+class AllOf(NamedTuple):
+    conditions: tuple
+
+
+class AnyOf(NamedTuple):
+    conditions: tuple
+
+
+Node = Union[Condition, AllOf, AnyOf]
+
+
+def tokenize(condition: str) -> list:
+    """
+    Splits an isVis string into (kind, text) tokens
+    """
+    tokens = []
+    position = 0
+    condition = condition.strip()
+    while position < len(condition):
+        match = _TOKEN.match(condition, position)
+        if match is None or match.end() == position:
+            raise ValueError(
+                f"Unable to parse condition {condition!r} at position {position}")
+        kind = match.lastgroup if match.lastgroup != "suffix" else "word"
+        # parentheses directly after a name are left over from the redcap csv, eg. item_1(placeholder)
+        text = match.group("word") if kind == "word" else match.group(kind)
+        if kind == "string":
+            kind, text = "word", text[1:-1]
+        tokens.append((kind, text))
+        position = match.end()
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent parser for isVis, where && binds tighter than ||
+
+        expression := conjunction ("||" conjunction)*
+        conjunction := atom ("&&" atom)*
+        atom := "(" expression ")" | word operator word
+    """
+
+    def __init__(self, condition: str):
+        self.condition = condition
+        self.tokens = tokenize(condition)
+        self.position = 0
+
+    def peek(self) -> Optional[str]:
+        if self.position < len(self.tokens):
+            return self.tokens[self.position][0]
+        return None
+
+    def take(self, kind: str) -> str:
+        if self.peek() != kind:
+            raise ValueError(
+                f"Unable to parse condition {self.condition!r}: expected {kind}")
+        text = self.tokens[self.position][1]
+        self.position += 1
+        return text
+
+    def parse(self) -> Node:
+        node = self.expression()
+        if self.peek() is not None:
+            raise ValueError(
+                f"Unable to parse condition {self.condition!r}: unexpected {self.tokens[self.position][1]!r}")
+        return node
+
+    def expression(self) -> Node:
+        nodes = [self.conjunction()]
+        while self.peek() == "or":
+            self.take("or")
+            nodes.append(self.conjunction())
+        return _combine(AnyOf, nodes)
+
+    def conjunction(self) -> Node:
+        nodes = [self.atom()]
+        while self.peek() == "and":
+            self.take("and")
+            nodes.append(self.atom())
+        return _combine(AllOf, nodes)
+
+    def atom(self) -> Node:
+        if self.peek() == "lparen":
+            self.take("lparen")
+            node = self.expression()
+            self.take("rparen")
+            return node
+        question = self.take("word")
+        operator = r.sub(r"\s", "", self.take("op"))
+        answer = self.take("word")
+        if operator == "==":
+            operator = "="
+        elif operator == "!==":
+            operator = "!="
+
+        # edge case where in the redcap csv, visibility is based on which button was checked for that specific question.
+        # eg. in confounders current_neuro_dx checks if neurological_history is equal to 1-6.
+        # isVis lists it as neurological_history___{1-6} == 1. We replace the underscores and re-assign question and answerSting
+        if "___" in question:
+            question, answer = r.split(r'___+', question, maxsplit=1)
+        return Condition(question.strip(), operator, answer.strip())
+
+
+def _combine(kind, nodes: list) -> Node:
+    if len(nodes) == 1:
+        return nodes[0]
+    # (a && b) && c is the same as a && b && c
+    flat = []
+    for node in nodes:
+        if isinstance(node, kind):
+            flat.extend(node.conditions)
+        else:
+            flat.append(node)
+    return kind(tuple(flat))
+
+
+def parse_condition(condition: str) -> Node:
+    """
+    Parses an isVis string into a tree of Condition, AllOf and AnyOf nodes
+    """
+    return _Parser(condition).parse()
+
+
+def _fhirpath(node: Node) -> str:
+    if isinstance(node, Condition):
+        answers = (f"%resource.repeat(item).where(linkId='{node.question}')"
+                   ".answer.value.select(code | $this.toString())")
+        answer = node.answer.replace("'", "\\'")
+        if node.operator in (">", "<", ">=", "<=") and r.fullmatch(r"-?\d+(\.\d+)?", answer):
+            return f"{answers}.exists($this.toDecimal() {node.operator} {answer})"
+        return f"{answers}.exists($this {node.operator} '{answer}')"
+    joiner = " and " if isinstance(node, AllOf) else " or "
+    return "(" + joiner.join(_fhirpath(child) for child in node.conditions) + ")"
+
+
+class EnableWhen(NamedTuple):
+    """
+    A compiled isVis condition.
+
+    FHIR enableWhen can only express a single comparison, or a flat list of comparisons
+    which are all ("all") or any ("any") required. Conditions that mix && and || are
+    kept as a FHIRPath expression for the SDC enableWhenExpression extension instead.
+    """
+    node: Node
+    conditions: Tuple[Condition, ...]
+    behavior: str
+    expression: Optional[str]
+
+    def enable_when(self) -> list:
+        return [{
+            "question": condition.question,
+            "operator": condition.operator,
+            "answerString": condition.answer
+        } for condition in self.conditions]
+
+    def apply(self, fhir_item: dict):
+        """
+        Adds the enableWhen, enableBehavior or enableWhenExpression to a FHIR questionnaire item
+        """
+        if self.expression is not None:
+            fhir_item.setdefault("extension", []).append({
+                "url": ENABLE_WHEN_EXPRESSION_URL,
+                "valueExpression": {
+                    "language": "text/fhirpath",
+                    "expression": self.expression
+                }
+            })
+            return
+        fhir_item["enableWhen"] = self.enable_when()
+        if self.behavior != "None":
+            fhir_item["enableBehavior"] = self.behavior
+
+
+@lru_cache(maxsize=4096)
+def compile_condition(condition: str) -> EnableWhen:
+    """
+    Parses an isVis string once and caches the result, the same conditions
+    repeat across many items and activities.
+    """
+    node = parse_condition(condition)
+    if isinstance(node, Condition):
+        return EnableWhen(node, (node, ), "None", None)
+
+    behavior = "all" if isinstance(node, AllOf) else "any"
+    if all(isinstance(child, Condition) for child in node.conditions):
+        return EnableWhen(node, node.conditions, behavior, None)
+
+    # mixed && and ||, keep every comparison but the behavior alone cannot express it
+    conditions = []
+    pending = [node]
+    while pending:
+        current = pending.pop(0)
+        if isinstance(current, Condition):
+            conditions.append(current)
+        else:
+            pending[0:0] = list(current.conditions)
+    return EnableWhen(node, tuple(conditions), behavior, _fhirpath(node))
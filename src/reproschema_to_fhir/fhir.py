@@ -2,59 +2,53 @@ from abc import ABC, abstractmethod
 import os
 import json
 from collections import OrderedDict
+from collections.abc import Mapping
 from typing import Optional
-from pathlib import Path
 
-from fhir.resources.questionnaire import Questionnaire
-from fhir.resources.valueset import ValueSet
-from fhir.resources.codesystem import CodeSystem
 from datetime import datetime, timezone
 
 from .config import Config
-import re as r
+from .enable_when import compile_condition
+from .index import ReproschemaIndex
+from .item_cache import ItemCache
+from .loader import ReproschemaLoader
+from .registry import TerminologyRegistry, concept_fingerprint
+from .visibility import VisibilityGraph
 
 def add_enable_when(condition: str):
     """
     Parses condition string and returns the enablewhen json
+
+    Conditions which mix && and || cannot be expressed by enableWhen alone, for those
+    the comparisons are returned with the behavior of the outermost operator. Use
+    compile_condition(...).apply(item) to get the enableWhenExpression instead.
+    """
+    compiled = compile_condition(condition)
+    return (compiled.enable_when(), compiled.behavior)
+
+
+TRANSLATION_URL = "http://hl7.org/fhir/StructureDefinition/translation"
+
+
+def localized(texts: dict, config):
+    """
+    The text of a {language: text} map in the first language of the config's language chain it has
+    """
+    for language in config.get_language_chain():
+        if language in texts:
+            return texts[language]
+    raise KeyError(config.get_language())
+
+
+def add_translation(element: dict, key: str, language: str, text: str):
     """
-    enable_when = []
-    behave = "None"
-    condition = condition.replace("\n", "")
-    if "||" in condition or " or" in condition:
-        behave = "any"
-    elif "&&" in condition or " and " in condition:
-        behave = "all"
-
-    # we are trying to clean up the condition string so we can apply regex to it
-    # special characters like '||' is a regex specific character so we replace it with ' or '
-    condition = condition.replace(" or", " or ")
-    condition = condition.replace("\"", "")
-    condition = condition.replace("||", " or ")
-    condition = condition.replace("! == ", "!=")
-
-    condition = r.split(r'&&|and | or ', condition)
-
-    for i in condition:
-        # the exact order of the regex matters as otherwise '<' will be parsed instead of of '<='
-        (id, operator, ans) = r.split(r'(==|>=|<=|!=|>|<)', i)
-        if operator == "==":
-            operator = "="
-        # regex to that removes parentheses left over from the redcap csv
-        # id's should now match
-        id = r.sub(r'\([^()]*\)', '', id.strip())
-
-        # edge case where in the redcap csv, visibility is based on which button was checked for that specific question.
-        # eg. in confounders current_neuro_dx checks if neurological_history is equal to 1-6.
-        # isVis lists it as neurological_history___{1-6} == 1. We replace the underscores and re-assign question and answerSting
-        if "___" in id:
-            id, ans = r.split(r'___+', id)
-        enable_when.append({
-            "question": id.strip(),
-            "operator": operator.strip(),
-            "answerString": ans.strip()
-        })
-
-    return (enable_when, behave)
+    Add the translation of element[key] as a FHIR translation extension on element["_" + key]
+    """
+    element.setdefault(f"_{key}", {}).setdefault("extension", []).append({
+        "url": TRANSLATION_URL,
+        "extension": [{"url": "lang", "valueCode": language},
+                      {"url": "content", "valueString": text}],
+    })
 
 
 def add_options(options_json, config) -> list:
@@ -77,10 +71,9 @@ def add_options(options_json, config) -> list:
         else:
             choice = j["value"]
 
-        if (choice and not isinstance(choice, int)
-                and config.get_language() in choice
-                and isinstance(choice, dict)):
-            choice = choice[config.get_language()]
+        if (isinstance(choice, dict) and
+                any(language in choice for language in config.get_language_chain())):
+            choice = localized(choice, config)
 
         choice = str(choice).strip()
         if choice != "":
@@ -88,48 +81,32 @@ def add_options(options_json, config) -> list:
     return options
 
 
-def generate_code_system(options_json, id_str: str, config) -> dict:
+def option_answers(options_json, config) -> dict:
     """
-    Helper function to generate a FHIR CodeSystem resource from a reproschema options json.
+    Maps the value of each choice to the valueString answer of its answerOption
     """
-    codeSystem = dict()
-    if config.get_mode() == "ValueSet":
-        # default headers for codesystem
-
-        codeSystem["resourceType"] = "CodeSystem"
-        codeSystem["id"] = id_str
-        codeSystem["text"] = {
-            "status": "generated",
-            "div":
-            '<div xmlns="http://www.w3.org/1999/xhtml">Placeholder</div>',
-        }
-
-        codeSystem["url"] = f"{config.get_codesystem()}{id_str}"
-        codeSystem["version"] = "1.4.0"
-        codeSystem["name"] = id_str.capitalize().replace("_", "")
-        codeSystem["title"] = id_str
-        codeSystem["status"] = "active"
-        codeSystem["date"] = (datetime.now(
-            timezone.utc)).strftime('%Y-%m-%dT%H:%M:%SZ')
-        codeSystem["publisher"] = "KinD Lab"
-        codeSystem["contact"] = [{
-            "name":
-            "KinD Lab",
-            "telecom": [{
-                "system": "url",
-                "value": "http://fhir.kindlab.sickkids.ca"
-            }],
-        }]
+    answers = dict()
+    count = 1
+    for j in options_json["choices"]:
+        # the same code as generate_code_system gives the choice
+        if "schema:value" in j and j["schema:value"] is not None:
+            value = str(j["schema:value"]).lstrip()
+        elif "value" in j and j["value"] is not None:
+            value = str(j["value"]).lstrip()
+        else:
+            value = str(count)
+        display = add_options({"choices": [j]}, config)
+        if display:
+            answers[value] = {"valueString": display[0]}
+        count += 1
+    return answers
 
-        codeSystem["description"] = id_str
-        codeSystem["caseSensitive"] = True
-        codeSystem["content"] = "complete"
-        codeSystem["count"] = len(options_json["choices"])
-        codeSystem["concept"] = []
-    else:
-        return codeSystem
 
-    options = add_options(options_json, config)
+def code_system_concepts(options_json, options: list) -> list:
+    """
+    The concepts of the CodeSystem of a reproschema options json, with the options as displays
+    """
+    concepts = []
     # we wish to retrieve each option stored in the reproschema json list. We do this by parsing the list
     # of jsons and append then contents to an outlined codesystem
     count = 1
@@ -138,25 +115,93 @@ def generate_code_system(options_json, id_str: str, config) -> dict:
 
         codeSystem_option = dict()
 
-        if config.get_mode() == "ValueSet":
-            # we parse to string and lsstrip as fhir codes don't allow leading whitespaces
-            if "schema:value" in j and j["schema:value"] is not None:
-                codeSystem_option["code"] = str(j[f"schema:value"]).lstrip()
-            elif "value" in j and j["value"] is not None:
-                codeSystem_option["code"] = str(j["value"]).lstrip()
-            else:
-                codeSystem_option[f"code"] = count
-            codeSystem_option[f"display"] = str(options[count - 1])
+        # we parse to string and lsstrip as fhir codes don't allow leading whitespaces
+        if "schema:value" in j and j["schema:value"] is not None:
+            codeSystem_option["code"] = str(j[f"schema:value"]).lstrip()
+        elif "value" in j and j["value"] is not None:
+            codeSystem_option["code"] = str(j["value"]).lstrip()
+        else:
+            codeSystem_option[f"code"] = count
+        codeSystem_option[f"display"] = str(options[count - 1])
 
-            codeSystem[f"concept"].append(codeSystem_option)
+        concepts.append(codeSystem_option)
         count += 1
+    return concepts
+
+
+def generate_code_system(options_json,
+                         id_str: str,
+                         config,
+                         date: Optional[datetime] = None,
+                         options: Optional[list] = None) -> dict:
+    """
+    Helper function to generate a FHIR CodeSystem resource from a reproschema options json.
+
+    The date of the resource is the current time unless a date is given. The displays are
+    the add_options of the options json unless they are given.
+    """
+    if config.get_mode() != "ValueSet":
+        return dict()
+
+    if options is None:
+        options = add_options(options_json, config)
+    return (code_system_resource(id_str, code_system_concepts(options_json, options), config, date),
+            options)
+
+
+def code_system_resource(id_str: str,
+                         concepts: list,
+                         config,
+                         date: Optional[datetime] = None) -> dict:
+    """
+    Helper function to generate a FHIR CodeSystem resource from its concepts
+
+    The date of the resource is the current time unless a date is given.
+    """
+    codeSystem = dict()
+    # default headers for codesystem
+
+    codeSystem["resourceType"] = "CodeSystem"
+    codeSystem["id"] = id_str
+    codeSystem["text"] = {
+        "status": "generated",
+        "div":
+        '<div xmlns="http://www.w3.org/1999/xhtml">Placeholder</div>',
+    }
+
+    codeSystem["url"] = f"{config.get_codesystem()}{id_str}"
+    codeSystem["version"] = "1.4.0"
+    codeSystem["name"] = id_str.capitalize().replace("_", "")
+    codeSystem["title"] = id_str
+    codeSystem["status"] = "active"
+    codeSystem["date"] = (date or datetime.now(
+        timezone.utc)).strftime('%Y-%m-%dT%H:%M:%SZ')
+    codeSystem["publisher"] = "KinD Lab"
+    codeSystem["contact"] = [{
+        "name":
+        "KinD Lab",
+        "telecom": [{
+            "system": "url",
+            "value": "http://fhir.kindlab.sickkids.ca"
+        }],
+    }]
 
-    return (codeSystem, options)
+    codeSystem["description"] = id_str
+    codeSystem["caseSensitive"] = True
+    codeSystem["content"] = "complete"
+    codeSystem["count"] = len(concepts)
+    codeSystem["concept"] = concepts
 
+    return codeSystem
 
-def generate_value_set(id_str: str, config) -> dict:
+
+def generate_value_set(id_str: str,
+                       config,
+                       date: Optional[datetime] = None) -> dict:
     """
     Helper function that generates a FHIR valueset for a given question
+
+    The date of the resource is today unless a date is given.
     """
     valueset = dict()
     if config.get_mode() != "ValueSet":
@@ -174,7 +219,7 @@ def generate_value_set(id_str: str, config) -> dict:
     valueset["name"] = id_str.capitalize().replace("_", "")
     valueset["title"] = id_str
     valueset["status"] = "active"
-    valueset["date"] = str(datetime.today().strftime('%Y-%m-%d'))
+    valueset["date"] = str((date or datetime.today()).strftime('%Y-%m-%d'))
     valueset["publisher"] = f"KinD Lab"
     valueset["contact"] = [{
         "name":
@@ -201,11 +246,30 @@ class Generator(ABC):
     Abstract base class for FHIR resource generator.
     """
 
-    def __init__(self, config: Config):
+    def __init__(self,
+                 config: Config,
+                 registry: Optional[TerminologyRegistry] = None,
+                 date: Optional[datetime] = None,
+                 item_cache: Optional[ItemCache] = None):
         self.config: Config = config
-        self.code_system_options: dict = {}
+        # pins the date of every resource, eg. to the last change of the input, instead of now
+        self.date: Optional[datetime] = date
+        # maps the fingerprint of each code system's (code, display) pairs to its canonical id
+        self.registry: TerminologyRegistry = registry if registry is not None else TerminologyRegistry()
+        # converted items shared with other generators, eg. by every activity of a batch run
+        self.item_cache: Optional[ItemCache] = item_cache
         self.code_system: dict = {}
         self.value_set: dict = {}
+        # concepts of every code system used, new or shared, by id
+        self.concepts: dict = {}
+        # linkId: (item type, {response value: fhir answer}) of every converted item
+        self.answer_table: dict = {}
+        # {response value: fhir answer} of each code system, shared by the items using it
+        self.coded_answers: dict = {}
+        # (linkId, enable condition or None, parent linkId) of every converted item, see visibility_graph
+        self.enable_conditions: list = []
+        # generators of the translation languages, by language
+        self.translators: dict = {}
 
     def get_code_system(self):
         return self.code_system
@@ -213,24 +277,240 @@ class Generator(ABC):
     def get_value_set(self):
         return self.value_set
 
+    def register_code_system(self, options_json, id_str: str, options: Optional[list] = None,
+                             concepts: Optional[list] = None, fingerprint: Optional[str] = None):
+        """
+        Returns the id of the canonical code system for the options and the options.
+
+        Only the first time the content of a code system is seen, by this generator or any
+        other sharing the registry, is the code system added to self.code_system. When the
+        options, concepts and fingerprint are known, e.g. from the item cache, the code system
+        is only generated when it is new.
+        """
+        code_system = None
+        if options is None or concepts is None:
+            (code_system, options) = generate_code_system(options_json, id_str,
+                                                          self.config, self.date, options)
+            concepts = code_system["concept"]
+        if fingerprint is None:
+            fingerprint = concept_fingerprint(concepts)
+        (codesystem_id, is_new) = self.registry.claim(fingerprint, id_str, concepts)
+        if is_new:
+            if code_system is None or codesystem_id != id_str:
+                # not generated yet, or id_str is taken by a code system with different content
+                code_system = code_system_resource(codesystem_id, concepts, self.config, self.date)
+            # the given concepts may have translated designations
+            code_system["concept"] = concepts
+            self.code_system[codesystem_id] = code_system
+        # the content of a shared code system is the same as the one generated here
+        self.concepts[codesystem_id] = concepts
+        return (codesystem_id, options)
+
 
 class QuestionnaireGenerator(Generator):
     """
     Class for generating FHIR questionnaire resource.
     """
 
+    def visibility_graph(self, questionnaire_url: Optional[str] = None) -> VisibilityGraph:
+        """
+        The dependency graph of the enable conditions of the items converted so far.
+
+        Raises a VisibilityError when the conditions depend on each other in a cycle,
+        conditions on items which are not in the questionnaire are warnings of the graph.
+        """
+        return VisibilityGraph(self.enable_conditions, questionnaire_url)
+
     @classmethod
     def from_dict(cls, questionnaire_dict: dict):
         """
         Parse a dictionary into a FHIR questionnaire resource.
         """
+        # the pydantic models are slow to import and only needed here
+        from fhir.resources.questionnaire import Questionnaire
         questionnaire = Questionnaire.parse_raw(questionnaire_dict)
         return questionnaire
 
     def parse_reproschema_items(self, reproschema_items: OrderedDict,
                                 reproschema_content: OrderedDict):
         """
-        Helper function to parse reproschema items into fhir items
+        Helper function to parse reproschema items into a list of fhir items, see iter_reproschema_items
+        """
+        return list(self.iter_reproschema_items(reproschema_items, reproschema_content))
+
+    def convert_item(self, var_name: str, item_json: dict, options_json: Optional[dict]) -> dict:
+        """
+        Converts what of a reproschema item only depends on the item, its resolved options,
+        the languages and the mode, through the item cache when there is one.
+
+        Returns the fragment {"item": fhir item, "options": option displays, "concepts" and
+        "fingerprint" of its code system, "answers": answerOption answers}, with None for
+        what the item does not have, see ItemCache.
+        """
+        if self.item_cache is None:
+            return self._translated_item(var_name, item_json, options_json)
+        key = ItemCache.key(var_name, item_json, options_json,
+                            self.config.get_language(), self.config.get_mode(),
+                            self.config.get_translations(), self.config.LANGUAGE_FALLBACK)
+        fragment = self.item_cache.get(key)
+        if fragment is None:
+            fragment = self._translated_item(var_name, item_json, options_json)
+            self.item_cache.put(key, fragment)
+        return fragment
+
+    def translator(self, language: str) -> "QuestionnaireGenerator":
+        """
+        A generator converting items into a translation language, see Config.for_language
+        """
+        if language not in self.translators:
+            self.translators[language] = QuestionnaireGenerator(self.config.for_language(language))
+        return self.translators[language]
+
+    def _translated_item(self, var_name: str, item_json: dict, options_json: Optional[dict]) -> dict:
+        # the item is converted once per translation language from the same parsed documents,
+        # and what differs from the language of the questionnaire is added as translations
+        fragment = self._convert_item(var_name, item_json, options_json)
+        item = fragment["item"]
+        for language in self.config.get_translations():
+            translated = self.translator(language)._convert_item(var_name, item_json, options_json)
+            if "text" in item and translated["item"].get("text", item["text"]) != item["text"]:
+                add_translation(item, "text", language, translated["item"]["text"])
+            for (option, translated_option) in zip(item.get("answerOption", []),
+                                                   translated["item"].get("answerOption", [])):
+                if translated_option["valueString"] != option["valueString"]:
+                    add_translation(option, "valueString", language, translated_option["valueString"])
+            for (concept, translated_concept) in zip(fragment["concepts"] or [],
+                                                     translated["concepts"] or []):
+                if translated_concept["display"] != concept["display"]:
+                    concept.setdefault("designation", []).append(
+                        {"language": language, "value": translated_concept["display"]})
+        if fragment["concepts"] is not None and self.config.get_translations():
+            fragment["fingerprint"] = concept_fingerprint(fragment["concepts"])
+        return fragment
+
+    def _convert_item(self, var_name: str, item_json: dict, options_json: Optional[dict]) -> dict:
+        curr_item = dict()
+        curr_item["linkId"] = var_name
+
+        item_type = "string"
+        if "inputType" in item_json["ui"]:
+            if item_json["ui"]["inputType"] == "radio":
+                item_type = f"choice"
+            elif item_json["ui"]["inputType"] in ("number", "xsd:int"):
+                item_type = "integer"
+            elif item_json["ui"]["inputType"] in ("audioImageRecord", "audioRecord"):
+                item_type = f"attachment"
+            else:
+                item_type = "string"
+
+        curr_item["type"] = item_type
+        preamble = ""
+        if "preamble" in item_json and isinstance(item_json["preamble"], dict):
+            preamble = localized(item_json["preamble"], self.config)
+        elif "preamble" in item_json and isinstance(item_json["preamble"], str):
+            preamble = item_json["preamble"]
+
+        if preamble != "":
+            preamble = f"{preamble}: "
+
+        if "question" in item_json and isinstance(item_json["question"],
+                                                  dict):
+            curr_item["text"] = preamble + str(
+                localized(item_json["question"], self.config))
+
+        elif f"prefLabel" in item_json:
+            curr_item["text"] = str(item_json["prefLabel"])
+        else:
+            curr_item[f"text"] = curr_item[f"linkId"]
+
+        # displays of the choices, the code system of the value set is made from them
+        options = None
+
+        if "responseOptions" in item_json:
+            # FOR VERSION 1.0.0
+            if isinstance(item_json["responseOptions"], str):
+                options = add_options(options_json, self.config)
+                if (self.config.get_mode() == "AnswerOptions"):
+                    curr_item["linkId"] = var_name
+                    curr_item["type"] = "string"
+                    if "question" in item_json:
+                        curr_item["text"] = preamble + str(
+                            localized(item_json["question"], self.config))
+                    else:
+                        curr_item["text"] = preamble
+                    curr_item["answerOption"] = [{
+                        "valueString": option.strip()
+                    } for option in options]
+                    # val(schema_name, var_name, options)
+
+                # VERSION 0.0.1
+            elif isinstance(item_json["responseOptions"], dict):
+                if "choices" not in item_json[
+                        "responseOptions"] or item_json["responseOptions"][
+                            "choices"] is None:
+                    curr_item["linkId"] = var_name
+                    if "valueType" in item_json[
+                            "responseOptions"] and "int" in item_json[
+                                "responseOptions"]["valueType"]:
+                        curr_item[f"type"] = f"integer"
+                    elif "valueType" in item_json[
+                            "responseOptions"] and "date" in item_json[
+                                "responseOptions"]["valueType"]:
+                        curr_item["type"] = "date"
+                    elif "valueType" in item_json[
+                            "responseOptions"] and "audio" in item_json[
+                                "responseOptions"]["valueType"]:
+                        curr_item["type"] = "attachment"
+                    else:
+                        curr_item["type"] = "string"
+                    if "question" not in item_json:
+                        if "prefLabel" in item_json:
+                            curr_item["text"] = preamble + \
+                                str(item_json["prefLabel"])
+                        else:
+                            curr_item["text"] = preamble + \
+                                curr_item["linkId"]
+                    else:
+                        curr_item["text"] = preamble + str(
+                            localized(item_json["question"], self.config))
+                elif "choices" in item_json["responseOptions"]:
+                    options = add_options(options_json, self.config)
+                    curr_item["linkId"] = var_name
+                    curr_item["type"] = "choice"
+                    if "question" in item_json:
+                        curr_item["text"] = preamble + str(
+                            localized(item_json["question"], self.config))
+                    else:
+                        curr_item["text"] = preamble
+
+                    if self.config.get_mode() == "AnswerOptions":
+                        curr_item["answerOption"] = [{
+                            "valueString": option.strip()
+                        } for option in options]
+                        # val(schema_name, id_str, options)
+
+        # the code system is registered by each activity, its concepts are the same for all
+        concepts = None
+        fingerprint = None
+        if self.config.get_mode() == "ValueSet" and options is not None:
+            concepts = code_system_concepts(options_json, options)
+            fingerprint = concept_fingerprint(concepts)
+
+        # how the values of reproschema responses become fhir answers, see responses.py
+        answers = None
+        if "answerOption" in curr_item and options_json is not None:
+            answers = option_answers(options_json, self.config)
+        return {"item": curr_item, "options": options, "concepts": concepts,
+                "fingerprint": fingerprint, "answers": answers}
+
+    def iter_reproschema_items(self, reproschema_items: OrderedDict,
+                               reproschema_content: OrderedDict):
+        """
+        Generator of the fhir items of reproschema items, one at a time
+
+        reproschema_items is a dict of item path: document, or an iterable of (path, document)
+        pairs such as ReproschemaIndex.iter_items. The code systems and value sets of an item
+        are registered by the time it is yielded.
 
         Example of reproschema_items content:
 
@@ -249,199 +529,180 @@ class QuestionnaireGenerator(Generator):
         # there are a few possibilities for responses presented by reproschema:
         # 1. responseOptions is a string, which is a reference to a file with the responses
         # 2. responseOptions is a dict, which is a list of options
-        items = []
-        schema_name = [
-            name for name in list(reproschema_content.keys())
-            if name.endswith("_schema")
-        ][0]
-        question_visibility = dict()
-
-        reproschema_schema_properties = reproschema_content[schema_name]["ui"]["addProperties"]
-        for property in reproschema_schema_properties:
-            question_visibility[property["variableName"]] = property["isVis"]
-
-        for item_path, item_json in reproschema_items.items():
-            curr_item = dict()
+        if isinstance(reproschema_content, ReproschemaIndex):
+            index = reproschema_content
+        else:
+            index = ReproschemaIndex.build(reproschema_content)
+        question_visibility = index.visibility
 
+        if isinstance(reproschema_items, Mapping):
+            reproschema_items = reproschema_items.items()
+        for item_path, item_json in reproschema_items:
             var_name = item_path.replace("items/", "")
-            curr_item["linkId"] = var_name
-
-            item_type = "string"
-            if "inputType" in item_json["ui"]:
-                if item_json["ui"]["inputType"] == "radio":
-                    item_type = f"choice"
-                elif item_json["ui"]["inputType"] in ("number", "xsd:int"):
-                    item_type = "integer"
-                elif item_json["ui"]["inputType"] in ("audioImageRecord", "audioRecord"):
-                    item_type = f"attachment"
-                else:
-                    item_type = "string"
-
-            curr_item["type"] = item_type
-            preamble = ""
-            if "preamble" in item_json and isinstance(item_json["preamble"], dict):
-                preamble = item_json["preamble"][self.config.get_language()]
-            elif "preamble" in item_json and isinstance(item_json["preamble"], str):
-                preamble = item_json["preamble"]
-
-            if preamble != "":
-                preamble = f"{preamble}: "
-
-            if "question" in item_json and isinstance(item_json["question"],
-                                                      dict):
-                curr_item["text"] = preamble + str(
-                    item_json["question"][self.config.get_language()])
-
-            elif f"prefLabel" in item_json:
-                curr_item["text"] = str(item_json["prefLabel"])
-            else:
-                curr_item[f"text"] = curr_item[f"linkId"]
-
-            # now we prepare the ValueSet used for the response options
-            # prepare the valueset
-            value_set = None
-            code_system = None
             # id must be 64 characters
             id_str: str = var_name
             id_str = id_str.replace("_", "-")
             id_str = id_str.lower()
 
-            if "responseOptions" in item_json:
+            options_json = None
+            response_options = item_json.get("responseOptions")
+            if isinstance(response_options, str):
                 # FOR VERSION 1.0.0
-                if isinstance(item_json["responseOptions"], str):
-                    # resolve the path relative to the items folder to load in the dict
-                    codesystem_id_for_valueset = id_str
-                    options_path = Path(
-                        item_path).parent / item_json['responseOptions']
-                    options_path = options_path.resolve()
-
-                    options_json = reproschema_content[(
-                        str(options_path)).split("/")[-1]]
-
-                    if (self.config.get_mode() == "ValueSet"):
-                        # create a code system for this
-                        (code_system, options) = generate_code_system(
-                            options_json, id_str, self.config)
-                        if tuple(options) not in self.code_system_options:
-                            self.code_system_options[tuple(options)] = id_str
-                            self.code_system[id_str] = code_system
-                        else:
-                            codesystem_id_for_valueset = self.code_system_options[
-                                tuple(options)]
-                            curr_item["linkId"] = var_name
-                            curr_item["type"] = "string"
-                            curr_item["text"] = preamble + str(item_json["question"][
-                                self.config.get_language()])
-                    elif (self.config.get_mode() == "AnswerOptions"):
-                        options = add_options(options_json, self.config)
-                        curr_item["linkId"] = var_name
-                        curr_item["type"] = "string"
-                        if "question" in item_json:
-                            curr_item["text"] = preamble + str(
-                                item_json["question"][self.config.get_language()])
-                        else:
-                            curr_item["text"] = preamble
-                        curr_item["answerOption"] = [{
-                            "valueString": option.strip()
-                        } for option in options]
-                        # val(schema_name, var_name, options)
-
-                    # VERSION 0.0.1
-                elif isinstance(item_json["responseOptions"], dict):
-                    # we wish to avoid making identical codesystems. we assume the codesystem
-                    # we are making doesnt exist yet. Later when we find out it already exists,
-                    # we overright the codesystem_id_for_valueset to the codesystem that matches
-                    codesystem_id_for_valueset = id_str
-                    if "choices" not in item_json[
-                            "responseOptions"] or item_json["responseOptions"][
-                                "choices"] is None:
-                        curr_item["linkId"] = var_name
-                        if "valueType" in item_json[
-                                "responseOptions"] and "int" in item_json[
-                                    "responseOptions"]["valueType"]:
-                            curr_item[f"type"] = f"integer"
-                        elif "valueType" in item_json[
-                                "responseOptions"] and "date" in item_json[
-                                    "responseOptions"]["valueType"]:
-                            curr_item["type"] = "date"
-                        elif "valueType" in item_json[
-                                "responseOptions"] and "audio" in item_json[
-                                    "responseOptions"]["valueType"]:
-                            curr_item["type"] = "attachment"
-                        else:
-                            curr_item["type"] = "string"
-                        if "question" not in item_json:
-                            if "prefLabel" in item_json:
-                                curr_item["text"] = preamble + \
-                                    str(item_json["prefLabel"])
-                            else:
-                                curr_item["text"] = preamble + \
-                                    curr_item["linkId"]
-                        else:
-                            curr_item["text"] = preamble + str(item_json["question"][
-                                self.config.get_language()])
-                        code_system = None
-                    elif "choices" in item_json["responseOptions"]:
-                        options_json = item_json["responseOptions"]
-                        options = add_options(options_json, self.config)
-                        curr_item["linkId"] = var_name
-                        curr_item["type"] = "choice"
-                        if "question" in item_json:
-                            curr_item["text"] = preamble + str(
-                                item_json["question"][self.config.get_language()])
-                        else:
-                            curr_item["text"] = preamble
-
-                        if self.config.get_mode() == "ValueSet":
-                            (code_system, options) = generate_code_system(
-                                options_json, id_str, self.config)
-                            if tuple(options) not in self.code_system_options:
-                                self.code_system_options[tuple(
-                                    options)] = id_str
-                                self.code_system[id_str] = code_system
-                            else:
-                                codesystem_id_for_valueset = self.code_system_options[
-                                    tuple(options)]
-                        elif self.config.get_mode() == "AnswerOptions":
-                            curr_item["answerOption"] = [{
-                                "valueString": option.strip()
-                            } for option in options]
-                            # val(schema_name, id_str, options)
-
-            if self.config.get_mode() == "ValueSet" and code_system is not None:
+                # resolve the path relative to the items folder to load in the dict
+                options_json = index.resolve_options(item_path, response_options)
+            elif isinstance(response_options, dict) and response_options.get("choices") is not None:
+                # VERSION 0.0.1
+                options_json = response_options
+
+            fragment = self.convert_item(var_name, item_json, options_json)
+            # the fragment may be shared through the cache, this item gets its own copy to add to
+            curr_item = dict(fragment["item"])
+
+            # id of the canonical code system of the answers, if any
+            answer_code_system = None
+            if self.config.get_mode() == "ValueSet" and fragment["options"] is not None:
+                # we wish to avoid making identical codesystems. create a code system for
+                # this, or reuse the one with the same codes and displays
+                (codesystem_id_for_valueset, _) = self.register_code_system(
+                    options_json, id_str, fragment["options"], fragment["concepts"],
+                    fragment["fingerprint"])
+                answer_code_system = codesystem_id_for_valueset
+
+            if self.config.get_mode() == "ValueSet" and answer_code_system is not None:
                 value_set = generate_value_set(codesystem_id_for_valueset,
-                                               self.config)
+                                               self.config, self.date)
 
-                if codesystem_id_for_valueset not in self.value_set:
+                # the value set is written next to its code system, once
+                if (codesystem_id_for_valueset in self.code_system and
+                        codesystem_id_for_valueset not in self.value_set):
                     self.value_set[codesystem_id_for_valueset] = value_set
                 curr_item["answerValueSet"] = value_set["url"]
                 curr_item["type"] = "choice"
 
+            enable = None
             if curr_item["linkId"] in question_visibility and isinstance(question_visibility[curr_item["linkId"]], str):
                 isVis = question_visibility[curr_item["linkId"]]
-                (enable_when, behave) = add_enable_when(isVis)
-                curr_item["enableWhen"] = enable_when
-                if behave != "None":
-                    curr_item["enableBehavior"] = behave
-
-            items.append(curr_item)
-        return items
+                enable = compile_condition(isVis)
+                enable.apply(curr_item)
+            self.enable_conditions.append(
+                (curr_item["linkId"], None if enable is None else enable.node, None))
+
+            # how the values of reproschema responses become fhir answers, see responses.py
+            answers = dict()
+            if answer_code_system in self.coded_answers:
+                answers = self.coded_answers[answer_code_system]
+            elif answer_code_system is not None:
+                system = f"{self.config.get_codesystem()}{answer_code_system}"
+                answers = {
+                    str(concept["code"]): {
+                        "valueCoding": {
+                            "system": system,
+                            "code": str(concept["code"]),
+                            "display": concept["display"]
+                        }
+                    }
+                    for concept in self.concepts[answer_code_system]
+                }
+                self.coded_answers[answer_code_system] = answers
+            elif fragment["answers"] is not None:
+                answers = fragment["answers"]
+            self.answer_table[curr_item["linkId"]] = (curr_item["type"], answers)
+
+            yield curr_item
 
     def convert_to_fhir(self, reproschema_content: dict):
         """
         Function used to convert reproschema questionnaire into a fhir json
 
         Input is a dictionary which maps file: dict, where the dict is the loaded in
-        jsonld file.
+        jsonld file, a ReproschemaLoader which loads the files on demand, or a
+        ReproschemaIndex built from either of them.
         """
-        fhir_questionnaire = dict()
+        # the index holds the schema, the ordered items and their response options
+        if isinstance(reproschema_content, ReproschemaIndex):
+            index = reproschema_content
+        else:
+            index = ReproschemaIndex.build(reproschema_content)
+
+        fhir_questionnaire = self.questionnaire_header(index.schema)
+        items = self.parse_reproschema_items(index.items, index)
+
+        fhir_questionnaire["item"] = items
+        return fhir_questionnaire
+
+    def convert_protocol(self, protocol, resolver=None) -> dict:
+        """
+        Convert a reproschema protocol into a single fhir questionnaire with a group item per
+        activity, see activity_group.
+
+        protocol is a Protocol, whose activities are loaded here one after the other. Their
+        code systems and value sets are shared like those of a single activity.
+        """
+        groups = []
+        for activity in protocol.activities:
+            index = ReproschemaIndex.build(ReproschemaLoader(activity.location, resolver), resolver)
+            groups.append(self.activity_group(index, activity.link_id, activity.is_vis))
+        return self.protocol_questionnaire(protocol.schema, groups)
 
-        # reference to the main schema file
-        schema_name = [
-            name for name in list(reproschema_content.keys())
-            if name.endswith("_schema")
-        ][0]
-        reproschema_schema = reproschema_content[schema_name]
+    def activity_group(self, index: ReproschemaIndex, link_id: str, is_vis=True) -> dict:
+        """
+        The group item of an activity in the questionnaire of a protocol
+
+        The group holds the activity's items and is enabled by the isVis of the activity in
+        the protocol. The enable conditions of the items are recorded with the group as their
+        parent, so the visibility graph hides them with it.
+        """
+        first = len(self.enable_conditions)
+        title = index.schema.get("prefLabel", index.schema["id"])
+        group = {"linkId": link_id, "type": "group", "text": str(title)}
+        if isinstance(title, dict):
+            group["text"] = str(localized(title, self.config)) if any(
+                language in title for language in self.config.get_language_chain()) else index.schema["id"]
+            for language in self.config.get_translations():
+                text = title.get(language)
+                if text is not None and str(text) != group["text"]:
+                    add_translation(group, "text", language, str(text))
+        group["item"] = self.parse_reproschema_items(index.items, index)
+        enable = None
+        if isinstance(is_vis, str):
+            enable = compile_condition(is_vis)
+            enable.apply(group)
+        self.enable_conditions[first:] = [(link_id, None if enable is None else enable.node, None)] + [
+            (item_link_id, node, link_id if parent is None else parent)
+            for (item_link_id, node, parent) in self.enable_conditions[first:]
+        ]
+        return group
+
+    def protocol_questionnaire(self, protocol_schema: dict, groups: list) -> dict:
+        """
+        The questionnaire of a protocol from the group items of its activities
+
+        linkIds must be unique in a questionnaire, an item linkId used by two activities
+        raises a ValueError.
+        """
+        owners = dict()
+
+        def walk(items, group):
+            for item in items:
+                if item["linkId"] in owners:
+                    raise ValueError(
+                        f"linkId {item['linkId']} is used by both {owners[item['linkId']]} and {group}, "
+                        "convert the protocol into one questionnaire per activity instead")
+                owners[item["linkId"]] = group
+                walk(item.get("item", []), group)
+
+        for group in groups:
+            walk([group], group["linkId"])
+
+        fhir_questionnaire = self.questionnaire_header(protocol_schema)
+        fhir_questionnaire["item"] = groups
+        return fhir_questionnaire
+
+    def questionnaire_header(self, reproschema_schema: dict) -> dict:
+        """
+        The fhir questionnaire of a reproschema schema without its items
+        """
+        fhir_questionnaire = dict()
 
         reproschema_id = (reproschema_schema["id"]).replace("_", "")
 
@@ -455,7 +716,7 @@ class QuestionnaireGenerator(Generator):
 
         fhir_questionnaire[f"version"] = "1.4.0"
         fhir_questionnaire[f"status"] = "active"
-        fhir_questionnaire[f"date"] = (datetime.now(
+        fhir_questionnaire[f"date"] = (self.date or datetime.now(
             timezone.utc)).strftime('%Y-%m-%dT%H:%M:%SZ')
         fhir_questionnaire[f"publisher"] = f"KinD Lab"
         fhir_questionnaire[f"contact"] = [{
@@ -466,22 +727,4 @@ class QuestionnaireGenerator(Generator):
                 "value": "http://fhir.kindlab.sickkids.ca"
             }],
         }]
-
-
-        # create a pointer to the reproschema_items jsons and match the question
-        reproschema_items = OrderedDict([
-            (i, value) for (i, value) in reproschema_content.items()
-            if i.startswith("items/")
-        ])
-
-        question_order = [("items/" + sub.replace("items/", ""))
-                          for sub in reproschema_schema[f"ui"][f"order"]]
-
-        reproschema_items = OrderedDict(
-            (key, reproschema_items[key]) for key in question_order)
-
-        items = self.parse_reproschema_items(reproschema_items,
-                                             reproschema_content)
-
-        fhir_questionnaire["item"] = items
         return fhir_questionnaire
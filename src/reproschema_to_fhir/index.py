@@ -0,0 +1,142 @@
+from collections import OrderedDict
+import posixpath
+from typing import Optional
+
+from .resolver import Resolver, is_url, reference_name
+
+
+def find_schema_name(reproschema_content) -> str:
+    """
+    Returns the key of the main *_schema document in the reproschema content
+    """
+    # ReproschemaLoader and ReproschemaIndex already know which file is the schema
+    schema_name = getattr(reproschema_content, "schema_name", None)
+    if schema_name is not None:
+        return schema_name
+    return [
+        name for name in list(reproschema_content.keys())
+        if name.endswith("_schema")
+    ][0]
+
+
+def options_key(item_path: str, reference: str) -> str:
+    """
+    Normalizes a responseOptions reference into a path relative to the activity folder.
+
+    References are relative to the folder of the item, eg. "../valueConstraints/yes_no"
+    from "items/consent" becomes "valueConstraints/yes_no". This is pure string manipulation,
+    the filesystem and the process working directory are never consulted.
+    """
+    return posixpath.normpath(
+        posixpath.join(posixpath.dirname(item_path), reference))
+
+
+def item_key(reference: str) -> str:
+    """
+    The key of an item in the index for its reference in ui.order.
+
+    Items of the activity are "items/<name>" however they are referenced, and so are items
+    referenced by URL or by a "../" path into another activity. Two different references
+    with the same key are rejected by ReproschemaIndex.build.
+    """
+    if is_url(reference) or reference.startswith("../"):
+        return "items/" + reference_name(reference)
+    return "items/" + reference.replace("items/", "")
+
+
+class ReproschemaIndex:
+    """
+    Everything the generator needs from a reproschema activity, resolved in one pass.
+
+    - schema_name / schema: the main *_schema document
+    - items: the item documents in the order given by ui.order
+    - options: response option documents keyed by their normalized path relative to the activity
+    - visibility: the isVis condition of each variableName in ui.addProperties
+
+    Items and option lists referenced by URL are loaded through a Resolver, and so are the
+    relative references inside them. Items referenced by a "../" path into another activity
+    are read from the content like the activity's own files.
+    """
+
+    def __init__(self, reproschema_content, schema_name: str, resolver: Optional[Resolver] = None):
+        self.content = reproschema_content
+        self.schema_name = schema_name
+        self.schema = reproschema_content[schema_name]
+        self.items = OrderedDict()
+        self.options = dict()
+        self.visibility = dict()
+        self.resolver = resolver
+        # where the items which are not in the activity's items folder came from
+        self.locations = dict()
+
+    @classmethod
+    def build(cls, reproschema_content, resolver: Optional[Resolver] = None, lazy: bool = False):
+        """
+        Build the index from a dict of file: document or a ReproschemaLoader
+
+        A lazy index leaves items empty, the items are then loaded one at a time by iter_items.
+        """
+        index = cls(reproschema_content, find_schema_name(reproschema_content), resolver)
+
+        if not lazy:
+            for (item_path, item_json) in index.iter_items():
+                index.items[item_path] = item_json
+
+        for property in index.schema["ui"].get("addProperties", []):
+            index.visibility[property["variableName"]] = property["isVis"]
+        return index
+
+    def iter_items(self):
+        """
+        The (key, document) of every item in ui.order, loaded with its response options one at a time
+        """
+        references = dict()
+        for reference in self.schema["ui"]["order"]:
+            item_path = item_key(reference)
+            if references.setdefault(item_path, reference) != reference:
+                raise ValueError(f"{references[item_path]} and {reference} in ui.order are both {item_path}, "
+                                 f"the linkIds of the items would clash")
+            item_json = self.load_item(item_path, reference)
+            if isinstance(item_json.get("responseOptions"), str):
+                self.resolve_options(item_path, item_json["responseOptions"])
+            yield (item_path, item_json)
+
+    def get_resolver(self) -> Resolver:
+        # activities without remote references never need one
+        if self.resolver is None:
+            self.resolver = Resolver()
+        return self.resolver
+
+    def load_item(self, item_path: str, reference: str) -> dict:
+        """
+        Returns the item document referenced in ui.order
+        """
+        if is_url(reference):
+            self.locations[item_path] = Resolver.resolve(reference)
+            return self.get_resolver().load(reference)
+        if reference.startswith("../"):
+            self.locations[item_path] = posixpath.normpath(reference)
+            return self.content[self.locations[item_path]]
+        return self.content[item_path]
+
+    def resolve_options(self, item_path: str, reference: str) -> dict:
+        """
+        Returns the response options document referenced by an item
+        """
+        base = self.locations.get(item_path, item_path)
+        if is_url(reference) or is_url(base):
+            url = Resolver.resolve(reference, base)
+            if url not in self.options:
+                self.options[url] = self.get_resolver().load(url)
+            return self.options[url]
+        key = options_key(base, reference)
+        if key in self.options:
+            return self.options[key]
+        if key in self.content:
+            options_json = self.content[key]
+        else:
+            # older activities reference option files which sit next to the schema
+            # by a path that does not match their location, fall back to the file name
+            options_json = self.content[posixpath.basename(key)]
+        self.options[key] = options_json
+        return options_json
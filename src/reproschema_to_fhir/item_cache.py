@@ -0,0 +1,67 @@
+import hashlib
+import sqlite3
+from typing import Optional, Sequence
+
+from . import jsonio
+from .manifest import CONVERTER_VERSION
+
+
+class ItemCache:
+    """
+    Converted item fragments keyed by a hash of everything the conversion depends on.
+
+    Library items and option lists are reused by many activities. A fragment holds what
+    converting one item gives before anything activity specific is added: the item
+    (linkId, type, text, answerOption), its option displays and its answerOption answers.
+    The code systems, value sets and enable conditions are still added per activity.
+
+    The fragments are kept in memory, e.g. by every worker of a batch run. With a path they
+    are also kept in an SQLite database which is shared by concurrent workers and later
+    runs. The key includes CONVERTER_VERSION, so stale fragments are never used.
+    """
+
+    def __init__(self, path=None):
+        self.path = None if path is None else str(path)
+        self._fragments = dict()
+        self.hits = 0
+        self.misses = 0
+        self._connection = None
+        if self.path is not None:
+            self._connection = sqlite3.connect(self.path, timeout=60, isolation_level=None)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS fragments (key TEXT PRIMARY KEY, fragment BLOB NOT NULL)")
+
+    @staticmethod
+    def key(var_name: str, item_json: dict, options_json: Optional[dict], language: str, mode: str,
+            translations: Sequence[str] = (), fallback: Sequence[str] = ()) -> str:
+        return hashlib.sha256(jsonio.dumps(
+            [CONVERTER_VERSION, var_name, item_json, options_json, language, mode,
+             list(translations), list(fallback)],
+            sort_keys=True)).hexdigest()
+
+    def get(self, key: str) -> Optional[dict]:
+        fragment = self._fragments.get(key)
+        if fragment is None and self._connection is not None:
+            row = self._connection.execute(
+                "SELECT fragment FROM fragments WHERE key = ?", (key, )).fetchone()
+            if row is not None:
+                fragment = jsonio.loads(row[0])
+                self._fragments[key] = fragment
+        if fragment is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return fragment
+
+    def put(self, key: str, fragment: dict):
+        self._fragments[key] = fragment
+        if self._connection is not None:
+            # another worker may have converted the same item in the meantime, either is fine
+            self._connection.execute(
+                "INSERT OR IGNORE INTO fragments (key, fragment) VALUES (?, ?)",
+                (key, jsonio.dumps(fragment)))
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
@@ -0,0 +1,63 @@
+import json
+from typing import Union
+
+# orjson or msgspec when installed, the json module otherwise. Every backend writes the
+# same compact (or 2 space indented) utf-8 json, so the output does not depend on which
+try:
+    import orjson
+    BACKEND = "orjson"
+except ImportError:
+    try:
+        import msgspec
+        BACKEND = "msgspec"
+    except ImportError:
+        BACKEND = "json"
+
+
+def loads(data: Union[bytes, str]):
+    """
+    Decode json from bytes (or str) without decoding the bytes to str first
+    """
+    if BACKEND == "orjson":
+        return orjson.loads(data)
+    if BACKEND == "msgspec":
+        try:
+            return msgspec.json.decode(data)
+        except msgspec.DecodeError as e:
+            # the other backends raise ValueError subclasses
+            raise ValueError(str(e)) from e
+    return json.loads(data)
+
+
+def dumps(obj, sort_keys: bool = False, pretty: bool = False) -> bytes:
+    """
+    Encode obj as utf-8 json bytes, compact unless pretty, which indents by 2 spaces
+    """
+    if BACKEND == "orjson":
+        option = 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if pretty:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, option=option)
+    if BACKEND == "msgspec":
+        data = msgspec.json.encode(obj, order="sorted" if sort_keys else None)
+        return msgspec.json.format(data, indent=2) if pretty else data
+    if pretty:
+        text = json.dumps(obj, sort_keys=sort_keys, ensure_ascii=False, indent=2)
+    else:
+        text = json.dumps(obj, sort_keys=sort_keys, ensure_ascii=False, separators=(",", ":"))
+    return text.encode("utf-8")
+
+
+def load_file(path):
+    """
+    Read a json file as bytes straight into the decoder
+    """
+    with open(path, "rb") as f:
+        return loads(f.read())
+
+
+def dump_file(path, obj, sort_keys: bool = False, pretty: bool = False):
+    with open(path, "wb") as f:
+        f.write(dumps(obj, sort_keys, pretty))
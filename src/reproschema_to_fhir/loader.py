@@ -0,0 +1,79 @@
+from collections.abc import Mapping
+import posixpath
+
+from . import jsonio
+from .archive import open_source
+from .index import item_key
+from .resolver import is_url
+
+
+def check_schema_version(reproschema_schema: dict):
+    """
+    Raise a ValueError if the schema uses a reproschema version we cannot convert
+    """
+    if (f"schema:version" in reproschema_schema and
+            reproschema_schema["schema:version"] not in ("0.0.1", "1.0.0-rc1", "1.0.0")
+        ) or f"schemaVersion" in reproschema_schema and reproschema_schema[
+            "schemaVersion"] not in ("0.0.1", "1.0.0-rc1", "1.0.0-rc4", "1.0.0"):
+        raise ValueError(
+            'Unable to work with reproschema versions other than 0.0.1, 1.0.0-rc1, and 1.0.0-rc4'
+        )
+
+
+class ReproschemaLoader(Mapping):
+    """
+    Read-only view of a reproschema activity folder which loads documents on demand.
+
+    Only the *_schema file is read when the loader is created. Items and response options
+    are read the first time they are looked up, keyed by their path relative to the folder,
+    so the loader can be passed to QuestionnaireGenerator.convert_to_fhir in place of the
+    dict of every file in the folder.
+
+    The folder may also be inside a zip or tar archive, or the activity be published on the
+    web and read through the resolver, see open_source.
+
+    Without keep_items the items are read again every time they are looked up rather than
+    kept, so streaming a large activity only holds the item being converted, see
+    stream_activity. Schemas and response options are always kept.
+    """
+
+    def __init__(self, reproschema_folder, resolver=None, keep_items: bool = True):
+        self.source = open_source(reproschema_folder, resolver)
+        self.name = self.source.name
+        self.keep_items = keep_items
+        self._documents = dict()
+        self._item_keys = set()
+
+        schema_files = self.source.schema_names()
+        if not schema_files:
+            raise FileNotFoundError(f"No *_schema file found in {self.source}")
+        self.schema_name = schema_files[0]
+        self.schema = self[self.schema_name]
+        # fail before any item is read
+        check_schema_version(self.schema)
+
+        self.item_paths = [item_key(sub) for sub in self.schema["ui"]["order"]]
+        # where the items are read from, including items of other activities by their "../" path
+        self._item_keys = {
+            posixpath.normpath(sub) if sub.startswith("../") else item_key(sub)
+            for sub in self.schema["ui"]["order"] if not is_url(sub)
+        }
+
+    def __getitem__(self, key: str):
+        if key in self._documents:
+            return self._documents[key]
+        document = jsonio.loads(self.source.read(key))
+        if self.keep_items or key not in self._item_keys:
+            self._documents[key] = document
+        return document
+
+    def __contains__(self, key) -> bool:
+        return key in self._documents or self.source.is_file(key)
+
+    def __iter__(self):
+        # only the documents reachable from the schema are listed
+        yield self.schema_name
+        yield from self.item_paths
+
+    def __len__(self) -> int:
+        return 1 + len(self.item_paths)
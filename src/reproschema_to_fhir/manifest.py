@@ -0,0 +1,123 @@
+from datetime import datetime, timezone
+import hashlib
+import json
+import os
+from pathlib import Path
+import posixpath
+from typing import List, Optional
+
+from . import jsonio
+from .archive import open_source
+from .index import options_key
+from .resolver import RemoteSource, is_url
+
+# bump when a change to the converter changes its output for the same input
+CONVERTER_VERSION = "1"
+
+
+def config_fingerprint(config, **options) -> str:
+    """
+    Fingerprint of everything besides the input files which changes the output
+    """
+    settings = {
+        key: value
+        for key, value in sorted(vars(config).items()) if key.isupper()
+    }
+    settings.update(options)
+    settings["converter"] = CONVERTER_VERSION
+    return hashlib.sha256(
+        json.dumps(settings, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def conversion_fingerprint(config, shared_terminology: bool, deterministic: bool, validate: str) -> str:
+    """
+    Fingerprint of the config and options of a conversion, for hash_activity
+
+    parallel validates the same resources as full, only in other processes, so both have
+    the same fingerprint whether the activity is converted alone or in a batch run.
+    """
+    return config_fingerprint(config,
+                              shared_terminology=shared_terminology,
+                              deterministic=deterministic,
+                              validate="full" if validate == "parallel" else validate)
+
+
+def referenced_documents(source) -> List[str]:
+    """
+    The local documents outside an activity folder which its conversion reads: the items of
+    other activities referenced in ui.order by a "../" path and their option lists
+    """
+    if isinstance(source, RemoteSource) or not source.schema_names():
+        return []
+    schema = jsonio.loads(source.read(source.schema_names()[0]))
+    documents = []
+    for reference in schema.get("ui", {}).get("order", []):
+        if is_url(reference) or not reference.startswith("../"):
+            continue
+        item_path = posixpath.normpath(reference)
+        if not source.is_file(item_path):
+            continue
+        documents.append(item_path)
+        options = jsonio.loads(source.read(item_path)).get("responseOptions")
+        if isinstance(options, str) and not is_url(options) and source.is_file(options_key(item_path, options)):
+            documents.append(options_key(item_path, options))
+    return sorted(set(documents))
+
+
+def hash_activity(reproschema_folder, config_hash: str) -> str:
+    """
+    Hash of every file in an activity folder, their relative paths and the converter config
+
+    The documents of other activities it references by a "../" path are hashed too, see
+    referenced_documents. The folder may also be inside an archive, see open_source.
+    """
+    source = open_source(reproschema_folder)
+    digest = hashlib.sha256(config_hash.encode("utf-8"))
+    for relative in source.files() + referenced_documents(source):
+        digest.update(relative.encode("utf-8") + b"\0")
+        digest.update(hashlib.sha256(source.read(relative)).digest())
+    return digest.hexdigest()
+
+
+def last_change(reproschema_folder) -> datetime:
+    """
+    Time of the most recent change to any file in an activity folder, used to pin output dates
+    """
+    source = open_source(reproschema_folder)
+    mtimes = [source.mtime(relative) for relative in source.files()]
+    return datetime.fromtimestamp(int(max(mtimes, default=0)), timezone.utc)
+
+
+class Manifest:
+    """
+    Records the input hash of every activity converted into an output folder.
+
+    An activity whose hash matches the manifest and whose output still exists does not
+    need to be converted again.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.activities = dict()
+        if self.path.exists():
+            self.activities = jsonio.load_file(self.path)
+
+    def get(self, name: str) -> Optional[str]:
+        return self.activities.get(name)
+
+    def is_current(self, name: str, digest: str, output_path) -> bool:
+        return (self.activities.get(name) == digest and
+                (Path(output_path) / name / f"{name}.json").exists())
+
+    def update(self, name: str, digest: str):
+        self.activities[name] = digest
+
+    def remove(self, name: str):
+        self.activities.pop(name, None)
+
+    def save(self):
+        # write to a temporary file first so an interrupted run never leaves half a manifest
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = self.path.with_name(self.path.name + ".tmp")
+        jsonio.dump_file(temporary, self.activities, sort_keys=True, pretty=True)
+        os.replace(temporary, self.path)
@@ -0,0 +1,103 @@
+from contextlib import contextmanager
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Dict, List
+
+from . import jsonio
+
+STAGES = ("load", "index", "convert", "validate", "write")
+
+
+class StageTimer:
+    """
+    Records the wall time, and optionally the peak traced memory, of each stage of a conversion.
+
+    A disabled timer records nothing, so it can always be passed around.
+    """
+
+    def __init__(self, enabled: bool = True, trace_memory: bool = False):
+        self.enabled = enabled
+        self.trace_memory = enabled and trace_memory
+        self.stages: Dict[str, dict] = dict()
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        started_tracing = False
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                started_tracing = True
+            tracemalloc.reset_peak()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = self.stages.setdefault(name, {"seconds": 0.0})
+            record["seconds"] += time.perf_counter() - start
+            if self.trace_memory:
+                peak = tracemalloc.get_traced_memory()[1]
+                record["peak_bytes"] = max(record.get("peak_bytes", 0), peak)
+                if started_tracing:
+                    tracemalloc.stop()
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Linearly interpolated percentile, eg. share=0.95 for p95
+    """
+    values = sorted(values)
+    if not values:
+        return 0.0
+    position = (len(values) - 1) * share
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize_stages(stage_records: List[Dict[str, dict]]) -> Dict[str, dict]:
+    """
+    Combines the stages of many activities into per-stage totals and p50/p95 figures
+    """
+    names = [name for name in STAGES if any(name in record for record in stage_records)]
+    names += sorted({name for record in stage_records for name in record} - set(names))
+    summary = dict()
+    for name in names:
+        seconds = [record[name]["seconds"] for record in stage_records if name in record]
+        summary[name] = {
+            "count": len(seconds),
+            "total_seconds": sum(seconds),
+            "p50_seconds": percentile(seconds, 0.5),
+            "p95_seconds": percentile(seconds, 0.95),
+        }
+        peaks = [record[name]["peak_bytes"] for record in stage_records
+                 if name in record and "peak_bytes" in record[name]]
+        if peaks:
+            summary[name]["max_peak_bytes"] = max(peaks)
+    return summary
+
+
+def write_report(path, results, total_seconds: float):
+    """
+    Write a machine-readable report of a run: every activity and the per-stage summary
+    """
+    report = {
+        "total_seconds": total_seconds,
+        "activities": [{
+            "name": result.name,
+            "ok": result.ok,
+            "skipped": result.skipped,
+            "seconds": result.seconds,
+            "error": result.error,
+            "stages": result.stages,
+        } for result in results],
+        "stages": summarize_stages([result.stages for result in results
+                                    if result.ok and not result.skipped]),
+    }
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    jsonio.dump_file(path, report, pretty=True)
+    return report
@@ -0,0 +1,168 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import posixpath
+from pathlib import Path
+from typing import List, NamedTuple, Optional, Union
+
+from . import batch, jsonio
+from .archive import activity_name
+from .batch import BatchOptions, TerminologyPlan, _init_worker
+from .config import Config
+from .convert import terminology_resources, write_activity_output
+from .fhir import QuestionnaireGenerator
+from .index import ReproschemaIndex
+from .loader import ReproschemaLoader
+from .manifest import last_change
+from .registry import ProvisionalRegistry, TerminologyRegistry
+from .resolver import DEFAULT_TTL, Resolver, is_url
+from .validation import serialize, validate_resources
+from .visibility import VisibilityGraph
+
+
+class ProtocolActivity(NamedTuple):
+    """
+    An activity of a protocol: the linkId of its group, where it is and its isVis condition
+    """
+    link_id: str
+    location: str
+    is_vis: Union[bool, str] = True
+
+
+def is_protocol_schema(schema: dict) -> bool:
+    return str(schema.get("@type", "")).split(":")[-1] == "Protocol"
+
+
+class Protocol:
+    """
+    A reproschema Protocol: its schema and the location of each of its activities, in order.
+
+    Activities are referenced in ui.order by the path of their schema relative to the
+    protocol, eg. "../../activities/phq9/phq9_schema", or by URL. The protocol itself may be a
+    folder, a folder in an archive or the URL of its schema, like an activity.
+    """
+
+    def __init__(self, location, resolver: Optional[Resolver] = None):
+        self.loader = ReproschemaLoader(location, resolver)
+        self.name = self.loader.name
+        self.schema = self.loader.schema
+        if not is_protocol_schema(self.schema):
+            raise ValueError(f"{self.loader.source} is not a reproschema Protocol")
+
+        properties = {
+            property["isAbout"]: property
+            for property in self.schema["ui"].get("addProperties", [])
+        }
+        self.activities: List[ProtocolActivity] = []
+        for reference in self.schema["ui"]["order"]:
+            location = self.loader.source.locate(reference)
+            if not is_url(location) and posixpath.basename(location).endswith("_schema"):
+                # local activities are opened by their folder
+                location = os.path.dirname(location)
+            property = properties.get(reference, {})
+            self.activities.append(ProtocolActivity(
+                property.get("variableName") or activity_name(location), location,
+                property.get("isVis", True)))
+
+    @property
+    def locations(self) -> List[str]:
+        return [activity.location for activity in self.activities]
+
+
+def _convert_group(activity: ProtocolActivity) -> tuple:
+    """
+    The group item of an activity, with provisional ids for its code systems, its enable
+    conditions, the claims of its code systems and the date of its resources
+    """
+    loader = ReproschemaLoader(activity.location, batch._worker_resolver)
+    index = ReproschemaIndex.build(loader, batch._worker_resolver)
+    date = last_change(loader.source) if batch._worker_options.deterministic else None
+    registry = ProvisionalRegistry()
+    generator = QuestionnaireGenerator(batch._worker_config, registry, date,
+                                       batch._worker_item_cache)
+    group = generator.activity_group(index, activity.link_id, activity.is_vis)
+    return (group, generator.enable_conditions, registry.claims, date)
+
+
+def _replace_value_sets(items: list, urls: dict):
+    for item in items:
+        if item.get("answerValueSet") in urls:
+            item["answerValueSet"] = urls[item["answerValueSet"]]
+        _replace_value_sets(item.get("item", []), urls)
+
+
+def convert_grouped_protocol(protocol_location,
+                             output_path,
+                             workers: Optional[int] = None,
+                             deterministic: bool = False,
+                             validate: str = "full",
+                             sample_rate: float = 0.1,
+                             item_cache_path=None,
+                             document_cache_path=None,
+                             offline: bool = False,
+                             cache_ttl: float = DEFAULT_TTL) -> str:
+    """
+    Convert a reproschema protocol into a single questionnaire with a group item per activity.
+
+    The activities are converted across a pool of worker processes, like the activities of a
+    batch run, and the groups put together in protocol order. Code systems and value sets
+    are shared through the registry at <output_path>/terminology.sqlite and written to
+    output_path/codesystems and output_path/valuesets. Like in a batch run they are claimed
+    in protocol order once the activities converted, see TerminologyPlan, so the output
+    does not depend on the number of workers. The
+    questionnaire and its visibility graph are written to output_path/<protocol>.
+
+    Returns the name of the output folder, i.e. the name of the protocol.
+    """
+    resolver = Resolver(document_cache_path, cache_ttl, offline)
+    protocol = Protocol(protocol_location, resolver)
+    registry_path = Path(output_path) / "terminology.sqlite"
+    registry_path.parent.mkdir(parents=True, exist_ok=True)
+    options = BatchOptions(str(registry_path), deterministic=deterministic,
+                           item_cache_path=None if item_cache_path is None else str(item_cache_path),
+                           document_cache_path=None if document_cache_path is None else str(document_cache_path),
+                           offline=offline, cache_ttl=cache_ttl, planned=True)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(protocol.activities) or 1))
+
+    config = Config()
+    plan = TerminologyPlan(TerminologyRegistry(registry_path), config)
+    try:
+        with plan.registry.transaction():
+            if workers == 1:
+                _init_worker(options)
+                converted = [_convert_group(activity) for activity in protocol.activities]
+            else:
+                with ProcessPoolExecutor(max_workers=workers,
+                                         initializer=_init_worker,
+                                         initargs=(options, )) as executor:
+                    converted = list(executor.map(_convert_group, protocol.activities))
+            for (position, (group, _, claims, _)) in enumerate(converted):
+                _replace_value_sets([group], plan.claim(position, claims))
+
+            dates = [date for (_, _, _, date) in converted]
+            date = None
+            if deterministic:
+                date = max(dates + [last_change(protocol.loader.source)])
+            generator = QuestionnaireGenerator(config, date=date)
+            questionnaire = generator.protocol_questionnaire(
+                protocol.schema, [group for (group, _, _, _) in converted])
+            visibility = VisibilityGraph(
+                [condition for (_, conditions, _, _) in converted for condition in conditions],
+                questionnaire["url"])
+
+            (valuesets, codesystems) = terminology_resources(
+                list(plan.terminology(dict(enumerate(dates))).values()), config)
+            resources = [questionnaire] + list(valuesets.values()) + list(codesystems.values())
+            validated = validate_resources(resources, validate, sample_rate, workers)
+            serialized = [serialize(resource, validated_json)
+                          for (resource, validated_json) in zip(resources, validated)]
+
+            write_activity_output(
+                Path(output_path), protocol.name, serialized[0],
+                list(zip(valuesets, serialized[1:1 + len(valuesets)])),
+                list(zip(codesystems, serialized[1 + len(valuesets):])),
+                shared=True, visibility=jsonio.dumps(visibility.to_json()))
+    finally:
+        plan.registry.close()
+    return protocol.name
@@ -0,0 +1,196 @@
+from contextlib import contextmanager, nullcontext
+import hashlib
+import json
+import sqlite3
+from typing import Iterable, Optional, Tuple
+
+
+def concept_fingerprint(concepts: list) -> str:
+    """
+    Stable fingerprint of the (code, display) pairs of a CodeSystem.
+
+    Both the codes and the displays are part of the fingerprint, so two option lists with
+    the same displays but different codes are kept apart. So are the translated displays
+    of concepts which have designations.
+    """
+    pairs = [[str(concept["code"]), str(concept["display"])] +
+             [[designation["language"], designation["value"]] for designation in concept.get("designation", [])]
+             for concept in concepts]
+    return hashlib.sha256(
+        json.dumps(pairs, separators=(",", ":"),
+                   ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class TerminologyRegistry:
+    """
+    Maps CodeSystem fingerprints to the id of their one canonical CodeSystem/ValueSet.
+
+    Without a path the registry lives in memory and only deduplicates within a single
+    generator. With a path it is an SQLite database, usually in the output folder, which
+    is shared by every activity of a run and by later runs.
+
+    Claims are pending until they are committed, once the code systems they name were
+    written. A conversion which fails rolls its claims back, so the next activity needing
+    the same code system claims it again and writes it, see transaction. Only one process
+    claims at a time: batch runs with several workers assign the ids in their parent
+    process, see run_batch.
+    """
+
+    def __init__(self, path=None):
+        self.path = None if path is None else str(path)
+        self._claimed = dict()
+        # fingerprint: id of the claims which are not committed yet, in the order they were made
+        self._pending = dict()
+        self._pending_ids = set()
+        self._connection = sqlite3.connect(
+            ":memory:" if self.path is None else self.path,
+            timeout=60,
+            isolation_level=None)
+        if self.path is not None:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS code_systems ("
+            "fingerprint TEXT PRIMARY KEY, id TEXT UNIQUE NOT NULL)")
+
+    def lookup(self, fingerprint: str) -> Optional[str]:
+        """
+        Returns the canonical id for a fingerprint, or None if it was never claimed
+        """
+        if fingerprint in self._pending:
+            return self._pending[fingerprint]
+        if fingerprint in self._claimed:
+            return self._claimed[fingerprint]
+        row = self._connection.execute(
+            "SELECT id FROM code_systems WHERE fingerprint = ?",
+            (fingerprint, )).fetchone()
+        if row is None:
+            return None
+        self._claimed[fingerprint] = row[0]
+        return row[0]
+
+    def claim(self, fingerprint: str, id_str: str, concepts: Optional[list] = None) -> Tuple[str, bool]:
+        """
+        Returns the canonical id for a fingerprint and whether this call registered it.
+
+        The first claim wins and names the CodeSystem after id_str. When id_str is already
+        used by different content a numeric suffix is added, eg. yes-no-2. The claim is
+        pending until it is committed. The concepts of the code system are only kept by a
+        ProvisionalRegistry.
+        """
+        existing = self.lookup(fingerprint)
+        if existing is not None:
+            return (existing, False)
+
+        candidate = id_str
+        suffix = 2
+        while candidate in self._pending_ids or self._connection.execute(
+                "SELECT 1 FROM code_systems WHERE id = ?",
+            (candidate, )).fetchone() is not None:
+            candidate = f"{id_str}-{suffix}"
+            suffix += 1
+        self._pending[fingerprint] = candidate
+        self._pending_ids.add(candidate)
+        return (candidate, True)
+
+    def commit(self, fingerprints: Optional[Iterable[str]] = None):
+        """
+        Register the pending claims of the fingerprints, every pending claim by default
+        """
+        if fingerprints is None:
+            fingerprints = list(self._pending)
+        claims = [(fingerprint, self._pending.pop(fingerprint)) for fingerprint in fingerprints
+                  if fingerprint in self._pending]
+        if not claims:
+            return
+        # BEGIN IMMEDIATE takes the write lock up front, a run claiming in the same registry
+        # at the same time fails here rather than publishing two code systems under one id
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            self._connection.executemany(
+                "INSERT INTO code_systems (fingerprint, id) VALUES (?, ?)", claims)
+            self._connection.execute("COMMIT")
+        except sqlite3.IntegrityError as error:
+            self._connection.execute("ROLLBACK")
+            raise ValueError(f"{self.path} was changed by another run while this one claimed its code systems") from error
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        for (fingerprint, id_str) in claims:
+            self._pending_ids.discard(id_str)
+            self._claimed[fingerprint] = id_str
+
+    def rollback(self):
+        """
+        Forget every pending claim
+        """
+        self._pending.clear()
+        self._pending_ids.clear()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Commits the claims made in the block when it succeeds, rolls them back when it raises
+        """
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
+
+    def forget(self, ids: Iterable[str]):
+        """
+        Forget the code systems of the ids, eg. once no questionnaire uses them any more
+        """
+        ids = set(ids)
+        self._connection.executemany("DELETE FROM code_systems WHERE id = ?", [(id_str, ) for id_str in ids])
+        self._claimed = {fingerprint: id_str for (fingerprint, id_str) in self._claimed.items()
+                         if id_str not in ids}
+
+    def clear(self):
+        """
+        Forget every claimed code system, for outputs which are rewritten from scratch
+        """
+        self._connection.execute("DELETE FROM code_systems")
+        self._claimed.clear()
+        self.rollback()
+
+    def close(self):
+        self._connection.close()
+
+
+class ProvisionalRegistry:
+    """
+    Gives the code systems of one activity provisional ids, to be claimed once it converted.
+
+    Batch runs with several workers claim the code systems in their parent process, in the
+    order of the activities, see run_batch. A worker converts its activity with the id each
+    code system asks for, made unique within the activity, and sends back claims, the
+    {fingerprint: (provisional id, id, concepts)} of every code system it used. The parent
+    claims them and replaces the provisional ids which differ from the canonical ones in the
+    questionnaire, see replace_strings. The claims are never new: the shared code systems
+    and value sets are generated and written by the parent.
+    """
+
+    def __init__(self, path=None):
+        self.path = None if path is None else str(path)
+        self.claims = dict()
+        self._ids = set()
+
+    def lookup(self, fingerprint: str) -> Optional[str]:
+        return self.claims[fingerprint][0] if fingerprint in self.claims else None
+
+    def claim(self, fingerprint: str, id_str: str, concepts: Optional[list] = None) -> Tuple[str, bool]:
+        if fingerprint not in self.claims:
+            candidate = id_str
+            suffix = 2
+            while candidate in self._ids:
+                candidate = f"{id_str}-{suffix}"
+                suffix += 1
+            self._ids.add(candidate)
+            self.claims[fingerprint] = (candidate, id_str, concepts)
+        return (self.claims[fingerprint][0], False)
+
+    def transaction(self):
+        # nothing to commit, the parent commits the ids once it wrote the code systems
+        return nullcontext(self)
@@ -0,0 +1,214 @@
+import hashlib
+import os
+from pathlib import Path
+import posixpath
+import threading
+import time
+from typing import List, Optional
+from urllib.error import HTTPError
+from urllib.parse import urldefrag, urljoin, urlsplit
+
+from . import jsonio
+
+# a day, reproschema-library documents change rarely
+DEFAULT_TTL = 24 * 60 * 60
+
+
+def is_url(reference) -> bool:
+    """
+    True for absolute http(s) references, eg. items from the reproschema-library on github
+    """
+    return isinstance(reference, str) and urlsplit(reference).scheme in ("http", "https")
+
+
+def reference_name(reference: str) -> str:
+    """
+    The file name a reference points to, eg. "phq9_1" for ".../activities/PHQ-9/items/phq9_1"
+    """
+    if is_url(reference):
+        reference = urlsplit(reference).path
+    return posixpath.basename(reference.rstrip("/"))
+
+
+class Resolver:
+    """
+    Loads the documents activities reference by URL, each at most once per run.
+
+    With a cache_dir the responses are kept on disk: the bodies under objects/ named by the
+    sha256 of their content, so a document served at several URLs is stored once, and the
+    url, ETag, Last-Modified and fetch time under urls/ named by the sha256 of the url.
+    A cached document younger than ttl seconds is used as is, an older one is revalidated
+    with If-None-Match / If-Modified-Since. An offline resolver never touches the network and
+    uses whatever is in the cache, however old; documents missing from it raise FileNotFoundError.
+
+    The @context documents of the activities are never loaded: the converter reads the
+    compact keys of the documents as they are, without expanding them.
+
+    The cache may be shared by the worker processes of a batch run, every file is written to
+    a temporary name first and moved into place.
+    """
+
+    def __init__(self, cache_dir=None, ttl: float = DEFAULT_TTL, offline: bool = False,
+                 timeout: float = 30):
+        self.cache_dir = None if cache_dir is None else Path(cache_dir)
+        self.ttl = ttl
+        self.offline = offline
+        self.timeout = timeout
+        self._documents = dict()
+        self._bodies = dict()
+        self._lock = threading.Lock()
+        # requests answered with a body, and with 304 Not Modified
+        self.fetches = 0
+        self.revalidations = 0
+        if self.cache_dir is not None:
+            (self.cache_dir / "objects").mkdir(parents=True, exist_ok=True)
+            (self.cache_dir / "urls").mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def resolve(reference: str, base: Optional[str] = None) -> str:
+        """
+        The location of a reference relative to the document at base: a URL when either is
+        one, otherwise a normalized path relative to the same folder as base
+        """
+        if base is None or is_url(reference):
+            return urldefrag(reference)[0]
+        if is_url(base):
+            return urldefrag(urljoin(base, reference))[0]
+        return posixpath.normpath(posixpath.join(posixpath.dirname(base), reference))
+
+    def load(self, url: str) -> dict:
+        """
+        The parsed document at url
+        """
+        url = urldefrag(url)[0]
+        with self._lock:
+            if url not in self._documents:
+                self._documents[url] = jsonio.loads(self.fetch(url))
+            return self._documents[url]
+
+    def fetch(self, url: str) -> bytes:
+        """
+        The body at url, from the cache when it is fresh enough
+        """
+        url = urldefrag(url)[0]
+        if url not in self._bodies:
+            self._bodies[url] = self._fetch(url)
+        return self._bodies[url]
+
+    def _fetch(self, url: str) -> bytes:
+        entry = self._read_entry(url)
+        body = None if entry is None else self._read_body(entry["sha256"])
+        if body is not None and (self.offline or time.time() - entry["fetched"] < self.ttl):
+            return body
+        if self.offline:
+            raise FileNotFoundError(f"{url} is not in the document cache and the resolver is offline")
+        # only activities referencing documents by URL need urllib.request and what it imports
+        from urllib.request import Request, urlopen
+
+        request = Request(url, headers={"Accept": "application/ld+json, application/json"})
+        if body is not None:
+            if entry.get("etag"):
+                request.add_header("If-None-Match", entry["etag"])
+            if entry.get("last_modified"):
+                request.add_header("If-Modified-Since", entry["last_modified"])
+        try:
+            with urlopen(request, timeout=self.timeout) as response:
+                fetched = response.read()
+                headers = response.headers
+        except HTTPError as error:
+            if error.code != 304 or body is None:
+                raise
+            self.revalidations += 1
+            entry["fetched"] = time.time()
+            self._write_entry(url, entry)
+            return body
+        self.fetches += 1
+        self._store(url, fetched, headers.get("ETag"), headers.get("Last-Modified"))
+        return fetched
+
+    def _entry_path(self, url: str) -> Path:
+        return self.cache_dir / "urls" / (hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _read_entry(self, url: str) -> Optional[dict]:
+        if self.cache_dir is None:
+            return None
+        path = self._entry_path(url)
+        if not path.is_file():
+            return None
+        return jsonio.load_file(path)
+
+    def _read_body(self, digest: str) -> Optional[bytes]:
+        path = self.cache_dir / "objects" / digest
+        if not path.is_file():
+            return None
+        with open(path, "rb") as f:
+            return f.read()
+
+    def _write(self, path: Path, data: bytes):
+        temporary = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+
+    def _write_entry(self, url: str, entry: dict):
+        self._write(self._entry_path(url), jsonio.dumps(entry, sort_keys=True))
+
+    def _store(self, url: str, body: bytes, etag: Optional[str], last_modified: Optional[str]):
+        if self.cache_dir is None:
+            return
+        digest = hashlib.sha256(body).hexdigest()
+        path = self.cache_dir / "objects" / digest
+        if not path.is_file():
+            self._write(path, body)
+        self._write_entry(url, {
+            "url": url,
+            "sha256": digest,
+            "etag": etag,
+            "last_modified": last_modified,
+            "fetched": time.time(),
+        })
+
+
+class RemoteSource:
+    """
+    An activity published on the web, read through a Resolver from the URL of its schema.
+
+    Only the documents the schema references can be found, so files lists the schema alone.
+    """
+
+    def __init__(self, url: str, resolver: Optional[Resolver] = None):
+        self.url = urldefrag(url)[0]
+        self.resolver = resolver or Resolver()
+        path = urlsplit(self.url).path
+        self.schema_name = posixpath.basename(path)
+        self.name = posixpath.basename(posixpath.dirname(path))
+
+    def schema_names(self) -> List[str]:
+        return [self.schema_name]
+
+    def is_file(self, key: str) -> bool:
+        try:
+            self.resolver.fetch(urljoin(self.url, key))
+        except OSError:
+            return False
+        return True
+
+    def read(self, key: str) -> bytes:
+        try:
+            return self.resolver.fetch(urljoin(self.url, key))
+        except HTTPError as error:
+            if error.code == 404:
+                raise KeyError(key) from error
+            raise
+
+    def files(self) -> List[str]:
+        return [self.schema_name]
+
+    def mtime(self, key: str) -> float:
+        return 0.0
+
+    def locate(self, reference: str) -> str:
+        return urljoin(self.url, reference)
+
+    def __str__(self):
+        return self.url
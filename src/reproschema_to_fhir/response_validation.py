@@ -0,0 +1,244 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import re as r
+from typing import Dict, FrozenSet, List, NamedTuple, Optional, Tuple
+
+from . import jsonio
+from .responses import MAX_ERRORS, _chunks, _open
+from .visibility import VisibilityGraph
+
+_DATE = r.compile(r"\d{4}(-\d{2}(-\d{2})?)?")
+
+# the value[x] each item type is answered with, and a check of the value
+ANSWER_TYPES = {
+    "integer": ("valueInteger", lambda value: isinstance(value, int) and not isinstance(value, bool)),
+    "decimal": ("valueDecimal", lambda value: isinstance(value, (int, float)) and not isinstance(value, bool)),
+    "string": ("valueString", lambda value: isinstance(value, str)),
+    "text": ("valueString", lambda value: isinstance(value, str)),
+    "boolean": ("valueBoolean", lambda value: isinstance(value, bool)),
+    "date": ("valueDate", lambda value: isinstance(value, str) and _DATE.fullmatch(value) is not None),
+    "attachment": ("valueAttachment", lambda value: isinstance(value, dict) and ("url" in value or "data" in value)),
+}
+
+
+class CompiledItem(NamedTuple):
+    """
+    Everything needed to check the answers to one questionnaire item
+    """
+    link_id: str
+    type: str
+    required: bool
+    repeats: bool
+    # (system, code) of every allowed coding, or ("", string) of every allowed answerOption string
+    allowed: Optional[FrozenSet[Tuple[str, str]]]
+
+
+def _walk(items: List[dict]):
+    for item in items:
+        yield item
+        yield from _walk(item.get("item", []))
+        for answer in item.get("answer", []):
+            yield from _walk(answer.get("item", []))
+
+
+class ResponseValidator:
+    """
+    Validates QuestionnaireResponses against one generated questionnaire.
+
+    The static tables are built once from the questionnaire and the code systems of its
+    value sets: the answer type of every item, the allowed codes or answerOption strings in
+    hash sets, and the VisibilityGraph of the enable conditions. Validating a response is
+    then a dict lookup and a few set lookups per answer, plus one pass over the graph.
+
+    Answers to items which are not enabled are flagged, as are missing answers to
+    required items which are enabled.
+    """
+
+    def __init__(self, questionnaire: dict, valuesets: List[dict] = (), codesystems: List[dict] = ()):
+        self.url = questionnaire.get("url")
+        concepts = {codesystem["url"]: codesystem.get("concept", []) for codesystem in codesystems}
+        valueset_codes = dict()
+        for valueset in valuesets:
+            codes = set()
+            for include in valueset.get("compose", {}).get("include", []):
+                system = include.get("system")
+                included = include.get("concept") or concepts.get(system, [])
+                codes.update((system, str(concept["code"])) for concept in included)
+            valueset_codes[valueset["url"]] = frozenset(codes)
+
+        self.items: Dict[str, CompiledItem] = dict()
+        for item in _walk(questionnaire.get("item", [])):
+            allowed = None
+            if "answerValueSet" in item:
+                if item["answerValueSet"] not in valueset_codes:
+                    raise ValueError(f"Value set {item['answerValueSet']} of {item['linkId']} was not given")
+                allowed = valueset_codes[item["answerValueSet"]]
+            elif "answerOption" in item:
+                allowed = frozenset(_option_key(option) for option in item["answerOption"])
+            self.items[item["linkId"]] = CompiledItem(
+                item["linkId"], item["type"], item.get("required", False),
+                item.get("repeats", False), allowed)
+        self.visibility = VisibilityGraph.from_questionnaire(questionnaire)
+        self.required = [item.link_id for item in self.items.values() if item.required]
+
+    def validate(self, response: dict) -> List[dict]:
+        """
+        Returns the errors of a QuestionnaireResponse, each with its linkId and a message
+        """
+        errors = []
+        if response.get("questionnaire") != self.url:
+            errors.append({"linkId": None, "error": f"questionnaire {response.get('questionnaire')} is not {self.url}"})
+        answered: Dict[str, List[dict]] = dict()
+        for item in _walk(response.get("item", [])):
+            if item.get("answer"):
+                answered.setdefault(item["linkId"], []).extend(item["answer"])
+
+        for (link_id, answers) in answered.items():
+            compiled = self.items.get(link_id)
+            if compiled is None:
+                errors.append({"linkId": link_id, "error": "not an item of the questionnaire"})
+                continue
+            if len(answers) > 1 and not compiled.repeats:
+                errors.append({"linkId": link_id, "error": f"{len(answers)} answers to an item which does not repeat"})
+            for answer in answers:
+                error = self.check_answer(compiled, answer)
+                if error:
+                    errors.append({"linkId": link_id, "error": error})
+
+        if self.visibility.conditions or self.required:
+            visible = self.visibility.visible(answered)
+            for link_id in self.visibility.conditions:
+                if link_id in answered and link_id not in visible:
+                    errors.append({"linkId": link_id, "error": "answered but not enabled"})
+            for link_id in self.required:
+                if link_id in visible and link_id not in answered:
+                    errors.append({"linkId": link_id, "error": "required but not answered"})
+        return errors
+
+    def check_answer(self, compiled: CompiledItem, answer: dict) -> Optional[str]:
+        if compiled.allowed is not None:
+            key = _option_key(answer)
+            if key not in compiled.allowed:
+                return f"{key[1]!r} is not an allowed answer"
+            return None
+        if compiled.type not in ANSWER_TYPES:
+            return None
+        (value_key, check) = ANSWER_TYPES[compiled.type]
+        if value_key not in answer:
+            return f"expected {value_key} for a {compiled.type} item, got {', '.join(answer) or 'nothing'}"
+        if not check(answer[value_key]):
+            return f"{answer[value_key]!r} is not a valid {value_key}"
+        return None
+
+    def validate_batch(self, responses: List[dict]) -> List[List[dict]]:
+        return [self.validate(response) for response in responses]
+
+
+def _option_key(answer: dict) -> Tuple[str, str]:
+    # answerOption and answers share the value[x] layout
+    if "valueCoding" in answer:
+        coding = answer["valueCoding"]
+        return (coding.get("system", ""), str(coding.get("code")))
+    for (key, value) in answer.items():
+        if key.startswith("value"):
+            return ("", str(value))
+    return ("", "")
+
+
+def compile_validators(resources: List[dict]) -> Dict[str, ResponseValidator]:
+    """
+    A ResponseValidator for every questionnaire among the resources, by questionnaire url
+    """
+    valuesets = [resource for resource in resources if resource.get("resourceType") == "ValueSet"]
+    codesystems = [resource for resource in resources if resource.get("resourceType") == "CodeSystem"]
+    validators = dict()
+    for questionnaire in resources:
+        if questionnaire.get("resourceType") == "Questionnaire":
+            validators[questionnaire["url"]] = ResponseValidator(questionnaire, valuesets, codesystems)
+    return validators
+
+
+# each worker process compiles the validators once
+_worker_validators: Dict[str, ResponseValidator] = dict()
+
+
+def _init_worker(validators: Dict[str, ResponseValidator]):
+    global _worker_validators
+    _worker_validators = validators
+
+
+def validate_lines(validators: Dict[str, ResponseValidator], lines: List[bytes],
+                   first_line: int = 1) -> Tuple[int, List[dict]]:
+    """
+    Validate ndjson lines of QuestionnaireResponses, returns the count and the errors by line
+    """
+    count = 0
+    errors = []
+    for (number, line) in enumerate(lines, first_line):
+        if not line.strip():
+            continue
+        count += 1
+        try:
+            response = jsonio.loads(line)
+            validator = validators.get(response.get("questionnaire"))
+            if validator is None:
+                response_errors = [{"linkId": None, "error": f"unknown questionnaire {response.get('questionnaire')}"}]
+            else:
+                response_errors = validator.validate(response)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            response = {}
+            response_errors = [{"linkId": None, "error": f"{type(e).__name__}: {e}"}]
+        if response_errors:
+            errors.append({"line": number, "id": response.get("id"), "errors": response_errors})
+    return (count, errors)
+
+
+def _validate_chunk(lines: List[bytes], first_line: int):
+    return validate_lines(_worker_validators, lines, first_line)
+
+
+def validate_responses(resources: List[dict],
+                       responses_path,
+                       workers: Optional[int] = None,
+                       chunk_size: int = 10000) -> Tuple[int, int, List[dict]]:
+    """
+    Validate an ndjson file of QuestionnaireResponses (.gz for gzipped) against the
+    questionnaires, value sets and code systems among the resources.
+
+    The file is read in chunks of chunk_size lines which are validated across a pool of
+    workers, each with the validators compiled once. Returns the number of responses, the
+    number of invalid ones and the errors of the first MAX_ERRORS invalid ones.
+    """
+    validators = compile_validators(resources)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    total = 0
+    invalid = 0
+    errors = []
+
+    def record(result):
+        nonlocal total, invalid
+        (count, chunk_errors) = result
+        total += count
+        invalid += len(chunk_errors)
+        errors.extend(chunk_errors[:MAX_ERRORS - len(errors)])
+
+    with _open(responses_path, "rb") as source:
+        chunks = _chunks(source, chunk_size)
+        if workers == 1:
+            for (lines, first_line) in chunks:
+                record(validate_lines(validators, lines, first_line))
+        else:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(validators, )) as executor:
+                in_flight = deque()
+                for (lines, first_line) in chunks:
+                    in_flight.append(executor.submit(_validate_chunk, lines, first_line))
+                    if len(in_flight) >= 2 * workers:
+                        record(in_flight.popleft().result())
+                while in_flight:
+                    record(in_flight.popleft().result())
+    return (total, invalid, errors)
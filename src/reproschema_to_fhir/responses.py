@@ -0,0 +1,282 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import gzip
+import itertools
+import os
+import posixpath
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from . import jsonio
+from .config import Config
+from .fhir import QuestionnaireGenerator
+from .index import ReproschemaIndex
+from .loader import ReproschemaLoader
+from .registry import TerminologyRegistry
+from .resolver import Resolver
+
+# errors kept per run, the rest are only counted
+MAX_ERRORS = 1000
+
+# each worker process builds its ResponseConverter once
+_worker_converter: Optional["ResponseConverter"] = None
+
+
+def _integer(value):
+    return {"valueInteger": int(value)}
+
+
+def _decimal(value):
+    return {"valueDecimal": float(value)}
+
+
+def _string(value):
+    return {"valueString": str(value)}
+
+
+def _boolean(value):
+    if isinstance(value, str):
+        value = value.strip().lower() in ("1", "true", "yes")
+    return {"valueBoolean": bool(value)}
+
+
+def _date(value):
+    return {"valueDate": str(value)[:10]}
+
+
+def _attachment(value):
+    return {"valueAttachment": {"url": str(value)}}
+
+
+# how a plain response value becomes an answer, by questionnaire item type
+ANSWER_TYPES = {
+    "integer": _integer,
+    "decimal": _decimal,
+    "string": _string,
+    "text": _string,
+    "boolean": _boolean,
+    "date": _date,
+    "attachment": _attachment,
+}
+
+
+class ResponseConverter:
+    """
+    Converts reproschema response activities to QuestionnaireResponses of one questionnaire.
+
+    table maps every linkId to its item type and the fhir answer of each choice value, as
+    recorded in QuestionnaireGenerator.answer_table. It is looked up once per response,
+    so converting a response is a few dict lookups per answer.
+
+    A response activity is a reproschema ResponseActivity whose generated list holds its
+    Response documents, each with the item it isAbout and its value:
+
+    {"id": "...", "wasAttributedTo": "participant", "startedAtTime": "...", "endedAtTime": "...",
+     "generated": [{"isAbout": "items/age", "value": 42}, ...]}
+    """
+
+    def __init__(self, questionnaire_url: str, table: Dict[str, Tuple[str, dict]]):
+        self.questionnaire_url = questionnaire_url
+        self.table = table
+        # linkId of every isAbout seen, which are the same few strings over and over
+        self._link_ids: Dict[str, str] = dict()
+        # the answer function of each item and its answers keyed by the codes and, as
+        # responses mostly carry numbers, also by the numbers, so values need no str()
+        self._lookup = dict()
+        for (link_id, (item_type, answers)) in table.items():
+            answers = dict(answers)
+            for code in list(answers):
+                if code.lstrip("-").isdigit():
+                    answers.setdefault(int(code), answers[code])
+            self._lookup[link_id] = (ANSWER_TYPES.get(item_type, _string), answers)
+
+    @classmethod
+    def from_activity(cls, reproschema_folder, config: Optional[Config] = None, registry_path=None,
+                      resolver: Optional[Resolver] = None):
+        """
+        Convert an activity once to get the canonical url and the answer table of its questionnaire.
+
+        When the activity was converted with shared terminology, registry_path is the
+        terminology.sqlite of that conversion: the answers then code the canonical code
+        systems its questionnaire uses instead of the ones named after its own items.
+        Nothing is claimed in the registry.
+
+        Items and option lists referenced by URL are loaded through the resolver, the one
+        of the conversion with its document cache, so they are the documents it converted.
+        """
+        if registry_path is not None and not Path(registry_path).is_file():
+            # opening it would create an empty registry, which has none of the code systems
+            raise FileNotFoundError(f"{registry_path} does not exist, it is the terminology.sqlite "
+                                    "of the shared terminology conversion of the activity")
+        registry = TerminologyRegistry(registry_path)
+        try:
+            generator = QuestionnaireGenerator(config or Config(), registry)
+            index = ReproschemaIndex.build(ReproschemaLoader(reproschema_folder, resolver), resolver)
+            header = generator.questionnaire_header(index.schema)
+            for _ in generator.iter_reproschema_items(index.items, index):
+                pass
+            if registry_path is not None and generator.code_system:
+                raise ValueError(f"The code systems {', '.join(generator.code_system)} of {reproschema_folder} "
+                                 f"are not in {registry_path}, convert the activity with it first")
+        finally:
+            registry.rollback()
+            registry.close()
+        return cls(header["url"], generator.answer_table)
+
+    def answer(self, link_id: str, value) -> List[dict]:
+        """
+        The fhir answers of the value, or list of values, of a response to an item
+        """
+        (to_answer, answers) = self._lookup[link_id]
+        values = value if isinstance(value, list) else [value]
+        result = []
+        for value in values:
+            if value is None or value == "":
+                continue
+            if answers:
+                answer = answers.get(value)
+                if answer is None:
+                    answer = answers.get(str(value).strip())
+                if answer is None:
+                    raise ValueError(f"{value!r} is not an answer of {link_id}")
+                result.append(answer)
+            else:
+                result.append(to_answer(value))
+        return result
+
+    def link_id(self, is_about: str) -> str:
+        link_id = self._link_ids.get(is_about)
+        if link_id is None:
+            link_id = posixpath.basename(str(is_about).rstrip("/"))
+            if link_id not in self.table:
+                raise ValueError(f"{link_id} is not an item of {self.questionnaire_url}")
+            self._link_ids[is_about] = link_id
+        return link_id
+
+    def convert(self, response_activity: dict) -> dict:
+        """
+        The QuestionnaireResponse of a response activity
+        """
+        response = {"resourceType": "QuestionnaireResponse"}
+        identifier = response_activity.get("id") or response_activity.get("@id")
+        if identifier:
+            response["id"] = posixpath.basename(str(identifier).rstrip("/"))
+        response["questionnaire"] = self.questionnaire_url
+        response["status"] = "completed" if response_activity.get("endedAtTime") else "in-progress"
+        participant = response_activity.get("wasAttributedTo")
+        if isinstance(participant, dict):
+            participant = participant.get("@id") or participant.get("id")
+        if participant:
+            response["subject"] = {"identifier": {"value": str(participant)}}
+        authored = response_activity.get("endedAtTime") or response_activity.get("startedAtTime")
+        if authored:
+            response["authored"] = authored
+
+        items = []
+        for reproschema_response in response_activity.get("generated", []):
+            link_id = self.link_id(reproschema_response["isAbout"])
+            answer = self.answer(link_id, reproschema_response.get("value"))
+            if answer:
+                items.append({"linkId": link_id, "answer": answer})
+        if items:
+            response["item"] = items
+        return response
+
+    def convert_lines(self, lines: List[bytes], first_line: int = 1) -> Tuple[List[bytes], List[dict]]:
+        """
+        Convert ndjson lines of response activities to QuestionnaireResponse json lines.
+
+        Returns the lines and an error for each line which could not be converted.
+        """
+        converted = []
+        errors = []
+        for (number, line) in enumerate(lines, first_line):
+            if not line.strip():
+                continue
+            try:
+                converted.append(jsonio.dumps(self.convert(jsonio.loads(line))))
+            except (ValueError, KeyError, TypeError, AttributeError) as e:
+                errors.append({"line": number, "error": f"{type(e).__name__}: {e}"})
+        return (converted, errors)
+
+
+def _init_worker(converter: ResponseConverter):
+    global _worker_converter
+    _worker_converter = converter
+
+
+def _convert_chunk(lines: List[bytes], first_line: int):
+    return _worker_converter.convert_lines(lines, first_line)
+
+
+def _open(path, mode: str):
+    return gzip.open(path, mode) if str(path).endswith(".gz") else open(path, mode)
+
+
+def _chunks(lines: Iterable[bytes], chunk_size: int):
+    # (lines, number of the first line) of chunk_size lines at a time
+    first_line = 1
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        yield (chunk, first_line)
+        first_line += len(chunk)
+
+
+def convert_responses(reproschema_folder,
+                      responses_path,
+                      output_path,
+                      config: Optional[Config] = None,
+                      workers: Optional[int] = None,
+                      chunk_size: int = 10000,
+                      registry_path=None,
+                      resolver: Optional[Resolver] = None) -> Tuple[int, int, List[dict]]:
+    """
+    Convert an ndjson file of response activities to an ndjson file of QuestionnaireResponses.
+
+    Either file may be gzipped (.gz). The lines are read and converted in chunks of
+    chunk_size across a pool of workers, with at most two chunks per worker in flight,
+    so memory stays bounded however large the file is. The output keeps the input order.
+    registry_path is the terminology.sqlite of a shared terminology conversion of the
+    activity and resolver loads the documents it references by URL, see
+    ResponseConverter.from_activity.
+
+    Returns the number of converted responses, the number of failed ones and the first
+    MAX_ERRORS errors, by line number.
+    """
+    converter = ResponseConverter.from_activity(reproschema_folder, config, registry_path, resolver)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    converted = 0
+    failed = 0
+    errors = []
+
+    def write(output, result):
+        nonlocal converted, failed
+        (lines, chunk_errors) = result
+        for line in lines:
+            output.write(line + b"\n")
+        converted += len(lines)
+        failed += len(chunk_errors)
+        errors.extend(chunk_errors[:MAX_ERRORS - len(errors)])
+
+    Path(output_path).parent.mkdir(parents=True, exist_ok=True)
+    with _open(responses_path, "rb") as source, _open(output_path, "wb") as output:
+        chunks = _chunks(source, chunk_size)
+        if workers == 1:
+            for (lines, first_line) in chunks:
+                write(output, converter.convert_lines(lines, first_line))
+        else:
+            with ProcessPoolExecutor(max_workers=workers,
+                                     initializer=_init_worker,
+                                     initargs=(converter, )) as executor:
+                in_flight = deque()
+                for (lines, first_line) in chunks:
+                    in_flight.append(executor.submit(_convert_chunk, lines, first_line))
+                    if len(in_flight) >= 2 * workers:
+                        write(output, in_flight.popleft().result())
+                while in_flight:
+                    write(output, in_flight.popleft().result())
+    return (converted, failed, errors)
@@ -0,0 +1,284 @@
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import time
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+import zipfile
+
+from . import jsonio
+from .archive import Archive, ArchiveSource
+from .config import Config
+from .fhir import QuestionnaireGenerator
+from .index import ReproschemaIndex
+from .item_cache import ItemCache
+from .loader import ReproschemaLoader, check_schema_version
+from .profiling import percentile
+from .resolver import Resolver
+from .validation import VALIDATION_STRATEGIES, serialize, validate_resources
+
+ARCHIVE_CONTENT_TYPES = ("application/zip", "application/x-zip-compressed", "application/x-tar",
+                         "application/gzip", "application/x-gtar")
+# requests larger than this are refused rather than read into memory
+MAX_REQUEST_BYTES = 64 * 1024 * 1024
+# number of recent requests the latency percentiles are computed over
+LATENCY_WINDOW = 1000
+# number of bundles each worker keeps for requests which are sent again
+RESPONSE_CACHE_SIZE = 128
+
+# each worker process loads the .env and the pydantic models once, and keeps its
+# compiled enableWhen conditions for its lifetime
+_service_config: Optional[Config] = None
+# documents referenced by URL only come from the document cache, a request never makes
+# the service fetch a URL of its choosing
+_service_resolver: Optional[Resolver] = None
+# items converted by a worker are reused by every later request it converts, like in a batch run
+_service_item_cache: Optional[ItemCache] = None
+# fingerprint of a request: its bundle, of the most recent requests, see _convert_request
+_service_responses: Optional[OrderedDict] = None
+
+
+def _init_service_worker(validate: str, document_cache_path=None):
+    global _service_config, _service_resolver, _service_item_cache, _service_responses
+    _service_config = Config()
+    _service_resolver = Resolver(document_cache_path, offline=True)
+    _service_item_cache = ItemCache()
+    _service_responses = OrderedDict()
+    if validate != "off":
+        import fhir.resources.questionnaire  # noqa: F401
+        import fhir.resources.valueset  # noqa: F401
+        import fhir.resources.codesystem  # noqa: F401
+
+
+def documents_from_zip(data: bytes) -> ReproschemaLoader:
+    """
+    Returns a loader of the documents of a zipped (or tarred) reproschema activity.
+
+    The activity may be at the root of the archive or in a folder, paths are relative to
+    the folder of the *_schema file. Only the members the activity references are read.
+    """
+    archive = Archive(data=data)
+    activities = archive.activities()
+    if not activities:
+        raise ValueError("No *_schema file found in the archive")
+    # the activity closest to the root, like the archive of a single activity folder
+    folder = min(activities, key=lambda folder: (folder.count("/") + bool(folder), folder))
+    return ReproschemaLoader(ArchiveSource(archive, folder, name="activity"))
+
+
+def convert_documents(documents: dict, validate: str = "full", resolver: Optional[Resolver] = None,
+                      item_cache: Optional[ItemCache] = None) -> bytes:
+    """
+    Convert a dict of path: document to a collection Bundle of the questionnaire, its
+    value sets and its code systems, as json
+
+    Items and option lists referenced by URL are loaded through the resolver, by default
+    an offline one, so only documents in its cache can be referenced. Items are converted
+    through the item cache, by default the one of the worker.
+    """
+    if validate not in VALIDATION_STRATEGIES:
+        raise ValueError(
+            f"Unknown validation strategy {validate}, expected one of {', '.join(VALIDATION_STRATEGIES)}")
+    config = _service_config or Config()
+    index = ReproschemaIndex.build(documents, resolver or _service_resolver or Resolver(offline=True))
+    check_schema_version(index.schema)
+
+    # every request gets its own registry, so the response has all of its terminology
+    generator = QuestionnaireGenerator(
+        config, item_cache=item_cache if item_cache is not None else _service_item_cache)
+    questionnaire = generator.convert_to_fhir(index)
+    # enable conditions in a cycle fail the request
+    generator.visibility_graph(questionnaire["url"])
+    resources = ([questionnaire] + list(generator.get_value_set().values()) +
+                 list(generator.get_code_system().values()))
+    # the service is already spread over a pool, so validation stays in this worker
+    validated = validate_resources(resources, "full" if validate == "parallel" else validate,
+                                   workers=1)
+    entries = b",".join(b'{"resource":' + serialize(resource, validated_json) + b"}"
+                        for (resource, validated_json) in zip(resources, validated))
+    return b'{"resourceType":"Bundle","type":"collection","entry":[' + entries + b"]}"
+
+
+def _convert_request(body: bytes, content_type: str, validate: str) -> tuple:
+    """
+    The bundle of a request and whether it was converted before, by this worker.
+
+    A request is known by the fingerprint of its body, content type and validation
+    strategy. The documents it references by URL can only come from the document cache,
+    so the same request always converts to the same bundle.
+    """
+    fingerprint = hashlib.sha256(
+        content_type.encode("utf-8") + b"\0" + validate.encode("utf-8") + b"\0" + body).hexdigest()
+    if _service_responses is not None and fingerprint in _service_responses:
+        _service_responses.move_to_end(fingerprint)
+        return (_service_responses[fingerprint], True)
+    if content_type in ARCHIVE_CONTENT_TYPES:
+        documents = documents_from_zip(body)
+    else:
+        documents = jsonio.loads(body)
+        if not isinstance(documents, dict):
+            raise ValueError("Expected a json object of path: document")
+    bundle = convert_documents(documents, validate)
+    if _service_responses is not None:
+        _service_responses[fingerprint] = bundle
+        if len(_service_responses) > RESPONSE_CACHE_SIZE:
+            _service_responses.popitem(last=False)
+    return (bundle, False)
+
+
+class Metrics:
+    """
+    Request counts and the latency of the most recent requests, safe to update from many threads
+    """
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.cache_hits = 0
+        self.latencies = deque(maxlen=window)
+
+    def begin(self):
+        with self._lock:
+            self.in_flight += 1
+
+    def end(self, seconds: float, ok: bool, cached: bool = False):
+        with self._lock:
+            self.in_flight -= 1
+            self.requests += 1
+            self.errors += 0 if ok else 1
+            self.cache_hits += 1 if cached else 0
+            self.latencies.append(seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            latencies = list(self.latencies)
+            return {
+                "uptime_seconds": time.time() - self.started,
+                "requests": self.requests,
+                "errors": self.errors,
+                "cache_hits": self.cache_hits,
+                "in_flight": self.in_flight,
+                "latency_seconds": {
+                    "count": len(latencies),
+                    "p50": percentile(latencies, 0.5),
+                    "p95": percentile(latencies, 0.95),
+                    "p99": percentile(latencies, 0.99),
+                    "max": max(latencies, default=0.0),
+                },
+            }
+
+
+class ConversionHandler(BaseHTTPRequestHandler):
+    """
+    POST /convert with a zipped or tarred activity (Content-Type: application/zip, application/x-tar
+    or application/gzip) or a json object of path: document returns a collection Bundle of
+    the FHIR resources. ?validate= picks the validation strategy. A request sent again is
+    answered from the cache of the worker, with an X-Cache: HIT header. GET /metrics returns
+    the request counts and latency percentiles.
+
+    The service never goes to the network: an activity may only reference documents by URL
+    which are in the document cache of the server, see Resolver.
+    """
+    server_version = "reproschema-to-fhir"
+
+    def _send(self, status: int, body: bytes, content_type: str = "application/fhir+json",
+              headers: Optional[dict] = None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status: int, message: str):
+        self._send(status, jsonio.dumps({
+            "resourceType": "OperationOutcome",
+            "issue": [{"severity": "error", "code": "processing" if status < 500 else "exception",
+                       "diagnostics": message}]
+        }))
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            self._send(200, jsonio.dumps(self.server.metrics.snapshot(), pretty=True), "application/json")
+        elif path == "/health":
+            self._send(200, b'{"status":"ok"}', "application/json")
+        else:
+            self._send_error(404, f"Unknown path {path}")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/convert":
+            self._send_error(404, f"Unknown path {url.path}")
+            return
+        length = int(self.headers.get("Content-Length") or 0)
+        if length > MAX_REQUEST_BYTES:
+            self._send_error(413, f"Request larger than {MAX_REQUEST_BYTES} bytes")
+            return
+        body = self.rfile.read(length)
+        validate = parse_qs(url.query).get("validate", [self.server.validate])[0]
+        content_type = self.headers.get("Content-Type", "application/json").split(";")[0].strip()
+
+        metrics = self.server.metrics
+        metrics.begin()
+        start = time.perf_counter()
+        error = None
+        cached = False
+        try:
+            (result, cached) = self.server.executor.submit(_convert_request, body, content_type, validate).result()
+        except (ValueError, KeyError, IndexError, TypeError, FileNotFoundError, zipfile.BadZipFile) as e:
+            # the content is not a reproschema activity we can convert, or references
+            # documents which are not in the document cache
+            error = (400, f"{type(e).__name__}: {e}")
+        except Exception as e:
+            error = (500, f"{type(e).__name__}: {e}")
+        # recorded before responding, so a client reading /metrics next sees its own request
+        metrics.end(time.perf_counter() - start, error is None, cached)
+        if error is None:
+            self._send(200, result, headers={"X-Cache": "HIT" if cached else "MISS"})
+        else:
+            self._send_error(*error)
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+class ConversionServer(ThreadingHTTPServer):
+    """
+    HTTP server handing conversions to a pool of warm worker processes, see ConversionHandler
+    """
+    daemon_threads = True
+
+    def __init__(self, address, workers: Optional[int] = None, validate: str = "full",
+                 quiet: bool = False, document_cache_path=None):
+        super().__init__(address, ConversionHandler)
+        self.validate = validate
+        self.quiet = quiet
+        self.metrics = Metrics()
+        self.executor = ProcessPoolExecutor(max_workers=workers,
+                                            initializer=_init_service_worker,
+                                            initargs=(validate, document_cache_path))
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown()
+
+
+def serve(host: str = "127.0.0.1", port: int = 8000, workers: Optional[int] = None,
+          validate: str = "full", document_cache_path=None):
+    """
+    Run the conversion service until interrupted
+    """
+    with ConversionServer((host, port), workers, validate, document_cache_path=document_cache_path) as server:
+        print(f"serving on http://{host}:{server.server_address[1]}/convert")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,74 @@
+import os
+from pathlib import Path
+from typing import BinaryIO, Iterable
+
+
+def write_questionnaire_stream(file: BinaryIO, header: bytes, items: Iterable[bytes]) -> int:
+    """
+    Write a questionnaire json from the compact json of its header and of each of its items.
+
+    header is the questionnaire without items. The items are written as they are produced,
+    so only one item is held in memory at a time. Returns the number of items written.
+    """
+    header = header.rstrip()
+    if not header.endswith(b"}"):
+        raise ValueError("The questionnaire header must be a json object")
+    # the header is written up to its closing brace and the item array spliced in after it
+    file.write(header[:-1])
+    empty = header[:-1].rstrip().endswith(b"{")
+    count = 0
+    for item in items:
+        if count == 0:
+            file.write(b'"item":[' if empty else b',"item":[')
+        else:
+            file.write(b",")
+        file.write(item)
+        count += 1
+    # fhir does not allow empty arrays, so a questionnaire without items has no item at all
+    file.write(b"]}" if count else b"}")
+    return count
+
+
+
+def _replace_parts(parts: list, replacements: dict) -> bytes:
+    return b'"'.join(replacements.get(part, part) for part in parts)
+
+
+def replace_strings(data: bytes, replacements: dict) -> bytes:
+    """
+    Replace the json strings of data which are keys of replacements, both given without quotes.
+
+    Only whole strings are replaced: escaped quotes are preceded by a backslash, so the text
+    between two quotes is never one of the strings unless it is the whole string.
+    """
+    if not replacements:
+        return data
+    return _replace_parts(data.split(b'"'), replacements)
+
+
+def replace_strings_in_file(path, replacements: dict, chunk_size: int = 1 << 20):
+    """
+    Replace the json strings of the file at path which are keys of replacements, see
+    replace_strings, a chunk at a time.
+    """
+    if not replacements:
+        return
+    path = Path(path)
+    partial_path = path.with_name(path.name + ".partial")
+    try:
+        with open(path, "rb") as source, open(partial_path, "wb") as target:
+            # the text after the last quote of a chunk may continue in the next one
+            rest = b""
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                parts = (rest + chunk).split(b'"')
+                rest = parts.pop()
+                if parts:
+                    target.write(_replace_parts(parts, replacements) + b'"')
+            target.write(rest)
+    except BaseException:
+        partial_path.unlink(missing_ok=True)
+        raise
+    os.replace(partial_path, path)
@@ -0,0 +1,47 @@
+from dataclasses import dataclass
+from pathlib import Path
+from typing import List, Optional
+
+from . import jsonio
+from .config import Config
+
+
+@dataclass
+class Target:
+    """
+    One rendering of the converted activities: its settings and the folder it is written to.
+    """
+    name: str
+    config: Config
+    output_path: str
+
+
+def load_targets(profile_path, output_path, config: Optional[Config] = None) -> List[Target]:
+    """
+    The targets of a profile file, eg.
+
+    {
+        "targets": [
+            {"name": "staging", "QUESTIONNAIRE_URI": "https://staging.example.org/fhir/Questionnaire/"},
+            {"name": "production", "output": "published", "FHIR_QUESTIONNAIRE_MODE": "AnswerOptions"}
+        ]
+    }
+
+    Every setting of the .env may be given, the ones a target leaves out are those of
+    config. Each target is written to its "output" folder, output_path/<name> by default.
+    """
+    if config is None:
+        config = Config()
+    profile = jsonio.load_file(profile_path)
+    targets = []
+    for settings in profile["targets"]:
+        settings = dict(settings)
+        name = settings.pop("name")
+        output = settings.pop("output", None)
+        if any(target.name == name for target in targets):
+            raise ValueError(f"Target {name} is in {profile_path} twice")
+        targets.append(Target(name, config.with_settings(settings),
+                              str(output if output is not None else Path(output_path) / name)))
+    if not targets:
+        raise ValueError(f"{profile_path} has no targets")
+    return targets
@@ -0,0 +1,173 @@
+import asyncio
+from dataclasses import dataclass
+import gzip
+import itertools
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import jsonio
+
+BUNDLE_TYPES = ("batch", "transaction")
+# code systems before the value sets including them, before the questionnaires using those
+UPLOAD_ORDER = ("CodeSystem", "ValueSet", "Questionnaire")
+# statuses worth sending the same bundle again for
+RETRY_STATUSES = (408, 429, 500, 502, 503, 504)
+
+
+@dataclass
+class UploadResult:
+    """
+    Outcome of sending one bundle to the server.
+    """
+    bundle: int
+    entries: int
+    ok: bool
+    status: int = 0
+    attempts: int = 0
+    error: str = ""
+
+
+def read_output(output_path) -> List[dict]:
+    """
+    Every resource written to an output folder, by the files or the ndjson format
+    """
+    output_path = Path(output_path)
+    resources = []
+    for path in sorted(output_path.glob("*.ndjson")) + sorted(output_path.glob("*.ndjson.gz")):
+        opener = gzip.open if path.suffix == ".gz" else open
+        with opener(path, "rb") as f:
+            resources += [jsonio.loads(line) for line in f if line.strip()]
+    for path in sorted(output_path.glob("**/*.json")):
+        if path.parent == output_path:
+            # manifest.json, reports and other run files
+            continue
+        document = jsonio.load_file(path)
+        if isinstance(document, dict) and document.get("resourceType") in UPLOAD_ORDER:
+            resources.append(document)
+    return resources
+
+
+def _upload_position(resource: dict) -> int:
+    if resource["resourceType"] in UPLOAD_ORDER:
+        return UPLOAD_ORDER.index(resource["resourceType"])
+    return len(UPLOAD_ORDER)
+
+
+def make_bundles(resources: List[dict], bundle_size: int = 100,
+                 bundle_type: str = "batch") -> List[dict]:
+    """
+    Pack resources into bundles of at most bundle_size PUT entries each, in UPLOAD_ORDER
+
+    A bundle only holds resources of one type, so upload_bundles can send the types one
+    after the other. PUT to <resourceType>/<id> makes the upload idempotent, so a bundle
+    can be sent again.
+    """
+    if bundle_type not in BUNDLE_TYPES:
+        raise ValueError(f"Unknown bundle type {bundle_type}, expected one of {', '.join(BUNDLE_TYPES)}")
+    if bundle_size < 1:
+        raise ValueError("bundle_size must be at least 1")
+    resources = sorted(resources, key=_upload_position)
+    bundles = []
+    for (_, phase) in itertools.groupby(resources, key=_upload_position):
+        phase = list(phase)
+        bundles += [{
+            "resourceType": "Bundle",
+            "type": bundle_type,
+            "entry": [{
+                "resource": resource,
+                "request": {
+                    "method": "PUT",
+                    "url": f"{resource['resourceType']}/{resource['id']}"
+                }
+            } for resource in phase[start:start + bundle_size]],
+        } for start in range(0, len(phase), bundle_size)]
+    return bundles
+
+
+
+def _entry_errors(response: dict) -> List[str]:
+    # a batch is accepted as a whole even when some of its entries fail
+    errors = []
+    for number, entry in enumerate((response or {}).get("entry", [])):
+        status = entry.get("response", {}).get("status", "")
+        if status and not status.startswith("2"):
+            errors.append(f"entry {number}: {status}")
+    return errors
+
+
+async def upload_bundles(base_url: str,
+                         bundles: List[dict],
+                         concurrency: int = 4,
+                         retries: int = 3,
+                         backoff: float = 0.5,
+                         headers: Optional[Dict[str, str]] = None,
+                         timeout: float = 300) -> List[UploadResult]:
+    """
+    POST every bundle to the FHIR server at base_url over a pool of keep-alive connections.
+
+    The bundles of each resource type, see make_bundles, are sent once every bundle of the
+    types before it is done, so the code systems are on the server before the value sets
+    including them and those before the questionnaires using them. Within a type at most
+    concurrency bundles are in flight at once. A bundle which fails with a
+    connection error or one of the RETRY_STATUSES is sent again up to retries times,
+    waiting backoff, 2 * backoff, 4 * backoff... seconds, or the Retry-After of the server.
+    """
+    import aiohttp
+
+    headers = dict(headers or {})
+    headers.setdefault("Content-Type", "application/fhir+json")
+    headers.setdefault("Accept", "application/fhir+json")
+    semaphore = asyncio.Semaphore(concurrency)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async def send(session, number: int, bundle: dict) -> UploadResult:
+        result = UploadResult(number, len(bundle["entry"]), False)
+        body = jsonio.dumps(bundle)
+        async with semaphore:
+            while True:
+                result.attempts += 1
+                delay = backoff * 2**(result.attempts - 1)
+                try:
+                    async with session.post(base_url, data=body) as response:
+                        result.status = response.status
+                        text = await response.text()
+                        if response.status < 300:
+                            errors = _entry_errors(jsonio.loads(text) if text else None)
+                            result.ok = not errors
+                            result.error = "; ".join(errors)
+                            return result
+                        result.error = f"{response.status} {response.reason}: {text[:500]}"
+                        if response.status not in RETRY_STATUSES:
+                            return result
+                        if response.headers.get("Retry-After", "").isdigit():
+                            delay = float(response.headers["Retry-After"])
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    result.error = f"{type(e).__name__}: {e}"
+                if result.attempts > retries:
+                    return result
+                await asyncio.sleep(delay)
+
+    async with aiohttp.ClientSession(connector=connector,
+                                     headers=headers,
+                                     timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        results = []
+        phases = itertools.groupby(enumerate(bundles),
+                                   key=lambda numbered: _upload_position(numbered[1]["entry"][0]["resource"]))
+        for (_, phase) in phases:
+            results += await asyncio.gather(*[send(session, number, bundle) for (number, bundle) in phase])
+        return results
+
+
+def upload(output_path,
+           base_url: str,
+           bundle_size: int = 100,
+           bundle_type: str = "batch",
+           concurrency: int = 4,
+           retries: int = 3,
+           backoff: float = 0.5,
+           headers: Optional[Dict[str, str]] = None) -> List[UploadResult]:
+    """
+    Upload every resource in an output folder to a FHIR server, see upload_bundles
+    """
+    bundles = make_bundles(read_output(output_path), bundle_size, bundle_type)
+    return asyncio.run(upload_bundles(base_url, bundles, concurrency, retries, backoff, headers))
@@ -0,0 +1,86 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
+import random
+from typing import List, Optional
+
+from . import jsonio
+
+VALIDATION_STRATEGIES = ("off", "full", "sample", "parallel")
+
+
+def validate_resource(resource: dict) -> str:
+    """
+    Validate a FHIR resource dict with fhir.resources and return the validated model as json
+    """
+    # importing fhir.resources takes longer than converting an activity, so runs
+    # with --validate off never pay for it
+    from fhir.resources import construct_fhir_element
+    model = construct_fhir_element(resource["resourceType"], resource)
+    return model.json()
+
+
+def validate_item(item: dict) -> str:
+    """
+    Validate a single questionnaire item dict and return the validated model as json
+    """
+    from fhir.resources import construct_fhir_element
+    return construct_fhir_element("QuestionnaireItem", item).json()
+
+
+def _validate_chunk(resources: list) -> list:
+    return [validate_resource(resource) for resource in resources]
+
+
+def validate_resources(resources: List[dict],
+                       strategy: str = "full",
+                       sample_rate: float = 0.1,
+                       workers: Optional[int] = None,
+                       seed: Optional[int] = None) -> List[Optional[str]]:
+    """
+    Validate FHIR resources according to a strategy and return the validated json of each.
+
+    - off: nothing is validated
+    - full: every resource is validated in this process
+    - sample: a random sample_rate share of the resources, at least one, is validated
+    - parallel: every resource is validated across a pool of worker processes
+
+    The result has one entry per resource: the json of the validated model, or None when
+    the resource was not validated and should be serialized from the dict instead.
+    Invalid resources raise the pydantic ValidationError.
+    """
+    if strategy not in VALIDATION_STRATEGIES:
+        raise ValueError(
+            f"Unknown validation strategy {strategy}, expected one of {', '.join(VALIDATION_STRATEGIES)}")
+
+    validated: List[Optional[str]] = [None] * len(resources)
+    if strategy == "off" or not resources:
+        return validated
+
+    if strategy == "sample":
+        count = max(1, round(len(resources) * sample_rate))
+        for position in random.Random(seed).sample(range(len(resources)),
+                                                   min(count, len(resources))):
+            validated[position] = validate_resource(resources[position])
+        return validated
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if strategy == "parallel" and workers > 1 and len(resources) > 1:
+        # a few chunks per worker keeps the pickling overhead down and the workers busy
+        size = max(1, len(resources) // (workers * 4))
+        chunks = [resources[start:start + size]
+                  for start in range(0, len(resources), size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = executor.map(_validate_chunk, chunks)
+            return [resource for chunk in results for resource in chunk]
+
+    return [validate_resource(resource) for resource in resources]
+
+
+def serialize(resource: dict, validated: Optional[str]) -> bytes:
+    """
+    Returns the validated json if there is one, otherwise the json of the dict, as utf-8 bytes
+    """
+    if validated is not None:
+        return validated.encode("utf-8")
+    return jsonio.dumps(resource)
@@ -0,0 +1,323 @@
+import heapq
+import re as r
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from .enable_when import ENABLE_WHEN_EXPRESSION_URL, AllOf, AnyOf, Condition, Node
+
+# one comparison of the expressions written by enable_when._fhirpath
+_EXPRESSION_COMPARISON = r.compile(
+    r"%resource\.repeat\(item\)\.where\(linkId='(?P<question>(?:[^'\\]|\\.)*)'\)"
+    r"\.answer\.value\.select\(code \| \$this\.toString\(\)\)"
+    r"\.exists\(\$this(?:\.toDecimal\(\))? (?P<operator>=|!=|>=|<=|>|<) "
+    r"(?:'(?P<string>(?:[^'\\]|\\.)*)'|(?P<number>-?\d+(?:\.\d+)?))\)")
+_EXPRESSION_TOKEN = r.compile(r"\s*(?:(?P<comparison>%resource)|(?P<and>and\b)|(?P<or>or\b)|(?P<lparen>\()|(?P<rparen>\)))")
+_NUMBER = r.compile(r"-?\d+(\.\d+)?")
+
+
+class VisibilityError(ValueError):
+    """
+    The enable conditions of a questionnaire depend on each other in a cycle
+    """
+
+
+def parse_enable_when_expression(expression: str) -> Node:
+    """
+    Parses an enableWhenExpression written by the converter back into Condition, AllOf and AnyOf nodes
+    """
+    comparisons = []
+
+    def comparison(match):
+        answer = match.group("string")
+        if answer is None:
+            answer = match.group("number")
+        comparisons.append(Condition(match.group("question").replace("\\'", "'"), match.group("operator"),
+                                     answer.replace("\\'", "'")))
+        return "%resource"
+
+    remainder = _EXPRESSION_COMPARISON.sub(comparison, expression)
+    tokens = []
+    position = 0
+    while position < len(remainder.rstrip()):
+        match = _EXPRESSION_TOKEN.match(remainder, position)
+        if match is None:
+            raise ValueError(f"Unsupported enableWhenExpression {expression!r}")
+        tokens.append(match.lastgroup)
+        position = match.end()
+    pending = iter(comparisons)
+    position = 0
+
+    def expression_node() -> Node:
+        nonlocal position
+        nodes = [conjunction()]
+        while position < len(tokens) and tokens[position] == "or":
+            position += 1
+            nodes.append(conjunction())
+        return nodes[0] if len(nodes) == 1 else AnyOf(tuple(nodes))
+
+    def conjunction() -> Node:
+        nonlocal position
+        nodes = [atom()]
+        while position < len(tokens) and tokens[position] == "and":
+            position += 1
+            nodes.append(atom())
+        return nodes[0] if len(nodes) == 1 else AllOf(tuple(nodes))
+
+    def atom() -> Node:
+        nonlocal position
+        if position >= len(tokens):
+            raise ValueError(f"Unsupported enableWhenExpression {expression!r}")
+        token = tokens[position]
+        position += 1
+        if token == "comparison":
+            return next(pending)
+        if token == "lparen":
+            node = expression_node()
+            if position >= len(tokens) or tokens[position] != "rparen":
+                raise ValueError(f"Unsupported enableWhenExpression {expression!r}")
+            position += 1
+            return node
+        raise ValueError(f"Unsupported enableWhenExpression {expression!r}")
+
+    node = expression_node()
+    if position != len(tokens):
+        raise ValueError(f"Unsupported enableWhenExpression {expression!r}")
+    return node
+
+
+def _enable_when_answer(condition: dict) -> str:
+    for (key, value) in condition.items():
+        if key.startswith("answer"):
+            if isinstance(value, dict):
+                # answerCoding
+                return str(value.get("code"))
+            if isinstance(value, bool):
+                return "true" if value else "false"
+            return str(value)
+    return ""
+
+
+def enable_node(item: dict) -> Optional[Node]:
+    """
+    The enable condition of a FHIR questionnaire item, from its enableWhen and
+    enableBehavior or its enableWhenExpression, or None when it is always enabled
+    """
+    for extension in item.get("extension", []):
+        if extension.get("url") == ENABLE_WHEN_EXPRESSION_URL:
+            return parse_enable_when_expression(extension["valueExpression"]["expression"])
+    if not item.get("enableWhen"):
+        return None
+    conditions = tuple(
+        Condition(condition["question"], condition["operator"], _enable_when_answer(condition))
+        for condition in item["enableWhen"])
+    if len(conditions) == 1:
+        return conditions[0]
+    return AnyOf(conditions) if item.get("enableBehavior") == "any" else AllOf(conditions)
+
+
+def answer_strings(value) -> List[str]:
+    """
+    The answers to an item as the strings the enable conditions compare, like the
+    select(code | $this.toString()) of the enableWhenExpression.
+
+    value is a plain value, a FHIR answer ({"valueCoding": ...}, {"valueInteger": ...}, ...)
+    or a list of either.
+    """
+    if value is None:
+        return []
+    if not isinstance(value, (list, tuple)):
+        value = [value]
+    strings = []
+    for answer in value:
+        if isinstance(answer, dict):
+            for (key, answer_value) in answer.items():
+                if key.startswith("value"):
+                    strings.extend(answer_strings(answer_value.get("code", "") if isinstance(answer_value, dict)
+                                                  else answer_value))
+        elif isinstance(answer, bool):
+            strings.append("true" if answer else "false")
+        else:
+            strings.append(str(answer))
+    return strings
+
+
+def questions(node: Node) -> List[str]:
+    """
+    The linkIds a condition depends on, in order of appearance
+    """
+    if isinstance(node, Condition):
+        return [node.question]
+    found = []
+    for child in node.conditions:
+        found += [question for question in questions(child) if question not in found]
+    return found
+
+
+def _compile(node: Node) -> Callable[[Dict[str, List[str]]], bool]:
+    # a closure per node, so evaluating does not dispatch on the node types again
+    if isinstance(node, AllOf):
+        children = [_compile(child) for child in node.conditions]
+        return lambda answers: all(child(answers) for child in children)
+    if isinstance(node, AnyOf):
+        children = [_compile(child) for child in node.conditions]
+        return lambda answers: any(child(answers) for child in children)
+
+    (question, operator, answer) = node
+    if operator == "exists":
+        expected = answer.lower() == "true"
+        return lambda answers: bool(answers.get(question)) == expected
+    if operator == "=":
+        return lambda answers: answer in answers.get(question, ())
+    if operator == "!=":
+        return lambda answers: any(value != answer for value in answers.get(question, ()))
+    if operator not in (">", "<", ">=", "<="):
+        raise ValueError(f"Unknown enableWhen operator {operator}")
+    compare = {">": float.__gt__, "<": float.__lt__, ">=": float.__ge__, "<=": float.__le__}[operator]
+    if _NUMBER.fullmatch(answer):
+        number = float(answer)
+
+        def numeric(answers):
+            for value in answers.get(question, ()):
+                try:
+                    if compare(float(value), number):
+                        return True
+                except ValueError:
+                    # text answers are never more or less than a number
+                    continue
+            return False
+        return numeric
+    text_compare = {">": str.__gt__, "<": str.__lt__, ">=": str.__ge__, "<=": str.__le__}[operator]
+    return lambda answers: any(text_compare(value, answer) for value in answers.get(question, ()))
+
+
+def condition_to_json(node: Node):
+    if isinstance(node, Condition):
+        return {"question": node.question, "operator": node.operator, "answer": node.answer}
+    return {"all" if isinstance(node, AllOf) else "any": [condition_to_json(child) for child in node.conditions]}
+
+
+def condition_from_json(document: dict) -> Node:
+    if "all" in document:
+        return AllOf(tuple(condition_from_json(child) for child in document["all"]))
+    if "any" in document:
+        return AnyOf(tuple(condition_from_json(child) for child in document["any"]))
+    return Condition(document["question"], document["operator"], document["answer"])
+
+
+class VisibilityGraph:
+    """
+    The enable conditions of a questionnaire compiled into a dependency graph.
+
+    Every item depends on the questions its condition compares and on its parent group.
+    The items are kept in topological order, so the visible items for a set of answers
+    are found in a single pass: the answers to hidden items are ignored, as FHIR requires,
+    by the time the items depending on them are evaluated. Cycles raise a VisibilityError
+    when the graph is built. A condition on an item which is not in the questionnaire is
+    kept, the item it refers to is never answered, and recorded in warnings, as isVis
+    conditions often refer to items of other activities.
+
+    to_json and from_json read and write the sidecar written next to each questionnaire.
+    """
+
+    def __init__(self, items: Iterable[Tuple[str, Optional[Node], Optional[str]]], url: Optional[str] = None):
+        """
+        items are the (linkId, enable condition or None, parent linkId or None) of every
+        item, in questionnaire order
+        """
+        self.url = url
+        items = list(items)
+        self.conditions: Dict[str, Node] = {link_id: node for (link_id, node, _) in items if node is not None}
+        self.parents: Dict[str, str] = {link_id: parent for (link_id, _, parent) in items if parent is not None}
+        position = {link_id: number for (number, (link_id, _, _)) in enumerate(items)}
+
+        dependencies = dict()
+        self.warnings: List[str] = []
+        for (link_id, node, parent) in items:
+            depends_on = questions(node) if node is not None else []
+            self.warnings += [f"{link_id} depends on {question}, which is not in the questionnaire"
+                              for question in depends_on if question not in position]
+            if parent is not None:
+                depends_on = [parent] + depends_on
+            dependencies[link_id] = [question for question in depends_on if question in position]
+        self.dependencies: Dict[str, List[str]] = dependencies
+
+        # Kahn's algorithm, taking the earliest item in questionnaire order first
+        dependents = {link_id: [] for link_id in position}
+        remaining = dict()
+        for (link_id, depends_on) in dependencies.items():
+            remaining[link_id] = len(set(depends_on))
+            for question in set(depends_on):
+                dependents[question].append(link_id)
+        ready = [position[link_id] for (link_id, count) in remaining.items() if count == 0]
+        heapq.heapify(ready)
+        link_ids = [link_id for (link_id, _, _) in items]
+        self.order: List[str] = []
+        while ready:
+            link_id = link_ids[heapq.heappop(ready)]
+            self.order.append(link_id)
+            for dependent in dependents[link_id]:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, position[dependent])
+        if len(self.order) != len(link_ids):
+            cycle = [link_id for link_id in link_ids if remaining[link_id] > 0]
+            raise VisibilityError(f"Enable conditions depend on each other in a cycle: {', '.join(cycle)}")
+
+        # only the items with a condition or a parent need evaluating, in topological order
+        self._steps = [(link_id, _compile(self.conditions[link_id]) if link_id in self.conditions else None,
+                        self.parents.get(link_id))
+                       for link_id in self.order if link_id in self.conditions or link_id in self.parents]
+
+    @classmethod
+    def from_questionnaire(cls, questionnaire: dict) -> "VisibilityGraph":
+        def walk(items, parent):
+            for item in items:
+                yield (item["linkId"], enable_node(item), parent)
+                yield from walk(item.get("item", []), item["linkId"])
+        return cls(walk(questionnaire.get("item", []), None), questionnaire.get("url"))
+
+    def visible(self, answers: dict) -> Set[str]:
+        """
+        The linkIds of the visible items given the answers by linkId, see answer_strings
+        """
+        return self.visible_strings({link_id: answer_strings(value) for (link_id, value) in answers.items()})
+
+    def visible_strings(self, answers: Dict[str, List[str]]) -> Set[str]:
+        """
+        Like visible, with the answers already converted by answer_strings
+        """
+        visible = set(self.order)
+        if not self._steps:
+            return visible
+        answers = dict(answers)
+        for (link_id, condition, parent) in self._steps:
+            if (parent is not None and parent not in visible) or (condition is not None and not condition(answers)):
+                visible.discard(link_id)
+                answers.pop(link_id, None)
+        return visible
+
+    def visible_batch(self, answer_sets: Iterable[dict]) -> List[Set[str]]:
+        return [self.visible(answers) for answers in answer_sets]
+
+    def to_json(self) -> dict:
+        return {
+            "questionnaire": self.url,
+            "order": self.order,
+            "items": {
+                link_id: dict(
+                    {"dependsOn": self.dependencies[link_id]},
+                    **({"parent": self.parents[link_id]} if link_id in self.parents else {}),
+                    **({"condition": condition_to_json(self.conditions[link_id])}
+                       if link_id in self.conditions else {}))
+                for link_id in self.order if self.dependencies[link_id] or link_id in self.conditions
+            },
+            **({"warnings": self.warnings} if self.warnings else {}),
+        }
+
+    @classmethod
+    def from_json(cls, document: dict) -> "VisibilityGraph":
+        # the topological order is also a valid questionnaire order to rebuild from
+        items = document["items"]
+        return cls(((link_id,
+                     condition_from_json(items[link_id]["condition"]) if "condition" in items.get(link_id, {}) else None,
+                     items.get(link_id, {}).get("parent"))
+                    for link_id in document["order"]), document.get("questionnaire"))
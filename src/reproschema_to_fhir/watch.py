@@ -0,0 +1,183 @@
+import os
+from pathlib import Path
+import threading
+from typing import Callable, Dict, List, Optional, Set
+
+from . import batch, jsonio
+from .archive import FolderSource
+from .batch import ActivityResult, BatchOptions, _convert_one, _init_worker, find_activities
+from .manifest import Manifest, referenced_documents
+
+
+def activity_signature(reproschema_folder, referenced: List[str] = ()) -> tuple:
+    """
+    Cheap fingerprint of an activity folder: the path, size and mtime of every file in it,
+    and of the documents of other activities it references, see referenced_documents
+    """
+    reproschema_folder = Path(reproschema_folder)
+    signature = []
+    for file in sorted(reproschema_folder.glob("**/*")):
+        if file.is_file():
+            stat = file.stat()
+            signature.append((file.relative_to(reproschema_folder).as_posix(),
+                              stat.st_size, stat.st_mtime_ns))
+    for relative in referenced:
+        try:
+            stat = os.stat(os.path.normpath(reproschema_folder / relative))
+            signature.append((relative, stat.st_size, stat.st_mtime_ns))
+        except FileNotFoundError:
+            signature.append((relative, None, None))
+    return tuple(signature)
+
+
+class ActivityWatcher:
+    """
+    Keeps a converter warm and converts again only the activities whose files changed.
+
+    The config, the registry and the imports are loaded once. Every poll compares a stat
+    signature of each activity folder, which is cheap enough to do a few times a second,
+    and converts the changed folders in this process. The signature includes the documents
+    of other activities an activity references by a "../" path, which are only looked up
+    again when the signature changed. The content hash in the manifest then skips folders
+    whose files were touched but not changed.
+
+    With a registry, an edited option list gets its own shared CodeSystem and ValueSet
+    like in a batch run, and the ones no questionnaire uses any more are removed from the
+    shared folders and from the registry.
+    """
+
+    def __init__(self, activities_root, output_path, options: Optional[BatchOptions] = None):
+        self.activities_root = Path(activities_root)
+        self.output_path = Path(output_path)
+        options = options or BatchOptions()
+        # the manifest is what lets touched but unchanged activities be skipped
+        options.incremental = True
+        self.options = options
+        if options.validate != "off":
+            # pay for the pydantic models now rather than on the first edit
+            import fhir.resources.questionnaire  # noqa: F401
+        # loaded on the first poll, after the batch run which usually comes before it
+        self.manifest: Optional[Manifest] = None
+        self.signatures: Dict[str, tuple] = dict()
+        # the documents of other activities each activity references, by folder
+        self.referenced: Dict[str, List[str]] = dict()
+        # with a registry, the ids of the shared value sets the questionnaire of each activity
+        # uses by name, read on the first change
+        self.terminology: Optional[Dict[str, Set[str]]] = None
+
+    def signature(self, folder: str) -> tuple:
+        """
+        The signature of an activity, see activity_signature
+        """
+        if folder in self.referenced:
+            signature = activity_signature(folder, self.referenced[folder])
+            if signature == self.signatures.get(folder):
+                return signature
+        try:
+            self.referenced[folder] = referenced_documents(FolderSource(folder))
+        except Exception:
+            # eg. a schema being written, converting it reports the error
+            self.referenced[folder] = []
+        return activity_signature(folder, self.referenced[folder])
+
+    def prime(self):
+        """
+        Record the current state of every activity without converting anything
+        """
+        self.signatures = {
+            str(folder): self.signature(str(folder))
+            for folder in find_activities(self.activities_root)
+        }
+
+    def used_terminology(self, name: str) -> Set[str]:
+        """
+        The ids of the shared value sets the questionnaire of an activity uses
+        """
+        path = self.output_path / name / f"{name}.json"
+        if not path.exists():
+            return set()
+        prefix = batch._worker_config.get_valueset()
+        ids = set()
+        items = list(jsonio.load_file(path).get("item", []))
+        while items:
+            item = items.pop()
+            if item.get("answerValueSet", "").startswith(prefix):
+                ids.add(item["answerValueSet"][len(prefix):])
+            items.extend(item.get("item", []))
+        return ids
+
+    def remove_unused_terminology(self, names: List[str]):
+        """
+        Remove the shared code systems and value sets which the activities of names used
+        before they were converted again but no activity uses now
+        """
+        previous = set()
+        for name in names:
+            previous |= self.terminology.get(name, set())
+            self.terminology[name] = self.used_terminology(name)
+        unused = previous - set().union(*self.terminology.values())
+        if not unused:
+            return
+        # forgotten first, so an activity using the options again writes them again
+        batch._worker_registry.forget(unused)
+        for id_str in unused:
+            for folder in ("codesystems", "valuesets"):
+                (self.output_path / folder / f"{id_str}.json").unlink(missing_ok=True)
+
+    def poll(self) -> List[ActivityResult]:
+        """
+        Convert the activities which were added or changed since the last poll
+        """
+        current = {
+            str(folder): self.signature(str(folder))
+            for folder in find_activities(self.activities_root)
+        }
+        changed = [folder for folder, signature in current.items()
+                   if self.signatures.get(folder) != signature]
+        removed = [folder for folder in self.signatures if folder not in current]
+        self.signatures = current
+        for folder in removed:
+            self.referenced.pop(folder, None)
+
+        if self.manifest is None:
+            self.manifest = Manifest(self.output_path / "manifest.json")
+        if batch._worker_options is not self.options:
+            # once, unless an in-process batch run replaced the converter in the meantime
+            _init_worker(self.options)
+        shared = self.options.registry_path is not None and bool(changed)
+        if shared and self.terminology is None:
+            # what every questionnaire uses before any of them is converted again, the
+            # output of removed activities is kept and so are the value sets it uses
+            self.terminology = {Path(folder).name: self.used_terminology(Path(folder).name)
+                                for folder in list(current) + removed}
+        results = []
+        for folder in changed:
+            name = Path(folder).name
+            result = _convert_one(folder, str(self.output_path), self.manifest.get(name))
+            if result.ok:
+                self.manifest.update(name, result.digest)
+            else:
+                # retried on the next change, e.g. once an editor finished writing the file
+                self.manifest.remove(name)
+            results.append(result)
+        for folder in removed:
+            self.manifest.remove(Path(folder).name)
+        if shared:
+            self.remove_unused_terminology([Path(folder).name for folder in changed])
+        if changed or removed:
+            self.manifest.save()
+        return results
+
+    def watch(self,
+              interval: float = 0.5,
+              on_results: Optional[Callable[[List[ActivityResult]], None]] = None,
+              stop: Optional[threading.Event] = None):
+        """
+        Poll every interval seconds until stop is set, passing converted activities to on_results
+        """
+        stop = stop or threading.Event()
+        while not stop.is_set():
+            results = [result for result in self.poll() if not result.skipped]
+            if results and on_results is not None:
+                on_results(results)
+            stop.wait(interval)